@@ -0,0 +1,223 @@
+"""
+Conditional, partial and signed GETs of file fields.
+
+The ETag of a BinderFileField is its stored content hash, so a client which
+has the file already gets a 304 without the file being opened. Other file
+fields are validated with the modified time of the file in storage.
+
+When BINDER_SIGNED_FILE_URL_MAX_AGE is set, the urls of BinderFileFields
+with serve_directly point to the signed_file_view instead. The url contains
+the name of the file in storage, its hash and an expiry time, signed with
+the SECRET_KEY, so the file can be handed to the web server without a
+query for the object or its permissions.
+"""
+
+import mimetypes
+import os
+import re
+import time
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import http_date, parse_http_date_safe
+
+from .exceptions import BinderException, BinderInvalidSignature, BinderMethodNotAllowed
+
+
+RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class RangeNotSatisfiable(Exception):
+	pass
+
+
+def get_etag(file_field):
+	content_hash = getattr(file_field, 'stored_content_hash', None)
+	if not content_hash:
+		return None
+	return '"{}"'.format(content_hash)
+
+
+def get_last_modified(file_field):
+	"""
+	Returns the modified time of the file as a timestamp, or None when the
+	storage does not know it.
+	"""
+	try:
+		return int(file_field.storage.get_modified_time(file_field.name).timestamp())
+	except (NotImplementedError, AttributeError):
+		return None
+
+
+def set_validators(response, etag, last_modified):
+	if etag is not None:
+		response['ETag'] = etag
+	if last_modified is not None:
+		response['Last-Modified'] = http_date(last_modified)
+
+
+def get_not_modified_response(request, etag, last_modified):
+	"""
+	Returns a 304 (or 412) response when the conditional headers of the
+	request match the file, otherwise None.
+	"""
+	response = HttpResponse()
+	set_validators(response, etag, last_modified)
+	conditional_response = get_conditional_response(request, etag=etag, last_modified=last_modified, response=response)
+	if conditional_response is response:
+		return None
+	return conditional_response
+
+
+def parse_range(request, size, etag, last_modified):
+	"""
+	Returns the first and last byte of the Range of the request, or None when
+	the whole file should be sent: when there is no Range, it is not a single
+	byte range, or the If-Range does not match the file. Raises
+	RangeNotSatisfiable when the range is outside of the file.
+	"""
+	header = request.META.get('HTTP_RANGE')
+	if not header:
+		return None
+
+	if_range = request.META.get('HTTP_IF_RANGE')
+	if if_range:
+		if if_range.startswith(('"', 'W/')):
+			# Weak etags can not be used for ranges
+			if etag is None or if_range != etag:
+				return None
+		elif last_modified is None or parse_http_date_safe(if_range) != last_modified:
+			return None
+
+	match = RANGE_RE.fullmatch(header.strip())
+	if not match or match.groups() == ('', ''):
+		return None
+	start, end = match.groups()
+
+	if not start:
+		# Suffix range, the last n bytes
+		length = int(end)
+		if not length or not size:
+			raise RangeNotSatisfiable()
+		return max(size - length, 0), size - 1
+
+	start = int(start)
+	if start >= size:
+		raise RangeNotSatisfiable()
+	end = int(end) if end else size - 1
+	if end < start:
+		# Invalid, so ignored
+		return None
+	return start, min(end, size - 1)
+
+
+class FileRange:
+	"""
+	Iterates over the bytes from start to end (inclusive) of a file, and
+	closes the file when the response is closed.
+	"""
+
+	def __init__(self, file, start, end, chunk_size=64 * 1024):
+		self.file = file
+		self.remaining = end - start + 1
+		self.chunk_size = chunk_size
+		file.seek(start)
+
+	def __iter__(self):
+		while self.remaining > 0:
+			chunk = self.file.read(min(self.chunk_size, self.remaining))
+			if not chunk:
+				break
+			self.remaining -= len(chunk)
+			yield chunk
+
+	def close(self):
+		self.file.close()
+
+
+def get_direct_response(storage, name, content_type):
+	"""
+	Returns a response which lets the web server serve the file, with the
+	INTERNAL_MEDIA_HEADER.
+	"""
+	resp = HttpResponse(content_type=content_type)
+	resp[settings.INTERNAL_MEDIA_HEADER] = os.path.join(settings.INTERNAL_MEDIA_LOCATION, name)
+	# if the filefield does not start with '/' it is likely a http address (S3) instead of path
+	# and because of that we set the redirect url
+	url = storage.url(name)
+	if not url.startswith('/'):
+		resp['redirect_url'] = url
+	return resp
+
+
+def get_signed_url_max_age():
+	"""
+	Returns the number of seconds signed file urls are valid, or None when
+	they are not used.
+	"""
+	return getattr(settings, 'BINDER_SIGNED_FILE_URL_MAX_AGE', None)
+
+
+def get_signature(model, field_name, name, content_hash, expires):
+	value = '\n'.join((model._meta.label, field_name, name, content_hash or '', str(expires)))
+	return salted_hmac('binder.downloads.signed_file', value, algorithm='sha256').hexdigest()
+
+
+def get_signed_url(route, model, field_name, name, content_hash, content_type, max_age):
+	"""
+	Returns the signed url of a file, which is valid for at least max_age
+	seconds. The expiry is rounded, so the url stays the same (and can be
+	cached by the browser) for max_age seconds.
+	"""
+	expires = (int(time.time()) // max_age + 2) * max_age
+	return '{}{}/signed/{}?h={}&content_type={}&filename={}&expires={}&signature={}'.format(
+		route, field_name, quote(name),
+		content_hash or '',
+		content_type or '',
+		os.path.basename(name),
+		expires,
+		get_signature(model, field_name, name, content_hash, expires),
+	)
+
+
+def signed_file_view(request, model, file_field, name):
+	"""
+	Serves a file of a signed url. This does not query the database, the
+	signature proves the url was handed out by a view of the object.
+	"""
+	try:
+		if request.method not in ('GET', 'HEAD'):
+			raise BinderMethodNotAllowed(['GET'])
+
+		content_hash = request.GET.get('h', '')
+		try:
+			expires = int(request.GET['expires'])
+			signature = request.GET['signature']
+		except (KeyError, ValueError):
+			raise BinderInvalidSignature()
+
+		if not constant_time_compare(signature, get_signature(model, file_field, name, content_hash, expires)):
+			raise BinderInvalidSignature()
+
+		max_age = expires - int(time.time())
+		if max_age <= 0:
+			raise BinderInvalidSignature()
+	except BinderException as e:
+		e.log()
+		return e.response()
+
+	etag = '"{}"'.format(content_hash) if content_hash else None
+	resp = get_not_modified_response(request, etag, None)
+	if resp is None:
+		guess = mimetypes.guess_type(name)
+		content_type = (guess and guess[0]) or 'application/octet-stream'
+		resp = get_direct_response(model._meta.get_field(file_field).storage, name, content_type)
+		set_validators(resp, etag, None)
+		if 'download' in request.GET:
+			resp['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(name))
+	# The url, and so the file, does not change until it expires
+	resp['Cache-Control'] = 'private, max-age={}'.format(max_age)
+	return resp
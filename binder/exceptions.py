@@ -122,6 +122,12 @@ class BinderForbidden(BinderException):
 
 
 
+class BinderInvalidSignature(BinderException):
+	http_code = 403
+	code = 'InvalidSignature'
+
+
+
 class BinderCSRFFailure(BinderRequestError):
 	http_code = 403
 	code = 'CSRFFailure'
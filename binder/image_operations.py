@@ -0,0 +1,100 @@
+"""
+Image operations of the ImageView, which run in worker processes.
+
+The operations get the path of the image in local storage, and write the
+result back to it. They do not use Django, so this module can be imported
+by worker processes which are not set up for it.
+"""
+
+import hashlib
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+
+# Forking the (possibly threaded) server process would copy the state of its
+# other threads, like held locks and open database connections, so workers
+# are started from a clean process instead.
+DEFAULT_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def hash_file(path, hash_name, buffer_size=64 * 1024):
+	hasher = hashlib.new(hash_name)
+	with open(path, 'rb') as fh:
+		while True:
+			chunk = fh.read(buffer_size)
+			if not chunk:
+				break
+			hasher.update(chunk)
+	return hasher.hexdigest()
+
+
+def rotate(path, hash_name, angle):
+	with Image.open(path) as img:
+		result = img.rotate(angle, expand=1)
+	result.save(path)
+	return hash_file(path, hash_name) if hash_name else None
+
+
+def crop(path, hash_name, box):
+	with Image.open(path) as img:
+		result = img.crop(box)
+	result.save(path)
+	return hash_file(path, hash_name) if hash_name else None
+
+
+def reset(path, hash_name, original_path):
+	with Image.open(original_path) as img:
+		img.save(path)
+	return hash_file(path, hash_name) if hash_name else None
+
+
+def get_pool(workers, start_method=None):
+	"""
+	Returns the pool of at most workers processes, started with the given
+	multiprocessing start method. The pool is created when it is first used,
+	and shared by all later calls in this process.
+	"""
+	key = (workers, start_method or DEFAULT_START_METHOD)
+	with _pools_lock:
+		pool = _pools.get(key)
+		if pool is None:
+			pool = _pools[key] = ProcessPoolExecutor(
+				max_workers=workers,
+				mp_context=multiprocessing.get_context(key[1]),
+			)
+		return pool
+
+
+def _discard_pool(pool):
+	with _pools_lock:
+		for key, value in list(_pools.items()):
+			if value is pool:
+				del _pools[key]
+	pool.shutdown(wait=False)
+
+
+def run(tasks, workers, start_method=None):
+	"""
+	Run a list of (operation, args) tuples in the pool of at most workers
+	processes, and return their results in order. A single task, or a single
+	worker, runs in this process.
+	"""
+	if workers <= 1 or len(tasks) <= 1:
+		return [operation(*args) for operation, args in tasks]
+
+	pool = get_pool(workers, start_method)
+	try:
+		futures = [pool.submit(operation, *args) for operation, args in tasks]
+	except BrokenProcessPool:
+		# A worker of the pool died in an earlier call, use a new pool
+		_discard_pool(pool)
+		pool = get_pool(workers, start_method)
+		futures = [pool.submit(operation, *args) for operation, args in tasks]
+	return [future.result() for future in futures]
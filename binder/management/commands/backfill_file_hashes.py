@@ -0,0 +1,57 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+from binder.models import BinderFileField
+
+
+# A stored value with a hash is a tuple of name, hash and content type, so
+# it contains a comma which is not escaped with a backslash
+HAS_HASH_RE = r'^([^,\\]|\\.)*,'
+
+
+class Command(BaseCommand):
+	help = 'Calculate and store the content hashes of BinderFileFields which were stored without one'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=1000, help='Number of rows to fetch at a time')
+
+	def handle(self, *args, batch_size, **options):
+		for model in apps.get_models():
+			for field in model._meta.concrete_fields:
+				if isinstance(field, BinderFileField):
+					count = self.backfill(model, field, batch_size)
+					self.stdout.write('{}.{}: {} hashes stored'.format(model._meta.label, field.name, count))
+
+	def backfill(self, model, field, batch_size):
+		queryset = (
+			model._base_manager
+			.exclude(**{field.attname + '__isnull': True})
+			.exclude(**{field.attname: ''})
+			.exclude(**{field.attname + '__regex': HAS_HASH_RE})
+			.order_by('pk')
+		)
+
+		count = 0
+		last_pk = None
+		while True:
+			batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+			rows = list(batch.values_list('pk', field.attname)[:batch_size])
+			if not rows:
+				break
+
+			for pk, name in rows:
+				file = field.attr_class(None, field, name, None, None)
+				# Read the file outside of any transaction, and only store the
+				# hash when the file was not replaced in the meantime
+				file.content_hash
+				count += (
+					model._base_manager
+					.alias(_binder_stored_file=Cast(field.attname, TextField()))
+					.filter(pk=pk, _binder_stored_file=name)
+					.update(**{field.attname: file})
+				)
+			last_pk = rows[-1][0]
+
+		return count
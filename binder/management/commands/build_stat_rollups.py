@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.urls import get_resolver
+from django.utils.translation import gettext as _
+
+from binder.rollups import stat_rollups
+
+
+class Command(BaseCommand):
+    help = _('Build the rollups of all materialized stats from all records')
+
+    def handle(self, *args, **options):
+        # Views are registered to stat_rollups in the urlconf
+        get_resolver().url_patterns
+
+        stat_rollups.build()
+
+        for model, view in stat_rollups.views.items():
+            stats = [name for name, stat in view.stats.items() if stat.materialized]
+            self.stdout.write(_('Built %(stats)s of %(model)s') % {'stats': ', '.join(stats), 'model': model._meta.label})
@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('binder', '0004_history_changeset_change_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=255)),
+                ('stat', models.CharField(max_length=255)),
+                ('built_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'unique_together': {('model', 'stat')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StatRollupValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.TextField()),
+                ('value', models.BigIntegerField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+                ('rollup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='values', to='binder.statrollup')),
+            ],
+            options={
+                'unique_together': {('rollup', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-19 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('binder', '0005_statrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Thumbnail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('file_name', models.CharField(max_length=400)),
+                ('size', models.BigIntegerField()),
+                ('accessed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
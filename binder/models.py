@@ -4,13 +4,14 @@ import warnings
 import hashlib
 import mimetypes
 import json
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from datetime import date, datetime, time
 from contextlib import suppress
 from decimal import Decimal
 from functools import partial
 
 from django import forms
+from django.conf import settings
 from django.db import models
 from django.db.models import Value
 from django.db.models.fields.files import FieldFile, FileField
@@ -32,6 +33,8 @@ from binder.json import jsonloads
 from binder.exceptions import BinderRequestError
 
 from . import history
+from . import rollups # noqa
+from . import thumbnails # noqa
 
 
 @models.CharField.register_lookup
@@ -492,6 +495,9 @@ class BinderModel(models.Model, metaclass=BinderModelBase):
 				continue
 			elif isinstance(field, models.ForeignKey):
 				fields[field.name] = getattr(self, field.name + '_id')
+			elif isinstance(field, BinderFileField) and field.attname not in deferred_fields:
+				# Like str() of the file, without constructing it
+				fields[field.name] = field.get_stored_file(self).name or ''
 			elif isinstance(field, models.FileField):
 				fields[field.name] = str(getattr(self, field.name))
 			else:
@@ -885,7 +891,7 @@ def parse_tuple(content):
 
 	chars = iter(content)
 	value = ''
-	for char in content:
+	for char in chars:
 		if char == ',':
 			values.append(value)
 			value = ''
@@ -898,6 +904,48 @@ def parse_tuple(content):
 	return tuple(values)
 
 
+class HashingFile(File):
+	"""
+	Wraps the content of a file while it is saved to storage, to calculate
+	its hash from the bytes the storage reads. The hash is only known when
+	the storage read the content from start to end.
+	"""
+
+	def __init__(self, file, get_hasher):
+		super().__init__(file, getattr(file, 'name', None))
+		self.get_hasher = get_hasher
+		self.hasher = get_hasher()
+		self.position = 0
+		self.eof = False
+
+	def read(self, size=-1):
+		data = self.file.read(size)
+		if self.hasher is not None:
+			if isinstance(data, bytes):
+				self.hasher.update(data)
+				self.position += len(data)
+				self.eof = not data or size is None or size < 0
+			else:
+				self.hasher = None
+		return data
+
+	def seek(self, *args, **kwargs):
+		result = self.file.seek(*args, **kwargs)
+		position = self.file.tell()
+		if position == 0:
+			self.hasher = self.get_hasher()
+			self.position = 0
+			self.eof = False
+		elif position != self.position:
+			self.hasher = None
+		return result
+
+	def hexdigest(self):
+		if self.hasher is None or not self.eof:
+			return None
+		return self.hasher.hexdigest()
+
+
 class BinderFieldFile(FieldFile):
 	"""
 	An extended FieldFile that also stores the content hash and content type
@@ -908,11 +956,15 @@ class BinderFieldFile(FieldFile):
 		self._content_hash = content_hash
 		self._content_type = content_type
 
+	def get_hasher(self):
+		return hashlib.new(getattr(settings, 'BINDER_FILE_HASH_ALGORITHM', 'sha1'))
+
 	def calculate_hash(self, fh):
-		hasher = hashlib.sha1()
+		hasher = self.get_hasher()
+		buffer_size = getattr(settings, 'BINDER_FILE_HASH_BUFFER_SIZE', 64 * 1024)
 
 		while True:
-			chunk = fh.read(4096)
+			chunk = fh.read(buffer_size)
 			if not chunk:
 				break
 			hasher.update(chunk)
@@ -956,6 +1008,17 @@ class BinderFieldFile(FieldFile):
 
 		return self._content_hash
 
+	@property
+	def stored_content_hash(self):
+		"""
+		The content hash as stored in the database, without reading the file
+		when it is missing. This is None for rows stored before the hash was,
+		until they are backfilled with the backfill_file_hashes command.
+		"""
+		if not self.name:
+			return None
+		return self._content_hash
+
 	@property
 	def content_type(self):
 		if not self.name:
@@ -974,12 +1037,29 @@ class BinderFieldFile(FieldFile):
 			self._content_hash = None
 		return super().open(mode)
 
-	def save(self, *args, **kwargs):
+	def save(self, name, content, save=True):
 		# So in this case both the name and the content can change so we
-		# reset everything
-		self._content_hash = None
+		# reset everything. The hash is calculated while the content is
+		# written, so it does not have to be read back from storage.
 		self._content_type = None
-		return super().save(*args, **kwargs)
+		if hasattr(content, 'temporary_file_path'):
+			# The storage may move this file instead of reading it, so hash
+			# it on local disk before it does
+			content.seek(0)
+			content_hash = self.calculate_hash(content)
+			super().save(name, content, save=False)
+		else:
+			content = HashingFile(content, self.get_hasher)
+			super().save(name, content, save=False)
+			content_hash = content.hexdigest()
+		# When the hash is still None it is read back from storage on access
+		self._content_hash = content_hash
+		# FieldFile.save assigns the new name to the instance, which would
+		# lose the hash on the next access
+		setattr(self.instance, self.field.attname, self)
+
+		if save:
+			self.instance.save()
 
 
 class BinderFileDescriptor:
@@ -1064,6 +1144,10 @@ class BinderFileDescriptor:
 		instance.__dict__[self.field.name] = value
 
 
+# The file of a BinderFileField as stored in the database
+StoredFile = namedtuple('StoredFile', ['name', 'content_hash', 'content_type'])
+
+
 class BinderFileField(FileField):
 
 	attr_class = BinderFieldFile
@@ -1097,6 +1181,34 @@ class BinderFileField(FileField):
 			value.content_type or '',
 		))
 
+	def get_stored_file(self, instance):
+		"""
+		Returns the StoredFile of the instance, parsed directly from the value
+		loaded from the database, without constructing a BinderFieldFile. The
+		name is None when there is no file, the hash and content type are
+		None when they are not stored (like for files stored by a FileField).
+
+		Unlike accessing the field, this does not refresh a deferred field
+		from the database, but raises a ValueError.
+		"""
+		try:
+			value = instance.__dict__[self.attname]
+		except KeyError:
+			raise ValueError('{}.{} is deferred'.format(instance._meta.label, self.name))
+
+		if isinstance(value, BinderFieldFile):
+			return StoredFile(value.name or None, value._content_hash, value._content_type)
+		if isinstance(value, File):
+			return StoredFile(value.name or None, None, None)
+		if not value:
+			return StoredFile(None, None, None)
+
+		data = parse_tuple(value)
+		if len(data) != 3:
+			return StoredFile(value, None, None)
+		name, content_hash, content_type = data
+		return StoredFile(name or None, content_hash, content_type)
+
 	def deconstruct(self):
 		name, path, args, kwargs = super().deconstruct()
 
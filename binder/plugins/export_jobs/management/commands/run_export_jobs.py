@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from binder.plugins.export_jobs.worker import run_export_jobs
+
+class Command(BaseCommand):
+	help = _('Run queued background exports')
+
+	def add_arguments(self, parser):
+		parser.add_argument('--once', action='store_true', help='Exit when there are no more queued exports, instead of waiting for new ones')
+		parser.add_argument('-i', '--interval', type=float, default=5, help='Seconds to wait before checking for new exports (default 5)')
+
+
+	def handle(self, *args, **options):
+		while True:
+			count = run_export_jobs()
+			if count:
+				self.stdout.write(_("Ran %(count)d export(s).") % {'count': count})
+			if options['once']:
+				return
+			time.sleep(options['interval'])
@@ -0,0 +1,79 @@
+from django.db import models, transaction
+from django.db.models import Q
+from django.conf import settings
+from django.utils import timezone
+
+from binder.models import BinderModel, ChoiceEnum
+
+
+class ExportJobQuerySet(models.QuerySet):
+
+	def claimable(self, now=None):
+		"""
+		Filter on jobs a worker may start: queued jobs, and jobs which are
+		running for longer than BINDER_EXPORT_JOB_TIMEOUT (a timedelta), whose
+		worker presumably died.
+		"""
+		claimable = Q(status=ExportJob.STATUSES.QUEUED)
+
+		timeout = getattr(settings, 'BINDER_EXPORT_JOB_TIMEOUT', None)
+		if timeout is not None:
+			if now is None:
+				now = timezone.now()
+			claimable |= Q(status=ExportJob.STATUSES.RUNNING, started_at__lt=now - timeout)
+
+		return self.filter(claimable)
+
+	def claim(self):
+		"""
+		Mark the oldest claimable job as running, and return it. Returns None
+		when there is nothing to do. Jobs locked by other workers are skipped,
+		so several workers can run at the same time.
+		"""
+		with transaction.atomic():
+			job = (
+				self.claimable()
+				.select_for_update(skip_locked=True)
+				.order_by('created_at', 'pk')
+				.first()
+			)
+			if job is None:
+				return None
+
+			job.status = ExportJob.STATUSES.RUNNING
+			job.started_at = timezone.now()
+			job.finished_at = None
+			job.progress = 0
+			job.error = ''
+			job.save(update_fields=['status', 'started_at', 'finished_at', 'progress', 'error'])
+			return job
+
+
+class ExportJob(BinderModel):
+	"""
+	An export of a CsvExportView, which is run in the background by the
+	run_export_jobs command instead of in the request.
+
+	The job stores the path and query string of the download request, so the
+	worker can replay it for the user who requested it.
+	"""
+
+	STATUSES = ChoiceEnum('queued', 'running', 'done', 'failed')
+
+	user = models.ForeignKey(
+		settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+		related_name='export_jobs',
+	)
+	path = models.CharField(max_length=255)
+	params = models.TextField(blank=True)
+	status = STATUSES(default=STATUSES.QUEUED, db_index=True)
+	# The number of exported objects, out of total
+	progress = models.PositiveIntegerField(default=0)
+	total = models.PositiveIntegerField(blank=True, null=True)
+	file = models.FileField(upload_to='export_jobs/', blank=True, null=True)
+	error = models.TextField(blank=True)
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+	started_at = models.DateTimeField(blank=True, null=True)
+	finished_at = models.DateTimeField(blank=True, null=True)
+
+	objects = ExportJobQuerySet.as_manager()
@@ -0,0 +1,27 @@
+from django.db.models import Q
+
+from binder.permissions.views import PermissionView
+
+from .models import ExportJob
+
+
+class ExportJobView(PermissionView):
+	"""
+	Lists the background exports of a user. The exported file can be
+	downloaded from export_job/<id>/file/ when the job is done.
+	"""
+
+	model = ExportJob
+	file_fields = ['file']
+	unwritable_fields = [
+		'user', 'path', 'params', 'status', 'progress', 'total', 'error',
+		'created_at', 'started_at', 'finished_at',
+	]
+
+	def _scope_view_own(self, request):
+		return Q(user=request.user)
+
+	def _scope_delete_own(self, request, obj, values):
+		if not isinstance(obj, ExportJob):
+			obj = obj.get()
+		return obj.user == request.user
@@ -0,0 +1,116 @@
+import logging
+import re
+from tempfile import TemporaryFile
+from uuid import uuid4
+
+from django.core.files import File
+from django.http import HttpRequest, QueryDict
+from django.urls import resolve
+from django.utils import timezone
+
+from .models import ExportJob
+
+
+logger = logging.getLogger(__name__)
+
+FILE_NAME_RE = re.compile(r'filename="([^"]+)"')
+
+
+def enqueue_export(request):
+	"""
+	Create an export job for a download request, to be run later for the
+	same user. The background parameter is left out of the stored query.
+	"""
+	params = request.GET.copy()
+	params.pop('background', None)
+
+	return ExportJob.objects.create(
+		user=request.user,
+		path=request.path_info,
+		params=params.urlencode(),
+	)
+
+
+def get_export_request(job):
+	"""
+	Build the download request of a job, as if the user did it. Progress
+	is reported back to the job while the export runs.
+	"""
+	request = HttpRequest()
+	request.method = 'GET'
+	request.path = request.path_info = job.path
+	request.GET = QueryDict(job.params)
+	request.META = {
+		'REQUEST_METHOD': 'GET',
+		'SERVER_NAME': 'localhost',
+		'SERVER_PORT': '80',
+	}
+	request._body = b''
+	request.user = job.user
+	request.request_id = str(uuid4())
+
+	def progress(done, total):
+		ExportJob.objects.filter(pk=job.pk).update(progress=done, total=total)
+		job.progress, job.total = done, total
+	request._export_progress = progress
+
+	return request
+
+
+def run_export_job(job):
+	"""
+	Run the export of a claimed job, writing the file as it is generated and
+	saving it in the storage of ExportJob.file when done.
+	"""
+	request = get_export_request(job)
+
+	try:
+		match = resolve(job.path)
+		response = match.func(request, *match.args, **match.kwargs)
+
+		if response.status_code >= 400:
+			raise ValueError(response.content.decode(errors='replace'))
+
+		match = FILE_NAME_RE.search(response.get('Content-Disposition', ''))
+		file_name = match.group(1) if match else 'export'
+
+		with TemporaryFile() as tmp:
+			try:
+				for part in (response.streaming_content if response.streaming else [response.content]):
+					tmp.write(part)
+			finally:
+				# Not response.close(), which sends request_finished, and so
+				# closes the database connection
+				file_to_stream = getattr(response, 'file_to_stream', None)
+				if file_to_stream is not None:
+					file_to_stream.close()
+
+			tmp.seek(0)
+			if job.file:
+				job.file.delete(save=False)
+			job.file.save(file_name, File(tmp), save=False)
+	except Exception as e:
+		logger.exception('Export job {} failed'.format(job.pk))
+		job.status = ExportJob.STATUSES.FAILED
+		job.error = str(e)
+	else:
+		job.status = ExportJob.STATUSES.DONE
+
+	job.finished_at = timezone.now()
+	job.save()
+	return job
+
+
+def run_export_jobs(limit=None):
+	"""
+	Run claimable jobs until there are none left, or limit jobs were run.
+	Returns the number of jobs run.
+	"""
+	count = 0
+	while limit is None or count < limit:
+		job = ExportJob.objects.claim()
+		if job is None:
+			break
+		run_export_job(job)
+		count += 1
+	return count
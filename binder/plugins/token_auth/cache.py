@@ -0,0 +1,171 @@
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from .models import Token
+
+
+class TokenCache:
+	"""
+	Cache for tokens resolved by the TokenAuthMiddleware, so a token
+	authenticated request does not need to query the token and its user.
+
+	Tokens are kept in a small in-process LRU, optionally backed by a shared
+	Django cache. This is configured by the following settings:
+
+	BINDER_TOKEN_CACHE_TIMEOUT: number of seconds a resolved token may be
+	used from the cache. Defaults to 0, which disables caching.
+	BINDER_TOKEN_CACHE_BACKEND: alias of a Django cache to use as second
+	level cache. Defaults to None, which only uses the in-process cache.
+
+	Entries are invalidated when a token or its user is saved or deleted,
+	but not on queryset updates, which bypass signals.
+	"""
+
+	KEY_PREFIX = 'binder.token_auth.'
+
+	def __init__(self, max_size=1024):
+		self.max_size = max_size
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+
+	@property
+	def timeout(self):
+		return getattr(settings, 'BINDER_TOKEN_CACHE_TIMEOUT', 0)
+
+
+	@property
+	def backend(self):
+		alias = getattr(settings, 'BINDER_TOKEN_CACHE_BACKEND', None)
+		return None if alias is None else caches[alias]
+
+
+	def _key(self, token):
+		# Never use the token itself as key, it is a secret
+		return self.KEY_PREFIX + hashlib.sha256(token.encode()).hexdigest()
+
+
+	def _store_local(self, key, token, timeout):
+		with self._lock:
+			self._entries[key] = (time.monotonic() + timeout, token)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+
+
+	def _copy(self, token):
+		# Every request gets its own instances, so state set on the user
+		# during a request does not leak into other requests.
+		result = copy.copy(token)
+		result.user = copy.copy(token.user)
+		return result
+
+
+	def get(self, token):
+		"""
+		Return the cached Token (with its user) for the given token string,
+		or None if it is not cached.
+		"""
+		timeout = self.timeout
+		if not timeout:
+			return None
+
+		key = self._key(token)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				if entry[0] > time.monotonic():
+					self._entries.move_to_end(key)
+					return self._copy(entry[1])
+				del self._entries[key]
+
+		backend = self.backend
+		if backend is not None:
+			cached = backend.get(key)
+			if cached is not None:
+				self._store_local(key, cached, timeout)
+				return self._copy(cached)
+
+		return None
+
+
+	def set(self, token):
+		"""
+		Cache a resolved token. The token should have its user loaded.
+		"""
+		timeout = self.timeout
+		if not timeout:
+			return
+
+		key = self._key(token.token)
+		token = self._copy(token)
+		self._store_local(key, token, timeout)
+
+		backend = self.backend
+		if backend is not None:
+			backend.set(key, token, timeout)
+
+
+	def invalidate(self, *tokens):
+		keys = [self._key(token) for token in tokens]
+		with self._lock:
+			for key in keys:
+				self._entries.pop(key, None)
+
+		backend = self.backend
+		if backend is not None:
+			backend.delete_many(keys)
+
+
+	def invalidate_user(self, user_id):
+		with self._lock:
+			keys = [key for key, (_, token) in self._entries.items() if token.user_id == user_id]
+			for key in keys:
+				del self._entries[key]
+
+		# The shared cache can only be invalidated by key, so look up the
+		# tokens of the user.
+		if self.backend is not None:
+			self.invalidate(*Token.objects.filter(user_id=user_id).values_list('token', flat=True))
+
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+
+token_cache = TokenCache()
+
+
+def _invalidate_changed_token(sender, instance, **kwargs):
+	if not token_cache.timeout or instance.pk is None:
+		return
+	# The token string itself may be changed, in that case the entry is
+	# stored under the old value.
+	old = Token.objects.filter(pk=instance.pk).values_list('token', flat=True).first()
+	if old is not None:
+		token_cache.invalidate(old)
+
+
+def _invalidate_token(sender, instance, **kwargs):
+	if token_cache.timeout:
+		token_cache.invalidate(instance.token)
+
+
+def _invalidate_user(sender, instance, **kwargs):
+	if token_cache.timeout:
+		token_cache.invalidate_user(instance.pk)
+
+
+pre_save.connect(_invalidate_changed_token, sender=Token, dispatch_uid='binder_token_cache_pre_save')
+post_save.connect(_invalidate_token, sender=Token, dispatch_uid='binder_token_cache_post_save')
+post_delete.connect(_invalidate_token, sender=Token, dispatch_uid='binder_token_cache_post_delete')
+post_save.connect(_invalidate_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='binder_token_cache_user_post_save')
+post_delete.connect(_invalidate_user, sender=settings.AUTH_USER_MODEL, dispatch_uid='binder_token_cache_user_post_delete')
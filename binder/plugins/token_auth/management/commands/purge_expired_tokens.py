@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+
+from binder.plugins.token_auth.models import Token
+
+class Command(BaseCommand):
+	help = _('Delete all expired tokens')
+
+	def add_arguments(self, parser):
+		parser.add_argument('-b', '--batch-size', type=int, default=1000, help='Number of tokens to delete per transaction (default 1000)')
+
+
+	def handle(self, *args, **options):
+		count = Token.objects.purge_expired(batch_size=options['batch_size'])
+
+		self.stdout.write(_("Deleted %(count)d expired token(s).") % {'count': count})
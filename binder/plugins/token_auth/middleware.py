@@ -1,7 +1,10 @@
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.utils import timezone
 
 from binder.exceptions import BinderException
 from binder.plugins.token_auth.models import Token
+from binder.plugins.token_auth.cache import token_cache
 
 
 class BinderTokenNotFound(BinderException):
@@ -42,6 +45,12 @@ class BinderTokenExpired(BinderException):
 class TokenAuthMiddleware:
 	"""
 	Authenticate by tokens provided by the HTTP_AUTHORIZATION header.
+
+	Resolved tokens are cached when BINDER_TOKEN_CACHE_TIMEOUT is set (see
+	TokenCache). Updates of last_used_at are coalesced to at most one write
+	per BINDER_TOKEN_LAST_USED_INTERVAL (a timedelta, defaults to writing on
+	every request). Note that when BINDER_TOKEN_EXPIRE_BASE is last_used_at,
+	expiry is only as precise as this interval.
 	"""
 
 	def __init__(self, get_response):
@@ -67,6 +76,40 @@ class TokenAuthMiddleware:
 		token = auth[6:]
 		return token
 
+	def _get_token(self, token):
+		"""
+		Resolve the token string to a Token with its user loaded, or return
+		the token string when there is no such token.
+		"""
+		cached = token_cache.get(token)
+		if cached is not None:
+			return cached
+
+		try:
+			token = Token.objects.select_related('user').get(token=token)
+		except Token.DoesNotExist:
+			return token
+
+		token_cache.set(token)
+		return token
+
+	def _touch(self, token):
+		"""
+		Update last_used_at, unless it was already updated within the last
+		BINDER_TOKEN_LAST_USED_INTERVAL.
+		"""
+		interval = getattr(settings, 'BINDER_TOKEN_LAST_USED_INTERVAL', None)
+		now = timezone.now()
+
+		if interval and now - token.last_used_at < interval:
+			return
+
+		# Update instead of save, this skips the read-modify-write of all
+		# fields and does not trigger signals (which would clear the cache).
+		Token.objects.filter(pk=token.pk).update(last_used_at=now)
+		token.last_used_at = now
+		token_cache.set(token)
+
 	def __call__(self, request):
 		if not hasattr(request, 'user'):
 			request.user = AnonymousUser()
@@ -80,9 +123,8 @@ class TokenAuthMiddleware:
 		if token is None:
 			return self.get_response(request)
 
-		try:
-			token = Token.objects.get(token=token)
-		except Token.DoesNotExist:
+		token = self._get_token(token)
+		if not isinstance(token, Token):
 			# Token does not exist
 			# Raise and catch needed to provide location
 			try:
@@ -100,7 +142,7 @@ class TokenAuthMiddleware:
 				return exc.response(request)
 
 		request.user = token.user
-		token.save()  # Auto updates last_used_at
+		self._touch(token)
 
 		# CSRF not needed because the token already establishes that the
 		# request was not forged.
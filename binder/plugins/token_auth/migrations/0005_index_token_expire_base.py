@@ -0,0 +1,23 @@
+# Generated by Django 3.2 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('token_auth', '0004_double_token_length'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='token',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='token',
+            name='last_used_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
@@ -11,6 +11,39 @@ def generate_token():
 	return urandom(32).hex()
 
 
+class TokenQuerySet(models.QuerySet):
+
+	def expired(self, now=None):
+		"""
+		Filter on expired tokens. This is the SQL equivalent of Token.expired,
+		comparing the (indexed) expire base field against a constant.
+		"""
+		expire_time = getattr(settings, 'BINDER_TOKEN_EXPIRE_TIME', None)
+
+		if expire_time is None:
+			return self.none()
+
+		if now is None:
+			now = timezone.now()
+
+		return self.filter(**{settings.BINDER_TOKEN_EXPIRE_BASE + '__lt': now - expire_time})
+
+	def purge_expired(self, batch_size=1000, now=None):
+		"""
+		Delete expired tokens in batches of batch_size, so the table is not
+		locked for too long. Returns the number of deleted tokens.
+		"""
+		if now is None:
+			now = timezone.now()
+
+		deleted = 0
+		while True:
+			pks = list(self.expired(now).values_list('pk', flat=True)[:batch_size])
+			if not pks:
+				return deleted
+			deleted += self.model.objects.filter(pk__in=pks).delete()[1].get(self.model._meta.label, 0)
+
+
 class Token(BinderModel):
 	"""
 	A Token is a proof of authentication for a certain user.
@@ -21,6 +54,9 @@ class Token(BinderModel):
 	expire, if set to None a token can never expire.
 	BINDER_TOKEN_EXPIRE_BASE determines which field to look at for the time of
 	the expire calculation.
+
+	Expired tokens are deleted when they are used, or in bulk by
+	Token.objects.purge_expired() (see the purge_expired_tokens command).
 	"""
 
 	user = models.ForeignKey(
@@ -28,8 +64,11 @@ class Token(BinderModel):
 		related_name='tokens',
 	)
 	token = models.CharField(default=generate_token, unique=True, max_length=64)
-	created_at = models.DateTimeField(auto_now_add=True)
-	last_used_at = models.DateTimeField(auto_now=True)
+	# Indexed so expired tokens can be found efficiently
+	created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+	last_used_at = models.DateTimeField(auto_now=True, db_index=True)
+
+	objects = TokenQuerySet.as_manager()
 
 	@property
 	def expires_at(self):
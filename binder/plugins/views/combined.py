@@ -1,14 +1,17 @@
 from collections import namedtuple, defaultdict
+import base64
+import binascii
 import logging
 import re
 
+from django.core.exceptions import EmptyResultSet
 from django.db import connection
-from django.db.models import Value, F
+from django.db.models import Value, F, Q
 from django.conf import settings
 
 from ...decorators import view_logger, handle_exceptions, allowed_methods
-from ...json import JsonResponse
-from ...views import ModelView, annotate, split_par_aware, RelatedModel
+from ...json import JsonResponse, jsondumps, jsonloads
+from ...views import ModelView, annotate, split_par_aware, RelatedModel, get_multi_valued_aliases
 from ...exceptions import BinderRequestError
 
 
@@ -22,6 +25,118 @@ LIMIT_MAX = None
 FakeRequest = namedtuple('FakeRequest', ['GET'])
 CombinedOrderBy = namedtuple('CombinedOrderBy', ['fields', 'inverted', 'nulls_last'])
 
+# Q objects which are always true or false
+Q_TRUE = ~Q(pk__in=[])
+Q_FALSE = Q(pk__in=[])
+
+
+def encode_cursor(values):
+	return base64.urlsafe_b64encode(jsondumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, length):
+	try:
+		values = jsonloads(base64.urlsafe_b64decode(cursor.encode()))
+	except (binascii.Error, ValueError):
+		raise BinderRequestError(f'Invalid cursor: {{after={cursor}}}')
+	if not isinstance(values, list) or len(values) != length:
+		raise BinderRequestError(f'Cursor does not match the ordering: {{after={cursor}}}')
+	return values
+
+
+def _after_value(field, value, inverted, nulls_last):
+	"""
+	Returns Q objects for the rows of which field comes after value in
+	the ordering, and for the rows where it is equal to value.
+	"""
+	if nulls_last is None:
+		# Without an explicit option the database decides where the nulls
+		# go, Postgres sorts them as if they are larger than any value while
+		# MySQL sorts them as if they are smaller.
+		nulls_last = connection.features.nulls_order_largest != inverted
+
+	if value is None:
+		if nulls_last:
+			return Q_FALSE, Q(**{f'{field}__isnull': True})
+		return Q(**{f'{field}__isnull': False}), Q(**{f'{field}__isnull': True})
+
+	after = Q(**{f'{field}__lt' if inverted else f'{field}__gt': value})
+	if nulls_last:
+		after |= Q(**{f'{field}__isnull': True})
+	return after, Q(**{field: value})
+
+
+def _after_id(value, index, count, inverted):
+	"""
+	Like _after_value, for the combined id (id * count + index) of the
+	model with the given index, while still filtering on the plain id.
+	"""
+	if inverted:
+		# id * count + index < value
+		after = Q(id__lt=-((index - value) // count))
+	else:
+		# id * count + index > value
+		after = Q(id__gt=(value - index) // count)
+	if (value - index) % count == 0:
+		return after, Q(id=(value - index) // count)
+	return after, Q_FALSE
+
+
+def _after_constant(constant, value, inverted):
+	if constant == value:
+		return Q_FALSE, Q_TRUE
+	if (constant < value) == inverted:
+		return Q_TRUE, Q_FALSE
+	return Q_FALSE, Q_FALSE
+
+
+def keyset_filter(comparisons):
+	"""
+	Combine (after, equal) pairs of Q objects of every field in the
+	ordering into a filter on the rows after the cursor.
+	"""
+	result = Q_FALSE
+	equal_before = Q_TRUE
+	for after, equal in comparisons:
+		result |= equal_before & after
+		equal_before &= equal
+	return result
+
+
+def count_records(querysets, approximate=False):
+	"""
+	Count the records of all querysets with a single query. When
+	approximate is set, the estimate of the query planner is used instead
+	on PostgreSQL, which does not have to read all rows.
+	"""
+	queries = []
+	params = []
+	for queryset in querysets:
+		queryset = queryset.order_by().prefetch_related(None).values('pk')
+		compiler = queryset.query.get_compiler(using=queryset.db)
+		try:
+			query, subparams = compiler.as_sql()
+		except EmptyResultSet:
+			continue
+		queries.append(query)
+		params.extend(subparams)
+
+	if not queries:
+		return 0
+
+	if approximate and connection.vendor == 'postgresql':
+		with connection.cursor() as cursor:
+			cursor.execute('EXPLAIN (FORMAT JSON) ' + ' UNION ALL '.join(f'({query})' for query in queries), params)
+			plan = cursor.fetchone()[0]
+		# Depending on the driver, the plan is decoded already
+		if isinstance(plan, str):
+			plan = jsonloads(plan)
+		return plan[0]['Plan']['Plan Rows']
+
+	with connection.cursor() as cursor:
+		cursor.execute('SELECT ' + ' + '.join(f'(SELECT COUNT(*) FROM ({query}) AS count_{i})' for i, query in enumerate(queries)), params)
+		return cursor.fetchone()[0]
+
 
 @view_logger(logger)
 @handle_exceptions
@@ -108,16 +223,20 @@ def combined_view(request, router, names):
 		if 'search' in request.GET:
 			queryset = view.search(queryset, request.GET['search'], request)
 
+		# A scoping or search over a to many relation returns an object once
+		# for every related object it matches
+		if get_multi_valued_aliases(queryset):
+			queryset = queryset.distinct()
+
 		querysets[name] = queryset
 
 	# Meta
 	include_meta = request.GET.get('include_meta', 'total_records').split(',')
 	meta = {}
 	if 'total_records' in include_meta:
-		meta['total_records'] = sum(
-			queryset.prefetch_related(None).values('pk').count()
-			for queryset in querysets.values()
-		)
+		meta['total_records'] = count_records(querysets.values())
+	if 'approximate_total_records' in include_meta:
+		meta['approximate_total_records'] = count_records(querysets.values(), approximate=True)
 
 	# Parse pagination
 	limit = LIMIT_DEFAULT
@@ -179,21 +298,47 @@ def combined_view(request, router, names):
 
 		order_bys[i] = CombinedOrderBy(dict(zip(names, order_by)), inverted, nulls_last)
 
+	cursor_values = None
+	if 'after' in request.GET:
+		if offset != 0:
+			raise BinderRequestError('Offset can not be combined with a cursor.')
+		cursor_values = decode_cursor(request.GET['after'], len(order_bys))
+
+	# When ordering on id for all models, every model is ordered on its plain
+	# id, so the ordering can use the primary key index.
+	id_order_bys = {
+		j for j, order_by in enumerate(order_bys)
+		if all(field == 'id' for field in order_by.fields.values())
+	}
+
+	# Every model only has to supply the rows up to the end of the page
+	branch_limit = None
+	if limit is not None:
+		branch_limit = limit + offset
+
 	queries = []
 	params = []
 	for i, name in enumerate(names):
 		queryset = querysets[name]
 		suborder_bys = []
+		branch_order_bys = []
+		comparisons = []
 		id_expr = F('id') * Value(len(names)) + Value(i)
 
-		for order_by in order_bys:
+		for j, order_by in enumerate(order_bys):
 			field = order_by.fields[name]
+			if cursor_values is not None:
+				value = cursor_values[j]
 
 			if field == 'id':
-				suborder_by = id_expr
+				suborder_by = F('id') if j in id_order_bys else id_expr
+				if cursor_values is not None:
+					comparisons.append(_after_id(value, i, len(names), order_by.inverted))
 
 			elif field == 'model_index':
 				suborder_by = Value(i)
+				if cursor_values is not None:
+					comparisons.append(_after_constant(i, value, order_by.inverted))
 
 			else:
 				# So this is a bit of a hack, filtering on annotations is normally
@@ -208,26 +353,48 @@ def combined_view(request, router, names):
 				finally:
 					views[name].annotations = old_annotations
 				suborder_by = F(field)
+				if cursor_values is not None:
+					comparisons.append(_after_value(field, value, order_by.inverted, order_by.nulls_last))
 
 			suborder_bys.append(suborder_by)
+			if not isinstance(suborder_by, Value):
+				nulls = {True: {'nulls_last': True}, False: {'nulls_first': True}, None: {}}[order_by.nulls_last]
+				branch_order_bys.append(suborder_by.desc(**nulls) if order_by.inverted else suborder_by.asc(**nulls))
+
+		if cursor_values is not None:
+			queryset = queryset.filter(keyset_filter(comparisons))
 
 		queryset = queryset.values_list(
 			id_expr,
 			*suborder_bys,
 		)
+		if branch_limit is not None:
+			# Order and limit every model on its own, so the database only has
+			# to read the first rows of every model (using an index when
+			# available), instead of sorting all rows of all models.
+			queryset = queryset.order_by(*branch_order_bys)[:branch_limit]
+		else:
+			queryset = queryset.order_by()
 		compiler = queryset.query.get_compiler(using=queryset.db)
-		query, subparams = compiler.as_sql()
+		try:
+			query, subparams = compiler.as_sql()
+		except EmptyResultSet:
+			# No rows of this model can be on the page
+			continue
 		queries.append(query)
 		params.extend(subparams)
 
+	# The ids of the models never overlap and every branch is distinct, so
+	# UNION ALL gives the same result as UNION, without having to
+	# deduplicate all rows.
 	query = (
-		'SELECT combined.id ' +
-		'FROM (' + ' UNION '.join(f"({query})" for query in queries) + ') AS combined (id' + ''.join(f', ordering_{i}' for i in range(len(order_bys))) + ')' +
+		'SELECT combined.id' + ''.join(f', combined.ordering_{j}' for j in range(len(order_bys))) + ' ' +
+		'FROM (' + ' UNION ALL '.join(f"({query})" for query in queries) + ') AS combined (id' + ''.join(f', ordering_{j}' for j in range(len(order_bys))) + ')' +
 		(' ORDER BY ' + ', '.join(
-			f'combined.ordering_{i}' +
+			('combined.id' if j in id_order_bys else f'combined.ordering_{j}') +
 			{True: ' DESC', False: ' ASC'}[order_by.inverted] +
 			{True: ' NULLS LAST', False: ' NULLS FIRST', None: ''}[order_by.nulls_last]
-			for i, order_by in enumerate(order_bys)
+			for j, order_by in enumerate(order_bys)
 		) if order_bys else '')
 	)
 	if limit is not None:
@@ -238,9 +405,24 @@ def combined_view(request, router, names):
 		params.append(offset)
 	params = tuple(params)
 
-	with connection.cursor() as cursor:
-		cursor.execute(query, params)
-		objs = cursor.fetchall()
+	if queries:
+		with connection.cursor() as cursor:
+			cursor.execute(query, params)
+			rows = cursor.fetchall()
+	else:
+		rows = []
+	objs = [row[:1] for row in rows]
+
+	if cursor_values is not None or 'next_cursor' in include_meta:
+		# The cursor of the last row, when there may be more rows
+		if rows and limit is not None and len(rows) == limit:
+			pk, *ordering = rows[-1]
+			meta['next_cursor'] = encode_cursor([
+				pk if j in id_order_bys else value
+				for j, value in enumerate(ordering)
+			])
+		else:
+			meta['next_cursor'] = None
 
 	# Get base data
 	data = []
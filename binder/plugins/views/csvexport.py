@@ -1,11 +1,12 @@
 import abc
 import csv
 from tempfile import NamedTemporaryFile
-from typing import List
+from typing import Iterable, List
 
-from django.http import HttpResponse, HttpRequest
+from django.http import HttpResponse, HttpRequest, StreamingHttpResponse, FileResponse
 
-from binder.json import jsonloads
+from binder.exceptions import BinderRequestError
+from binder.json import jsonloads, jsondumps, JsonResponse
 from binder.router import list_route
 
 
@@ -64,6 +65,32 @@ class ExportFileAdapter:
 		pass
 
 
+	def get_streaming_response(self, columns: List[str], rows: Iterable[List[str]]) -> HttpResponse:
+		"""
+		Return a http response with the columns and all rows, where rows is a
+		(lazy) iterable. Adapters which can write the file while it is being
+		sent override this, by default all rows are added first.
+
+		:param columns:
+		:param rows:
+		:return:
+		"""
+		self.set_columns(columns)
+		for row in rows:
+			self.add_row(row)
+		return self.get_response()
+
+
+class _Echo:
+	"""
+	File-like object that returns what is written, so csv.writer can be used
+	to generate lines.
+	"""
+
+	def write(self, value):
+		return value
+
+
 class CsvFileAdapter(ExportFileAdapter):
 	"""
 	Adapter for returning CSV files
@@ -88,6 +115,18 @@ class CsvFileAdapter(ExportFileAdapter):
 		self.response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(self.file_name)
 		return self.response
 
+	def get_streaming_response(self, columns: List[str], rows: Iterable[List[str]]) -> HttpResponse:
+		writer = csv.writer(_Echo())
+
+		def lines():
+			yield writer.writerow(columns)
+			for row in rows:
+				yield writer.writerow(row)
+
+		response = StreamingHttpResponse(lines(), content_type='text/csv')
+		response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(self.file_name)
+		return response
+
 
 class ExcelFileAdapter(ExportFileAdapter):
 	"""
@@ -102,11 +141,10 @@ class ExcelFileAdapter(ExportFileAdapter):
 		self.file_name = 'export'
 		# self.writer = self.pandas.ExcelWriter(self.response)
 
-		self.work_book = self.openpyxl.Workbook()
-		self.sheet = self.work_book.active
-
-		# The row number we are currently writing to
-		self._row_number = 0
+		# A write-only workbook writes rows to a temporary file as they are
+		# added, instead of keeping all cells in memory
+		self.work_book = self.openpyxl.Workbook(write_only=True)
+		self.sheet = self.work_book.create_sheet()
 
 	def set_file_name(self, file_name: str):
 		self.file_name = file_name
@@ -115,9 +153,7 @@ class ExcelFileAdapter(ExportFileAdapter):
 		self.add_row(columns)
 
 	def add_row(self, values: List[str]):
-		for (column_id, value) in enumerate(values):
-			self.sheet.cell(column=column_id + 1, row=self._row_number + 1, value=value)
-		self._row_number += 1
+		self.sheet.append(values)
 
 	def get_response(self) -> HttpResponse:
 		with NamedTemporaryFile() as tmp:
@@ -129,6 +165,23 @@ class ExcelFileAdapter(ExportFileAdapter):
 			self.response['Content-Disposition'] = 'attachment; filename="{}.xlsx"'.format(self.file_name)
 			return self.response
 
+	def get_streaming_response(self, columns: List[str], rows: Iterable[List[str]]) -> HttpResponse:
+		# A xlsx file is a zip file, which can only be written when all
+		# rows are known. So write all rows, and stream the file afterwards.
+		self.set_columns(columns)
+		for row in rows:
+			self.add_row(row)
+
+		tmp = NamedTemporaryFile(suffix='.xlsx')
+		self.work_book.save(tmp.name)
+		# The file is deleted when the response closes it
+		response = FileResponse(
+			tmp,
+			content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+		)
+		response['Content-Disposition'] = 'attachment; filename="{}.xlsx"'.format(self.file_name)
+		return response
+
 DEFAULT_RESPONSE_TYPE_MAPPING = {
 	'xlsx': ExcelFileAdapter,
 }
@@ -162,6 +215,9 @@ class RequestAwareAdapter(ExportFileAdapter):
 	def get_response(self) -> HttpResponse:
 		return self.base_adapter.get_response()
 
+	def get_streaming_response(self, columns: List[str], rows: Iterable[List[str]]) -> HttpResponse:
+		return self.base_adapter.get_streaming_response(columns, rows)
+
 
 
 
@@ -182,7 +238,8 @@ class CsvExportView:
 		"""
 
 		def __init__(self, withs, column_map, file_name=None, default_file_name='download', multi_value_delimiter=' ',
-					extra_permission=None, extra_params={}, csv_adapter=RequestAwareAdapter, limit=10000):
+					extra_permission=None, extra_params={}, csv_adapter=RequestAwareAdapter, limit=10000,
+					streaming=False, chunk_size=1000, background=False):
 			"""
 			@param withs: String[]  An array of all the withs that are necessary for this csv export
 			@param column_map: Tuple[] An array, with all columns of the csv file in order. Each column is represented by a tuple
@@ -197,6 +254,12 @@ class CsvExportView:
 			@param response_type_mapping: Mapping between the parameter used in the custom response type
 			@param limit: Limit for amount of items in the csv. This is a fail save that you do not bring down the server with
 			a big query
+			@param streaming: Boolean When set, the objects are fetched and written to the file in chunks, instead of all at
+			once through a get request. This uses constant memory, so the limit can be set to None. Note that a callable
+			file_name only gets the first chunk of data.
+			@param chunk_size: Int The number of objects per chunk when streaming
+			@param background: Boolean When set, download/?background=true queues the export as a job, which is run by
+			the run_export_jobs command of binder.plugins.export_jobs. The export is always streamed to a file then.
 			"""
 			self.withs = withs
 			self.column_map = column_map
@@ -207,10 +270,12 @@ class CsvExportView:
 			self.extra_params = extra_params
 			self.csv_adapter = csv_adapter
 			self.limit = limit
+			self.streaming = streaming
+			self.chunk_size = chunk_size
+			self.background = background
 
 
-	def _generate_csv_file(self, request: HttpRequest, file_adapter: CsvFileAdapter):
-
+	def _prepare_export_request(self, request: HttpRequest):
 		# Sometimes we want to add an extra permission check before a csv file can be downloaded. This checks if the
 		# permission is set, and if the permission is set, checks if the current user has the specified permission
 		if self.csv_settings.extra_permission is not None:
@@ -226,18 +291,21 @@ class CsvExportView:
 			request.GET[key] = value
 		request.GET._mutable = mutable
 
-		parent_result = self.get(request)
-		parent_data = jsonloads(parent_result.content)
 
+	def _get_file_name(self, parent_data):
 		file_name = self.csv_settings.file_name
 		if callable(file_name):
 			file_name = file_name(parent_data)
 		if file_name is None:
 			file_name = self.csv_settings.default_file_name
-		file_adapter.set_file_name(file_name)
+		return file_name
 
-		# CSV header
-		file_adapter.set_columns(list(map(lambda x: x[1], self.csv_settings.column_map)))
+
+	def _get_rows(self, parent_data):
+		"""
+		Generates the rows of the file for the data in parent_data, which is a
+		get() response (or a chunk of it when streaming).
+		"""
 
 		# Make a mapping from the withs. This creates a map. This is needed for easy looking up relations
 		# {
@@ -253,66 +321,218 @@ class CsvExportView:
 			for row in parent_data['with'][key]:
 				key_mapping[key][row['id']] = row
 
-		def get_datum(data, key, prefix=''):
-			"""
-			Recursively gets the correct data point from the dataset
-
-			@param data: Dict At the first call this is the 'data' value in the response. In the recursion, we go deeper
-			in the dict, and we get part of the original dict. However, when we go through a with, we may end up in the
-			data from one of the key mappings.
-			@param key: String The key of the value we try to find. The level of the dictionary where we need to find
-			the data are delimited by a .
-			@return: Any: The data point present at key
-			"""
+		# Compile the columns once, instead of parsing the keys for every cell
+		columns = [
+			self._compile_column(col_definition, parent_data['with_mapping'], key_mapping)
+			for col_definition in self.csv_settings.column_map
+		]
+
+		for row in parent_data['data']:
+			yield [column(row) for column in columns]
 
-			# Add the deepest level we can just get the specified key
-			if '.' not in key:
+
+	def _compile_accessor(self, key, with_mapping, key_mapping, prefix=''):
+		"""
+		Compiles the key of a column into a function which gets the correct data point from a row.
+
+		@param key: String The key of the value we try to find. The level of the dictionary where we need to find
+		the data are delimited by a .
+		@param with_mapping: Dict The with_mapping of the data, mapping relation paths to with names
+		@param key_mapping: Dict Mapping of with names to the related models by id
+		@param prefix: String The path of relations we already followed
+		@return: Callable: Function getting the data point present at key from a row
+		"""
+
+		# Add the deepest level we can just get the specified key
+		if '.' not in key:
+			def get_datum(data):
 				if key not in data:
 					raise Exception("{} not found in data: {}".format(key, data))
 				return data[key]
-			else:
-				"""
-				If we we are not at the deepest level, there are two possibilities:
-
-				- We want to go into an dict. This can be because the model has a json encoded dicts as a value, or because
-				the array is created by custom logic
-				- We want to follow a relation. In this case we either have a integer (in case of a X-to-one relation) or a
-				list of integers (in case of a X-to-many) relation. In this case, we reconstruct the whole path into the data
-				(We use the prefix for this). This is then mapped to the correct related model(s), and we go recursively
-				deeper in this models.
-				"""
-				head_key, subkey = key.split('.', 1)
-				if head_key in data:
-					new_prefix = '{}.{}'.format(prefix, head_key)
-					if isinstance(data[head_key], dict):
-						return get_datum(data[head_key], subkey, new_prefix)
-					else:
-						# Assume that we have a mapping now
-						fk_ids = data[head_key]
-						if not isinstance(fk_ids, list):
-							fk_ids = [fk_ids]
-
-						# if head_key not in key_mapping:
-						prefix_key = parent_data['with_mapping'][new_prefix[1:]]
-						datums = [str(get_datum(key_mapping[prefix_key][fk_id], subkey, new_prefix)) for fk_id in fk_ids]
-						return self.csv_settings.multi_value_delimiter.join(
-							datums
-						)
-
-				else:
-					raise Exception("{} not found in {}".format(head_key, data))
+			return get_datum
 
-		for row in parent_data['data']:
-			data = []
-			for col_definition in self.csv_settings.column_map:
-				datum = get_datum(row, col_definition[0])
-				if len(col_definition) >= 3:
-					transform_function = col_definition[2]
-					datum = transform_function(datum, row, key_mapping)
-				if isinstance(datum, list):
-					datum = self.csv_settings.multi_value_delimiter.join(datum)
-				data.append(datum)
-			file_adapter.add_row(data)
+		"""
+		If we we are not at the deepest level, there are two possibilities:
+
+		- We want to go into an dict. This can be because the model has a json encoded dicts as a value, or because
+		the array is created by custom logic
+		- We want to follow a relation. In this case we either have a integer (in case of a X-to-one relation) or a
+		list of integers (in case of a X-to-many) relation. In this case, we reconstruct the whole path into the data
+		(We use the prefix for this). This is then mapped to the correct related model(s), and we go deeper in this
+		models.
+
+		Which of these applies depends on the value, but the path is known beforehand, so the lookup of the related
+		models is done only once.
+		"""
+		head_key, subkey = key.split('.', 1)
+		new_prefix = '{}.{}'.format(prefix, head_key)
+		get_subdatum = self._compile_accessor(subkey, with_mapping, key_mapping, new_prefix)
+		related = key_mapping.get(with_mapping.get(new_prefix[1:]))
+		delimiter = self.csv_settings.multi_value_delimiter
+
+		def get_datum(data):
+			if head_key not in data:
+				raise Exception("{} not found in {}".format(head_key, data))
+
+			value = data[head_key]
+			if isinstance(value, dict):
+				return get_subdatum(value)
+
+			# Assume that we have a mapping now
+			if related is None:
+				raise KeyError(new_prefix[1:])
+			if not isinstance(value, list):
+				return str(get_subdatum(related[value]))
+			return delimiter.join([str(get_subdatum(related[fk_id])) for fk_id in value])
+
+		return get_datum
+
+
+	def _compile_column(self, col_definition, with_mapping, key_mapping):
+		"""
+		Compiles a column definition (key, title) or (key, title, callback) into a function getting the value of the
+		cell from a row.
+		"""
+		get_datum = self._compile_accessor(col_definition[0], with_mapping, key_mapping)
+		transform_function = col_definition[2] if len(col_definition) >= 3 else None
+		delimiter = self.csv_settings.multi_value_delimiter
+
+		def column(row):
+			datum = get_datum(row)
+			if transform_function is not None:
+				datum = transform_function(datum, row, key_mapping)
+			if isinstance(datum, list):
+				datum = delimiter.join(datum)
+			return datum
+
+		return column
+
+
+	def _generate_csv_file(self, request: HttpRequest, file_adapter: CsvFileAdapter):
+		self._prepare_export_request(request)
+
+		parent_result = self.get(request)
+		parent_data = jsonloads(parent_result.content)
+
+		file_adapter.set_file_name(self._get_file_name(parent_data))
+
+		# CSV header
+		file_adapter.set_columns(list(map(lambda x: x[1], self.csv_settings.column_map)))
+
+		for row in self._get_rows(parent_data):
+			file_adapter.add_row(row)
+
+
+	def _get_export_chunks(self, request: HttpRequest):
+		"""
+		Generates the data to export in chunks of csv_settings.chunk_size
+		objects. Every chunk has the same form as a get() response, with the
+		withs of the objects in the chunk.
+
+		Only the ids of the filtered queryset are fetched up front, every chunk
+		of objects is fetched with its own query. The chunks after the first
+		are generated while the response is streamed, after the transaction
+		of the view has ended, so no cursor may be kept open between chunks.
+		Note that this means the memory use still grows with the number of
+		exported objects, by one id per object; only the serialized objects
+		and their withs are limited to a single chunk.
+
+		When the request has an _export_progress callback (see
+		binder.plugins.export_jobs), it is called with the number of exported
+		objects and the total after every chunk.
+		"""
+		include_annotations = self._parse_include_annotations(request)
+		queryset, annotations = self._get_filtered_queryset_base(request, None, include_annotations)
+		queryset = self._order_by_base(queryset, request, annotations)
+
+		pks = queryset.values_list('pk', flat=True)
+		if self.csv_settings.limit is not None:
+			pks = pks[:self.csv_settings.limit]
+
+		pks = list(pks)
+
+		progress = getattr(request, '_export_progress', None)
+		if progress is not None:
+			total = len(pks)
+			done = 0
+			progress(done, total)
+
+		for start in range(0, len(pks), self.csv_settings.chunk_size):
+			chunk = pks[start:start + self.csv_settings.chunk_size]
+
+			# The chunk is in order, and so are the objects within the chunk
+			data = self._get_objs(
+				queryset.filter(pk__in=chunk),
+				request=request,
+				annotations=include_annotations.get(''),
+				to_annotate=annotations,
+			)
+
+			withs, with_mapping, with_related_name_mapping, field_results = self._get_withs(
+				{obj['id'] for obj in data}, None, request=request, include_annotations=include_annotations,
+			)
+			for obj in data:
+				self._annotate_obj_with_related_withs(obj, field_results)
+
+			# Round trip through JSON, so the values (and what the column
+			# callbacks get) are exactly the same as without streaming: dates,
+			# decimals and uuids become strings, and so do integer dict keys.
+			# This only serializes a single chunk, which is cheap compared to
+			# the queries for it.
+			yield jsonloads(jsondumps({
+				'data': data,
+				'with': withs,
+				'with_mapping': with_mapping,
+				'with_related_name_mapping': with_related_name_mapping,
+			}))
+
+			if progress is not None:
+				done += len(chunk)
+				progress(done, total)
+
+
+	def _generate_streaming_response(self, request: HttpRequest, file_adapter: CsvFileAdapter):
+		self._prepare_export_request(request)
+
+		chunks = self._get_export_chunks(request)
+		# Get the first chunk before the response is returned, so errors
+		# still result in an error response
+		first_chunk = next(chunks, {'data': [], 'with': {}, 'with_mapping': {}, 'with_related_name_mapping': {}})
+
+		file_adapter.set_file_name(self._get_file_name(first_chunk))
+
+		def rows():
+			for row in self._get_rows(first_chunk):
+				yield row
+			for chunk in chunks:
+				for row in self._get_rows(chunk):
+					yield row
+
+		return file_adapter.get_streaming_response(
+			list(map(lambda x: x[1], self.csv_settings.column_map)),
+			rows(),
+		)
+
+	def _enqueue_export(self, request: HttpRequest):
+		if not self.csv_settings.background:
+			raise BinderRequestError('Background exports are not enabled for {}.'.format(self.model.__name__))
+
+		# Check the permissions and the filters now, instead of only failing
+		# when the job is run
+		if self.csv_settings.extra_permission is not None:
+			self._require_model_perm(self.csv_settings.extra_permission, request)
+		self._get_filtered_queryset_base(request, None, self._parse_include_annotations(request))
+
+		# Imported here, so the export_jobs app is only needed when used
+		from binder.plugins.export_jobs.worker import enqueue_export
+		job = enqueue_export(request)
+
+		return JsonResponse({
+			'id': job.pk,
+			'status': job.status,
+			'progress': job.progress,
+			'total': job.total,
+		})
 
 	@list_route(name='download', methods=['GET'])
 	def download(self, request):
@@ -325,8 +545,15 @@ class CsvExportView:
 		if self.csv_settings is None:
 			raise Exception('No csv settings set!')
 
+		if request.GET.get('background') == 'true':
+			return self._enqueue_export(request)
+
 		file_adapter = self.csv_settings.csv_adapter(request)
 
+		# Background exports are always streamed to the file
+		if self.csv_settings.streaming or hasattr(request, '_export_progress'):
+			return self._generate_streaming_response(request, file_adapter)
+
 		self._generate_csv_file(request, file_adapter)
 
 		return file_adapter.get_response()
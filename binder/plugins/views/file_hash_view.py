@@ -1,12 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
 from hashlib import md5
 from os.path import getmtime
 from mimetypes import guess_type
 
+from django.conf import settings
+
 from binder.json import jsonloads, JsonResponse
 from binder.exceptions import BinderNotFound
 from binder.models import BinderFileField
 
 
+class FileHashCache:
+    """
+    Cache of the hashes of the modification times of files, so listing the
+    same files again does not stat them again. A hash may be used for
+    BINDER_FILE_HASH_CACHE_TIMEOUT seconds (default 5, 0 disables caching),
+    so a file which is changed outside of the view may keep its old hash
+    that long.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'BINDER_FILE_HASH_CACHE_TIMEOUT', 5)
+
+    def get_hash(self, path):
+        """
+        Returns the hash of the modification time of the file, or None when
+        it does not exist.
+        """
+        timeout = self.timeout
+        if timeout:
+            with self._lock:
+                entry = self._entries.get(path)
+                if entry is not None:
+                    if entry[0] > time.monotonic():
+                        return entry[1]
+                    del self._entries[path]
+
+        try:
+            url_hash = md5(str(getmtime(path)).encode()).hexdigest()
+        except OSError:
+            url_hash = None
+
+        if timeout:
+            with self._lock:
+                self._entries[path] = (time.monotonic() + timeout, url_hash)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return url_hash
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+file_hash_cache = FileHashCache()
+
+
 class FileHashView:
     """
     DEPRECATED: Use BinderFileField instead.
@@ -38,12 +100,12 @@ class FileHashView:
         if field in file_hash_fields:
             try:
                 path = field_file.path
-                mtime = getmtime(path)
             except Exception:
                 pass
             else:
-                url_hash = md5(str(mtime).encode()).hexdigest()
-                params.append('h=' + url_hash)
+                url_hash = file_hash_cache.get_hash(path)
+                if url_hash is not None:
+                    params.append('h=' + url_hash)
 
         if field in file_type_fields:
             if field_file.name:
@@ -55,27 +117,19 @@ class FileHashView:
         else:
             return '?' + '&'.join(params)
 
-    def _get_objs(self, queryset, *args, **kwargs):
-        params = {
-            obj.pk: {
-                field: self._get_params(obj, field)
-                for field in self.file_fields
-                # BinderFileField handles this by default
-                if not isinstance(obj._meta.get_field(field), BinderFileField)
-            }
-            for obj in queryset
-        }
+    def _annotate_objs(self, datas_by_id, objs_by_id):
+        super()._annotate_objs(datas_by_id, objs_by_id)
 
-        data = super()._get_objs(queryset, *args, **kwargs)
-
-        for obj in data:
-            obj.update({
-                field: obj[field] + field_params
-                for field, field_params in params[obj['id']].items()
-                if obj[field] is not None
-            })
-
-        return data
+        # Use the objects fetched by _get_objs, instead of fetching them again
+        fields = [
+            field for field in self.file_fields
+            # BinderFileField handles this by default
+            if not isinstance(self.model._meta.get_field(field), BinderFileField)
+        ]
+        for pk, data in datas_by_id.items():
+            for field in fields:
+                if data.get(field) is not None:
+                    data[field] += self._get_params(objs_by_id[pk], field)
 
     def dispatch_file_field(self, request, pk=None, file_field=None):
         if isinstance(pk, self.model):
@@ -86,12 +140,24 @@ class FileHashView:
             except self.model.DoesNotExist:
                 raise BinderNotFound()
 
+        if request.method in ('POST', 'DELETE'):
+            self._invalidate_file_hash(obj, file_field)
+
         res = super().dispatch_file_field(request, obj, file_field)
 
         if request.method == 'POST':
+            self._invalidate_file_hash(obj, file_field)
             data = jsonloads(res.content)
             field = next(iter(data['data']))
             data['data'][field] += self._get_params(obj, field)
             return JsonResponse(data)
 
         return res
+
+    def _invalidate_file_hash(self, obj, field):
+        try:
+            path = getattr(obj, field).path
+        except Exception:
+            pass
+        else:
+            file_hash_cache.invalidate(path)
@@ -1,12 +1,13 @@
-from PIL import Image
 from abc import ABCMeta
 
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.core.exceptions import ValidationError
 from django.utils.translation import gettext as _
 from django import forms
 
+from binder import image_operations
 from binder.json import jsonloads, JsonResponse
 from binder.exceptions import BinderValidationError
+from binder.models import BinderFieldFile
 from binder.router import list_route
 from binder.permissions.views import PermissionView
 
@@ -46,6 +47,11 @@ class ImageView:
 
 	image_name = 'file'
 	image_backup_name = 'original_file'
+	# The max number of processes which transform images at the same time
+	image_workers = 4
+	# The multiprocessing start method of these processes, None for
+	# image_operations.DEFAULT_START_METHOD (forkserver, or spawn)
+	image_worker_start_method = None
 
 	def _get_file(self, imageObject):
 		''' Get the image file from the imageObject '''
@@ -66,12 +72,8 @@ class ImageView:
 
 		angle = body['angle']
 
-		for s in self._get_images(body, request):
-			file = self._get_file(s)
-			src_im = Image.open(file)
-			rotated_img = src_im.rotate(angle, expand=1)
-			rotated_img.save(file.file.name, overwrite=True)
-			file.close()
+		images = self._get_images(body, request)
+		self._transform_images(images, image_operations.rotate, lambda image: (angle,))
 		return JsonResponse([])
 
 	@list_route(name='crop', methods='PATCH')
@@ -87,13 +89,8 @@ class ImageView:
 		y_1 = body['y_1']
 		y_2 = body['y_2']
 
-		for s in self._get_images(body, request):
-			file = self._get_file(s)
-			src_im = Image.open(file)
-			rotated_img = src_im.crop((x_1, y_1, x_2, y_2))
-			rotated_img.save(file.file.name, overwrite=True)
-			file.close()
-
+		images = self._get_images(body, request)
+		self._transform_images(images, image_operations.crop, lambda image: ((x_1, y_1, x_2, y_2),))
 		return JsonResponse([])
 
 	@list_route(name='reset', methods='PATCH')
@@ -104,31 +101,59 @@ class ImageView:
 		# if not form.is_valid():
 		# 	raise BinderValidationError(form.errors)
 
-		for s in self._get_images(body, request):
-			file = self._get_file(s)
-			original_file = self._get_backup_file(s)
-			src_im = Image.open(original_file)
-			src_im.save(file.file.name, overwrite=True)
-			file.file.close()
-			original_file.file.close()
-
+		images = self._get_images(body, request)
+		self._transform_images(images, image_operations.reset, lambda image: (self._get_backup_file(image).path,))
 		return JsonResponse([])
 
-	def _get_images(self, body, request):
+	def _transform_images(self, images, operation, get_args):
 		'''
-		Get all the scans defined in the body's ids paramater, or retruns a validation error if one of the objects
-		does not exist
+		Run an operation of binder.image_operations on the file of every image,
+		in at most image_workers processes. get_args returns the extra arguments
+		of the operation for an image. The new content hashes of BinderFileFields
+		are stored afterwards, so their urls change.
 		'''
-		ids = body['ids']
+		tasks = []
+		for image in images:
+			file = self._get_file(image)
+			hash_name = file.get_hasher().name if isinstance(file, BinderFieldFile) else None
+			tasks.append((operation, (file.path, hash_name) + get_args(image)))
+
+		hashes = image_operations.run(tasks, self.image_workers, self.image_worker_start_method)
+
+		changed = []
+		for image, content_hash in zip(images, hashes):
+			if content_hash is not None:
+				self._get_file(image)._content_hash = content_hash
+				changed.append(image)
+		if changed:
+			# Note that bulk_update does not send post_save, so handlers of it
+			# (like the invalidation of cached and materialized stats) do not
+			# run for the new hashes
+			self.model.objects.bulk_update(changed, [self.image_name])
 
-		scans = []
-		for i in ids:
+	def _get_images(self, body, request):
+		'''
+		Get all the scans defined in the body's ids paramater, or retruns a validation error if some of the objects
+		do not exist
+		'''
+		pk_field = self.model._meta.pk
+		ids = []
+		missing = []
+		for i in body['ids']:
 			try:
-				scans.append(self.model.objects.get(pk=i))
-			except ObjectDoesNotExist:
-				raise BinderValidationError({
-					'ids': ['ImageObject with id {} not found'.format(i)]
-				})
+				ids.append(pk_field.to_python(i))
+			except ValidationError:
+				missing.append(i)
+
+		objects = self.model.objects.in_bulk(ids)
+		missing.extend(i for i in ids if i not in objects)
+		if missing:
+			raise BinderValidationError({
+				'ids': ['ImageObject with id {} not found'.format(i) for i in missing]
+			})
+
+		# Every image only once, they must not be transformed concurrently
+		scans = [objects[i] for i in dict.fromkeys(ids)]
 
 		if isinstance(self, PermissionView):
 			self.scope_change_list(request, scans, {})
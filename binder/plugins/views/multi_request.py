@@ -1,8 +1,13 @@
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from django.http import HttpRequest, JsonResponse
-from django.db import transaction
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.db import transaction, connections
 from django.core.handlers.base import BaseHandler
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 from binder.exceptions import (
 	BinderException, BinderRequestError, BinderMethodNotAllowed,
@@ -16,6 +21,30 @@ class RequestHandler(BaseHandler):
 		self.load_middleware()
 
 
+_handler = None
+_handler_lock = threading.Lock()
+
+
+def get_handler():
+	"""
+	Returns the RequestHandler for this process. Loading the middleware
+	instantiates every middleware, so this is only done once.
+	"""
+	global _handler
+	with _handler_lock:
+		if _handler is None:
+			_handler = RequestHandler()
+		return _handler
+
+
+@receiver(setting_changed)
+def _reset_handler(setting, **kwargs):
+	global _handler
+	if setting == 'MIDDLEWARE':
+		with _handler_lock:
+			_handler = None
+
+
 class ErrorStatus(Exception):
 
 	def __init__(self, status):
@@ -46,31 +75,25 @@ def multi_request_view(request):
 			e.log()
 			return e.response(request)
 
-	handler = RequestHandler()
+	handler = get_handler()
+	workers = getattr(settings, 'BINDER_MULTI_REQUEST_WORKERS', 1)
+
+	if (
+		request.method == 'GET' and workers > 1 and
+		all(isinstance(data, dict) for data in requests)
+	):
+		responses, status = run_parallel(handler, requests, request, workers)
+		return encode_responses(responses, status)
 
 	try:
 		with transaction.atomic():
 			for i, data in enumerate(requests):
 				key = data.pop('key', i)
 
-				# Get response from request
-				try:
-					req = parse_request(
-						data, allowed_methods, key_responses, request,
-					)
-				except BinderException as e:
-					e.log()
-					res = e.response(request)
-				else:
-					# There's a "sneaky little hack" in Django test client
-					# to avoid csrf checks in tests. This needs to be passed
-					# down to make sure tests for multi request are also skipping
-					# csrf checks. See also: https://github.com/django/django/blob/ebb08d19424c314c75908bc6048ff57c2f872269/django/test/client.py#L142
-					req._dont_enforce_csrf_checks = request._dont_enforce_csrf_checks
-					res = handler.get_response(req)
+				res = get_response(handler, data, allowed_methods, key_responses, request)
 
 				# Serialize and add to responses
-				res_data = serialize_response(res)
+				res_data = SubResponse(res)
 				responses.append(res_data)
 
 				# Add by key so that we can reference it in other requests
@@ -84,7 +107,126 @@ def multi_request_view(request):
 	else:
 		status = 200
 
-	return JsonResponse(responses, safe=False, status=status)
+	return encode_responses(responses, status)
+
+
+def get_response(handler, data, allowed_methods, responses, request):
+	try:
+		req = parse_request(
+			data, allowed_methods, responses, request,
+		)
+	except BinderException as e:
+		e.log()
+		return e.response(request)
+
+	# There's a "sneaky little hack" in Django test client
+	# to avoid csrf checks in tests. This needs to be passed
+	# down to make sure tests for multi request are also skipping
+	# csrf checks. See also: https://github.com/django/django/blob/ebb08d19424c314c75908bc6048ff57c2f872269/django/test/client.py#L142
+	req._dont_enforce_csrf_checks = request._dont_enforce_csrf_checks
+	return handler.get_response(req)
+
+
+def get_dependencies(keys, requests):
+	"""
+	Determine for every request which earlier requests it refers to in its
+	transforms, as a dict mapping the key to the index of the request. Like
+	in sequential execution, a key refers to the last earlier request with
+	that key.
+	"""
+	dependencies = []
+	indices = {}
+
+	for i, (key, data) in enumerate(zip(keys, requests)):
+		deps = {}
+		transforms = data.get('transforms') if isinstance(data, dict) else None
+		for transform in transforms if isinstance(transforms, list) else []:
+			source = transform.get('source') if isinstance(transform, dict) else None
+			if not isinstance(source, list) or not source:
+				continue
+			try:
+				if source[0] in indices:
+					deps[source[0]] = indices[source[0]]
+			except TypeError:
+				# Unhashable, parse_request will complain about it
+				pass
+		dependencies.append(deps)
+		indices[key] = i
+
+	return dependencies
+
+
+def get_waves(dependencies):
+	"""
+	Group requests into waves, where each request only depends on requests
+	in earlier waves. The requests in a wave can be executed concurrently.
+	"""
+	waves = []
+	wave_of = []
+
+	for i, deps in enumerate(dependencies):
+		wave = max((wave_of[j] + 1 for j in deps.values()), default=0)
+		wave_of.append(wave)
+		if wave == len(waves):
+			waves.append([])
+		waves[wave].append(i)
+
+	return waves
+
+
+def _get_response_in_thread(handler, req):
+	try:
+		return handler.get_response(req)
+	finally:
+		# The worker thread has its own database connections
+		connections.close_all()
+
+
+def run_parallel(handler, requests, request, workers):
+	"""
+	Execute a GET batch with independent requests running concurrently in
+	a thread pool. The result is identical to sequential execution: the
+	responses are in request order, and end at the first failing request.
+
+	Note that the requests run on their own database connections, so they
+	are not executed in a single transaction.
+	"""
+	keys = [data.pop('key', i) for i, data in enumerate(requests)]
+	dependencies = get_dependencies(keys, requests)
+	results = [None] * len(requests)
+	# Index of the first failing request, later requests are discarded
+	failed = len(requests)
+
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for wave in get_waves(dependencies):
+			futures = {}
+			for i in wave:
+				if i > failed:
+					continue
+				responses = {key: results[j][1] for key, j in dependencies[i].items()}
+				try:
+					req = parse_request(requests[i], ['GET'], responses, request)
+				except BinderException as e:
+					e.log()
+					results[i] = e.response(request), None
+				else:
+					req._dont_enforce_csrf_checks = request._dont_enforce_csrf_checks
+					futures[i] = executor.submit(_get_response_in_thread, handler, req)
+
+			for i, future in futures.items():
+				results[i] = future.result(), None
+
+			for i in wave:
+				if results[i] is None:
+					continue
+				res = results[i][0]
+				results[i] = res, SubResponse(res)
+				if res.status_code >= 400:
+					failed = min(failed, i)
+
+	responses = [res_data for _, res_data in results[:failed + 1]]
+	status = results[failed][0].status_code if failed < len(results) else 200
+	return responses, status
 
 
 def parse_request(data, allowed_methods, responses, request):
@@ -129,6 +271,10 @@ def parse_request(data, allowed_methods, responses, request):
 					.format(transform['source'], key)
 				)
 
+		# The body of a whole response is only there when it is decoded
+		if isinstance(value, SubResponse):
+			value = value.decoded()
+
 		# Set value according to target
 		target = data
 		target_key = transform['target'][0]
@@ -214,15 +360,41 @@ def parse_request(data, allowed_methods, responses, request):
 	return req
 
 
-def serialize_response(response):
-	content_type = response.get('Content-Type', '')
-	if content_type == 'application/json':
-		body = jsonloads(response.content)
-	else:
-		body = response.content.decode()
+class SubResponse(dict):
+	"""
+	A serialized response of a request in the batch. The JSON body is only
+	decoded when a transform of a later request refers to it, otherwise it
+	is copied as is into the response of the batch.
+	"""
+
+	def __init__(self, response):
+		content_type = response.get('Content-Type', '')
+		super().__init__(status=response.status_code, content_type=content_type)
+		self.content = response.content.decode()
+		self.is_json = content_type == 'application/json'
+
+	def __missing__(self, key):
+		if key != 'body':
+			raise KeyError(key)
+		self['body'] = jsonloads(self.content) if self.is_json else self.content
+		return self['body']
+
+	def decoded(self):
+		"""
+		Returns the response as a plain dict, including the decoded body.
+		"""
+		return {**self, 'body': self['body']}
+
+	def encode(self):
+		if 'body' in self or not self.is_json:
+			body = jsondumps(self['body'])
+		else:
+			body = self.content
+		return '{{"status": {}, "body": {}, "content_type": {}}}'.format(
+			jsondumps(self['status']), body, jsondumps(self['content_type']),
+		)
+
 
-	return {
-		'status': response.status_code,
-		'body': body,
-		'content_type': content_type,
-	}
+def encode_responses(responses, status):
+	content = '[{}]'.format(', '.join(res_data.encode() for res_data in responses))
+	return HttpResponse(content, content_type='application/json', status=status)
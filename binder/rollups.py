@@ -0,0 +1,256 @@
+"""
+Materialized stats.
+
+A Stat with materialized=True is kept up to date in a rollup table, when
+the view is registered to a RollupController:
+
+	stat_rollups.register(binder.views.ModelView)
+
+Every save or delete of an instance updates the rollup with the difference
+the instance makes to the stat. The rollup of a stat is only used when the
+request does not filter the records, otherwise the stat is aggregated live.
+"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.db import models, transaction
+from django.db.models import Count, Sum, Value, F
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.http import HttpRequest
+from django.utils import timezone
+
+from .json import jsondumps, jsonloads
+
+
+class StatRollup(models.Model):
+	"""
+	A materialized stat. built_at is set when the rollup has been built
+	from all records, and is only maintained incrementally from then on.
+	"""
+	model = models.CharField(max_length=255)
+	stat = models.CharField(max_length=255)
+	built_at = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		unique_together = [('model', 'stat')]
+
+
+class StatRollupValue(models.Model):
+	"""
+	The value of a materialized stat for one group (the JSON of the group_by
+	value, or null for stats without group_by), and the number of records
+	in that group.
+	"""
+	rollup = models.ForeignKey(StatRollup, on_delete=models.CASCADE, related_name='values')
+	key = models.TextField()
+	value = models.BigIntegerField(default=0)
+	count = models.BigIntegerField(default=0)
+
+	class Meta:
+		unique_together = [('rollup', 'key')]
+
+
+def _get_rollup_request():
+	# Rollups are shared by all users, so they do not depend on a request
+	request = HttpRequest()
+	request.user = AnonymousUser()
+	return request
+
+
+def check_materialized_stat(view, name, stat):
+	"""
+	Materialized stats must be sums of their records, so they can be
+	updated with the difference a single record makes.
+	"""
+	expr = stat.expr
+	if not isinstance(expr, (Count, Sum)) or expr.distinct:
+		raise ValueError(f'{view.__name__}.stats[{name!r}]: only Count and Sum (without distinct) can be materialized.')
+
+	if isinstance(expr, Sum):
+		source, = expr.get_source_expressions()
+		if not isinstance(source, F):
+			raise ValueError(f'{view.__name__}.stats[{name!r}]: only Sum of a field can be materialized.')
+		field = view.model._meta.get_field(source.name)
+		if not isinstance(field, models.IntegerField):
+			raise ValueError(f'{view.__name__}.stats[{name!r}]: only Sum of an integer field can be materialized.')
+
+
+class RollupController(object):
+	"""
+	Maintains the rollups of the materialized stats of all registered views.
+	"""
+
+	def __init__(self):
+		self.views = {}
+
+	def register(self, superclass):
+		for view in superclass.__subclasses__():
+			if view.register_for_model and view.model is not None and self._get_materialized_stats(view):
+				for name, stat in self._get_materialized_stats(view).items():
+					check_materialized_stat(view, name, stat)
+				self.views[view.model] = view
+
+				uid = f'binder.rollups.{view.model._meta.label}'
+				pre_save.connect(self._before_write, sender=view.model, weak=False, dispatch_uid=uid)
+				pre_delete.connect(self._before_write, sender=view.model, weak=False, dispatch_uid=uid)
+				post_save.connect(self._after_write, sender=view.model, weak=False, dispatch_uid=uid)
+				post_delete.connect(self._after_delete, sender=view.model, weak=False, dispatch_uid=uid)
+
+			self.register(view)
+
+		return self
+
+	def _get_materialized_stats(self, view):
+		return {name: stat for name, stat in view.stats.items() if stat.materialized}
+
+	def get_base_queryset(self, view, request):
+		"""
+		The records the rollups of a view are built from: all records which
+		are not soft deleted, without scoping.
+		"""
+		if isinstance(view, type):
+			view = view()
+		return view.filter_deleted(view.model.objects.all(), None, None, request)
+
+	def _get_values(self, view, name, stat, queryset):
+		"""
+		Aggregate the stat on the queryset, returning a dict mapping the
+		JSON of the group_by value to a (value, count) tuple.
+		"""
+		request = _get_rollup_request()
+		view = view()
+		include_annotations = view._get_stats_include_annotations()
+		annotations = {
+			key: value['expr']
+			for key, value in view.annotations(request, include_annotations).items()
+		}
+		queryset = view._filter_stat_queryset(request, queryset, stat, annotations, include_annotations)
+		queryset = queryset.order_by()
+
+		if stat.group_by is None:
+			rows = [(None,) + tuple(queryset.aggregate(
+				_binder_value=stat.expr,
+				_binder_count=Count(Value(1)),
+			).values())]
+		else:
+			group_by = stat.group_by.replace('.', '__')
+			rows = (
+				queryset
+				.exclude(**{group_by: None})
+				.values(group_by)
+				.annotate(_binder_value=stat.expr, _binder_count=Count(Value(1)))
+				.values_list(group_by, '_binder_value', '_binder_count')
+			)
+
+		return {
+			jsondumps(key): (value or 0, count)
+			for key, value, count in rows
+		}
+
+	def _get_record_values(self, view, pk):
+		request = _get_rollup_request()
+		queryset = self.get_base_queryset(view, request).filter(pk=pk)
+		return {
+			name: self._get_values(view, name, stat, queryset)
+			for name, stat in self._get_materialized_stats(view).items()
+		}
+
+	def _before_write(self, sender, instance, **kwargs):
+		if instance.pk is None:
+			instance._binder_rollup_values = {}
+		else:
+			instance._binder_rollup_values = self._get_record_values(self.views[sender], instance.pk)
+
+	def _after_write(self, sender, instance, **kwargs):
+		old = getattr(instance, '_binder_rollup_values', {})
+		new = self._get_record_values(self.views[sender], instance.pk)
+		self._apply(sender, old, new)
+
+	def _after_delete(self, sender, instance, **kwargs):
+		old = getattr(instance, '_binder_rollup_values', {})
+		self._apply(sender, old, {})
+
+	def _apply(self, model, old, new):
+		view = self.views[model]
+		for name in self._get_materialized_stats(view):
+			old_values = old.get(name, {})
+			new_values = new.get(name, {})
+			changes = {}
+			for key in set(old_values) | set(new_values):
+				old_value, old_count = old_values.get(key, (0, 0))
+				new_value, new_count = new_values.get(key, (0, 0))
+				if (old_value, old_count) != (new_value, new_count):
+					changes[key] = (new_value - old_value, new_count - old_count)
+			if not changes:
+				continue
+
+			rollup = StatRollup.objects.filter(model=model._meta.label, stat=name, built_at__isnull=False).first()
+			if rollup is None:
+				# Not built yet, the build will count this record
+				continue
+
+			for key, (value, count) in changes.items():
+				updated = StatRollupValue.objects.filter(rollup=rollup, key=key).update(
+					value=F('value') + value,
+					count=F('count') + count,
+				)
+				if not updated:
+					rollup_value, _ = StatRollupValue.objects.get_or_create(rollup=rollup, key=key)
+					StatRollupValue.objects.filter(pk=rollup_value.pk).update(
+						value=F('value') + value,
+						count=F('count') + count,
+					)
+
+	def build(self, view=None):
+		"""
+		(Re)build the rollups of the given view, or of all registered views,
+		from all records.
+		"""
+		views = [view] if view is not None else list(self.views.values())
+		for view in views:
+			for name, stat in self._get_materialized_stats(view).items():
+				with transaction.atomic():
+					rollup, _ = StatRollup.objects.select_for_update().get_or_create(model=view.model._meta.label, stat=name)
+					rollup.values.all().delete()
+					values = self._get_values(view, name, stat, self.get_base_queryset(view, _get_rollup_request()))
+					StatRollupValue.objects.bulk_create([
+						StatRollupValue(rollup=rollup, key=key, value=value, count=count)
+						for key, (value, count) in values.items()
+					])
+					rollup.built_at = timezone.now()
+					rollup.save()
+
+	def get(self, view, name, stat, queryset, request):
+		"""
+		Returns the value of a materialized stat from its rollup, in the same
+		form as the aggregate of the stat (a dict for grouped stats). Returns
+		None when the rollup can not be used for the queryset.
+		"""
+		if self.views.get(view.model) is not type(view):
+			# The rollup is not maintained by this process
+			return None
+
+		base = self.get_base_queryset(view, request)
+		if str(queryset.order_by().values('pk').query) != str(base.order_by().values('pk').query):
+			# Filtered, or scoped to less records than the rollup
+			return None
+
+		rollup = StatRollup.objects.filter(model=view.model._meta.label, stat=name, built_at__isnull=False).first()
+		if rollup is None:
+			return None
+
+		values = {
+			key: (value, count)
+			for key, value, count in rollup.values.values_list('key', 'value', 'count')
+			if count
+		}
+
+		if stat.group_by is None:
+			value, count = values.get('null', (0, 0))
+			if not count and isinstance(stat.expr, Sum):
+				return {'value': None}
+			return {'value': value}
+
+		return {'value': {jsonloads(key): value for key, (value, count) in values.items()}}
+
+
+stat_rollups = RollupController()
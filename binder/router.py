@@ -4,6 +4,9 @@ from django.apps import apps
 from django.urls import reverse, re_path
 
 from binder.views import ModelView
+from binder.models import BinderFileField
+from binder import downloads
+from binder.stats_cache import stats_cache
 from .exceptions import BinderRequestError, BinderCSRFFailure
 
 from .route_decorators import _route_decorator, list_route, detail_route  # noqa: for backwards compatibility
@@ -69,6 +72,8 @@ class Router(object):
 			self.model_views[view.model] = view
 			self.name_models[view._model_name()] = view.model
 
+		stats_cache.register(view)
+
 		if view.route is not None:
 			if isinstance(view.route, Route):
 				route = view.route
@@ -140,6 +145,12 @@ class Router(object):
 				urls.append(re_path(r'^{}/(?P<pk>[0-9]+)/{}/$'.format(route.route, ff),
 						view.as_view(), {'file_field': ff, 'router': self}, name='{}.{}'.format(name, ff)))
 
+				# Signed urls of files served by the web server, see binder.downloads
+				field = view.model._meta.get_field(ff)
+				if isinstance(field, BinderFileField) and field.serve_directly:
+					urls.append(re_path(r'^{}/{}/signed/(?P<name>.+)$'.format(route.route, ff),
+							downloads.signed_file_view, {'model': view.model, 'file_field': ff}, name='{}.{}.signed'.format(name, ff)))
+
 			# Custom endpoints
 			for m in dir(view):
 				method = getattr(view, m)
@@ -0,0 +1,117 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+
+class StatsCache(object):
+	"""
+	Caches the results of stats per view, stat and filtered queryset.
+
+	Every watched model has a generation in the cache, which is part of the
+	cache key of every stat depending on the model. Writing the model
+	increases the generation, so all cached stats of that model are missed
+	from then on, and expire after their timeout.
+	"""
+
+	def __init__(self):
+		self.models = set()
+
+	@property
+	def cache(self):
+		return caches[getattr(settings, 'BINDER_STATS_CACHE', 'default')]
+
+	def _generation_key(self, label):
+		return 'binder_stats_generation:' + label
+
+	def watch(self, *models):
+		"""
+		Invalidate the cached stats of the given models when they are written.
+		"""
+		self.models.update(model._meta.label for model in models)
+
+	def register(self, view):
+		"""
+		Watch the models of a view with cached stats. This is done when the view
+		is registered with the router, so every process invalidates the stats
+		on writes, also before it served stats of the view itself.
+		"""
+		if view.stats_cache_timeout and view.model is not None:
+			self.watch(view.model, *view.stats_cache_models)
+
+	def get_generations(self, models):
+		keys = [self._generation_key(model._meta.label) for model in models]
+		generations = self.cache.get_many(keys)
+		for key in keys:
+			if key not in generations:
+				# Start at an unused generation, in case the generation was
+				# evicted while stats of earlier generations are still cached
+				self.cache.add(key, time.time_ns(), None)
+				generations[key] = self.cache.get(key)
+		return [generations[key] for key in keys]
+
+	def get_key(self, view, queryset, models):
+		"""
+		Returns the cache key prefix for stats of the view on the queryset,
+		which includes the filters of the request and the scoping of the
+		user. Returns None when the queryset can't be used as a key.
+		"""
+		self.watch(*models)
+		try:
+			sql, params = queryset.query.sql_with_params()
+		except EmptyResultSet:
+			return None
+		key = repr((
+			type(view).__module__,
+			type(view).__qualname__,
+			sql,
+			params,
+			self.get_generations(models),
+		))
+		return 'binder_stats:' + hashlib.sha256(key.encode()).hexdigest()
+
+	def get_many(self, keys):
+		return self.cache.get_many(keys)
+
+	def set_many(self, values, timeout):
+		self.cache.set_many(values, timeout)
+
+	def invalidate(self, *models):
+		"""
+		Invalidate the cached stats depending on the given models.
+		"""
+		for model in models:
+			key = self._generation_key(model._meta.label)
+			try:
+				self.cache.incr(key)
+			except ValueError:
+				self.cache.add(key, time.time_ns(), None)
+
+
+stats_cache = StatsCache()
+
+
+def _invalidate(*models):
+	models = [model for model in models if model is not None and model._meta.label in stats_cache.models]
+	if not models:
+		return
+	stats_cache.invalidate(*models)
+	# Invalidate again on commit, in case stats were cached from another
+	# transaction before this one was committed
+	transaction.on_commit(lambda: stats_cache.invalidate(*models))
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _invalidate_on_write(sender, **kwargs):
+	_invalidate(sender)
+
+
+@receiver(m2m_changed)
+def _invalidate_on_m2m_change(sender, instance, model, **kwargs):
+	_invalidate(sender, type(instance), model)
@@ -0,0 +1,181 @@
+"""
+Thumbnails of image fields, generated on request.
+
+A GET of an image field with ?width=256&height=256&fit=cover&format=webp
+serves a thumbnail instead of the stored image. The width and height are
+rounded up to one of BINDER_THUMBNAIL_SIZES. Thumbnails are stored in
+the default storage, under a name derived from the content hash of
+the image and the parameters, so they are only generated once for every
+version of an image. When the total size of all thumbnails exceeds
+BINDER_THUMBNAIL_CACHE_SIZE bytes, the least recently used ones are
+deleted.
+"""
+
+import bisect
+import hashlib
+import os
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Sum
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .exceptions import BinderRequestError
+
+
+# The sizes a requested width and height are rounded up to, so every image
+# only has a limited number of thumbnails
+SIZES = (32, 64, 128, 256, 512, 1024, 2048)
+FITS = ('contain', 'cover')
+FORMATS = {
+	'jpeg': 'jpg',
+	'png': 'png',
+	'webp': 'webp',
+}
+
+# Only update the last access of a thumbnail once in this interval
+ACCESS_INTERVAL = timedelta(minutes=5)
+
+
+class Thumbnail(models.Model):
+	"""
+	A thumbnail in storage. The key is unique for the image contents and
+	the thumbnail parameters.
+	"""
+	key = models.CharField(max_length=255, unique=True)
+	file_name = models.CharField(max_length=400)
+	size = models.BigIntegerField()
+	accessed_at = models.DateTimeField(db_index=True)
+
+
+def get_params(GET):
+	"""
+	Returns the thumbnail parameters of a request, or None when it does not
+	ask for a thumbnail.
+	"""
+	if not any(key in GET for key in ('width', 'height', 'fit', 'format')):
+		return None
+
+	sizes = sorted(getattr(settings, 'BINDER_THUMBNAIL_SIZES', SIZES))
+	size = []
+	for key in ('width', 'height'):
+		value = GET.get(key)
+		if value is None:
+			size.append(None)
+			continue
+		try:
+			value = int(value)
+		except ValueError:
+			raise BinderRequestError('Invalid {}: {}.'.format(key, value))
+		i = bisect.bisect_left(sizes, value)
+		if value < 1 or i == len(sizes):
+			raise BinderRequestError('Invalid {}: must be between 1 and {}.'.format(key, sizes[-1]))
+		size.append(sizes[i])
+	width, height = size
+
+	fit = GET.get('fit', 'contain')
+	if fit not in FITS:
+		raise BinderRequestError('Invalid fit: must be one of {}.'.format(', '.join(FITS)))
+
+	format = GET.get('format')
+	if format is not None and format not in FORMATS:
+		raise BinderRequestError('Invalid format: must be one of {}.'.format(', '.join(FORMATS)))
+
+	return width, height, fit, format
+
+
+def get_key(content_hash, params):
+	width, height, fit, format = params
+	return '{}-{}x{}-{}-{}'.format(content_hash, width or '', height or '', fit, format or '')
+
+
+def make_thumbnail(file, params):
+	width, height, fit, format = params
+
+	img = Image.open(file)
+	format = format or img.format.lower()
+	if format not in FORMATS:
+		format = 'png'
+
+	# Never scale up
+	width = min(width or img.width, img.width)
+	height = min(height or img.height, img.height)
+
+	# Let JPEG decode at a lower resolution when the thumbnail is small enough
+	img.draft(img.mode, (width, height))
+	if fit == 'cover':
+		img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+	else:
+		img.thumbnail((width, height), Image.LANCZOS)
+
+	if format == 'jpeg' and img.mode not in ('L', 'RGB'):
+		img = img.convert('RGB')
+	elif img.mode not in ('1', 'L', 'P', 'RGB', 'RGBA'):
+		img = img.convert('RGBA')
+
+	out = BytesIO()
+	img.save(out, format)
+	return out.getvalue(), FORMATS[format]
+
+
+def get_thumbnail(file_field, content_hash, params):
+	"""
+	Returns the name in storage of the thumbnail of the image, generating
+	it when it does not exist yet.
+	"""
+	key = get_key(content_hash, params)
+	now = timezone.now()
+
+	thumbnail = Thumbnail.objects.filter(key=key).first()
+	if thumbnail is not None:
+		Thumbnail.objects.filter(pk=thumbnail.pk, accessed_at__lt=now - ACCESS_INTERVAL).update(accessed_at=now)
+		return thumbnail.file_name
+
+	with file_field.open('rb') as file:
+		content, extension = make_thumbnail(file, params)
+
+	directory = getattr(settings, 'BINDER_THUMBNAIL_DIR', 'thumbnails')
+	name = os.path.join(directory, content_hash[:2], '{}.{}'.format(hashlib.sha1(key.encode()).hexdigest(), extension))
+
+	with transaction.atomic():
+		thumbnail, created = Thumbnail.objects.get_or_create(key=key, defaults={
+			'file_name': name,
+			'size': len(content),
+			'accessed_at': now,
+		})
+		if created:
+			thumbnail.file_name = default_storage.save(name, ContentFile(content))
+			thumbnail.save()
+			transaction.on_commit(evict_thumbnails)
+
+	return thumbnail.file_name
+
+
+def evict_thumbnails():
+	"""
+	Delete the least recently used thumbnails until their total size is
+	below BINDER_THUMBNAIL_CACHE_SIZE.
+	"""
+	max_size = getattr(settings, 'BINDER_THUMBNAIL_CACHE_SIZE', 1024 ** 3)
+	if max_size is None:
+		return
+
+	excess = (Thumbnail.objects.aggregate(size=Sum('size'))['size'] or 0) - max_size
+	if excess <= 0:
+		return
+
+	evicted = []
+	for pk, file_name, size in Thumbnail.objects.order_by('accessed_at', 'pk').values_list('pk', 'file_name', 'size').iterator():
+		if excess <= 0:
+			break
+		evicted.append((pk, file_name))
+		excess -= size
+
+	Thumbnail.objects.filter(pk__in=[pk for pk, _ in evicted]).delete()
+	for _, file_name in evicted:
+		default_storage.delete(file_name)
@@ -0,0 +1,158 @@
+"""
+Checks on uploaded files which are done while the file is received.
+
+The UploadLimitHandler is put in front of Django's upload handlers by
+ModelView.dispatch, so an upload which is too large or of the wrong type is
+aborted as soon as that is known, instead of after the whole request body
+was received. The files themselves are still stored by Django's upload
+handlers, which spool files larger than FILE_UPLOAD_MAX_MEMORY_SIZE to disk.
+
+Django parses a POST body as soon as request.POST is accessed, which the
+CsrfViewMiddleware does for requests which are checked for CSRF. Add the
+UploadLimitMiddleware before it to install the handler in time:
+
+	MIDDLEWARE = [
+		...
+		'binder.uploads.UploadLimitMiddleware',
+		'django.middleware.csrf.CsrfViewMiddleware',
+		...
+	]
+"""
+
+import os
+
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from .exceptions import BinderFileSizeExceeded, BinderFileTypeIncorrect
+
+
+# The bytes files of an extension start with, used to reject files of which
+# the contents do not match their extension
+MAGIC_BYTES = {
+	'jpg': (b'\xff\xd8\xff',),
+	'jpeg': (b'\xff\xd8\xff',),
+	'png': (b'\x89PNG\r\n\x1a\n',),
+	'gif': (b'GIF87a', b'GIF89a'),
+	'bmp': (b'BM',),
+	'tif': (b'II*\x00', b'MM\x00*'),
+	'tiff': (b'II*\x00', b'MM\x00*'),
+	'pdf': (b'%PDF-',),
+	'zip': (b'PK\x03\x04',),
+	'docx': (b'PK\x03\x04',),
+	'xlsx': (b'PK\x03\x04',),
+	'pptx': (b'PK\x03\x04',),
+	'odt': (b'PK\x03\x04',),
+	'ods': (b'PK\x03\x04',),
+}
+
+
+def get_magic_bytes(allowed_extensions):
+	"""
+	Returns the bytes a file may start with to be of one of the allowed
+	extensions, or None when they are not known for all of them.
+	"""
+	if allowed_extensions is None:
+		return None
+	magic_bytes = set()
+	for extension in allowed_extensions:
+		try:
+			magic_bytes.update(MAGIC_BYTES[extension.lower()])
+		except KeyError:
+			return None
+	return tuple(magic_bytes)
+
+
+class UploadLimitHandler(FileUploadHandler):
+	"""
+	Aborts an upload as soon as a file exceeds its max size, or has an
+	extension or contents which are not allowed. get_limits is called with
+	the name of the multipart field of every file, and returns the max size
+	in bytes (or None) and allowed extensions (or None) of the file.
+
+	The error is stored on the request, and raised by check_upload once
+	the view accesses the files.
+	"""
+
+	def __init__(self, request=None, get_limits=None):
+		super().__init__(request)
+		self.get_limits = get_limits
+
+	def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+		super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+		self.max_size, allowed_extensions = self.get_limits(field_name)
+		self.size = 0
+		self.head = b''
+
+		if allowed_extensions is not None:
+			allowed_extensions = {ext.lower() for ext in allowed_extensions}
+			extension = os.path.splitext(file_name)[1][1:].lower()
+			if extension not in allowed_extensions:
+				self.abort(BinderFileTypeIncorrect([{'extension': t} for t in allowed_extensions]))
+		self.allowed_extensions = allowed_extensions
+		self.magic_bytes = get_magic_bytes(allowed_extensions)
+
+		if content_length is not None:
+			self.check_size(content_length)
+
+	def receive_data_chunk(self, raw_data, start):
+		self.size += len(raw_data)
+		self.check_size(self.size)
+
+		if self.magic_bytes is not None:
+			self.head += raw_data[:16 - len(self.head)]
+			if len(self.head) >= 16:
+				self.check_magic_bytes()
+
+		return raw_data
+
+	def file_complete(self, file_size):
+		if self.magic_bytes is not None:
+			self.check_magic_bytes()
+		return None
+
+	def check_size(self, size):
+		if self.max_size is not None and size > self.max_size:
+			self.abort(BinderFileSizeExceeded(self.max_size / 10**6))
+
+	def check_magic_bytes(self):
+		if not self.head.startswith(self.magic_bytes):
+			self.abort(BinderFileTypeIncorrect([{'extension': t} for t in self.allowed_extensions]))
+		# Checked, no need to look at the rest of the file
+		self.magic_bytes = None
+
+	def abort(self, error):
+		if self.request is not None:
+			self.request._binder_upload_error = error
+		# Do not read the rest of the request body
+		raise StopUpload(connection_reset=True)
+
+
+def check_upload(request):
+	"""
+	Raise the error of an upload which was aborted by the UploadLimitHandler.
+	"""
+	error = getattr(request, '_binder_upload_error', None)
+	if error is not None:
+		raise error
+
+
+class UploadLimitMiddleware:
+	"""
+	Installs the UploadLimitHandler of binder views before other middleware
+	(like the CsrfViewMiddleware) parses the request body.
+	"""
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		return self.get_response(request)
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		# Avoid a circular import
+		from .views import ModelView
+
+		view_class = getattr(view_func, 'view_class', None)
+		if view_class is not None and issubclass(view_class, ModelView):
+			view_class()._install_upload_handler(request, view_kwargs)
+		return None
@@ -17,7 +17,8 @@ from django.views.generic import View
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, FieldError, ValidationError, FieldDoesNotExist
 from django.core.files.base import File, ContentFile
-from django.http import HttpResponse,  HttpResponseForbidden, FileResponse
+from django.core.files.storage import default_storage
+from django.http import HttpResponse,  HttpResponseForbidden, FileResponse, StreamingHttpResponse
 from django.http.request import RawPostDataException
 from django.http.multipartparser import MultiPartParser
 from django.db import models, connections
@@ -26,11 +27,17 @@ from django.db.models.lookups import Transform
 from django.utils import timezone
 from django.db import transaction
 from django.db.models.expressions import BaseExpression, Value, CombinedExpression, OrderBy, ExpressionWrapper
+from django.db.models.fields.files import FieldFile
 from django.db.models.fields.reverse_related import ForeignObjectRel
 
 
 from .exceptions import BinderException, BinderFieldTypeError, BinderFileSizeExceeded, BinderForbidden, BinderImageError, BinderImageSizeExceeded, BinderInvalidField, BinderIsDeleted, BinderIsNotDeleted, BinderMethodNotAllowed, BinderNotAuthenticated, BinderNotFound, BinderReadOnlyFieldError, BinderRequestError, BinderValidationError, BinderFileTypeIncorrect, BinderInvalidURI
 from . import history
+from .stats_cache import stats_cache
+from .rollups import stat_rollups
+from .uploads import UploadLimitHandler, check_upload
+from . import downloads
+from . import thumbnails
 from .orderable_agg import OrderableArrayAgg, GroupConcat, StringAgg
 from .models import FieldFilter, BinderModel, ContextAnnotation, OptionalAnnotation, BinderFileField, BinderImageField
 from .json import JsonResponse, jsonloads, jsondumps
@@ -41,10 +48,11 @@ from .route_decorators import list_route
 # filter: a dict of filters to filter the queryset with before getting the aggregate, leading dot not included (optional),
 # group_by: a field to group by separated by dots if following relations (optional),
 # annotations: a list of annotation names that have to be applied to the queryset for the expr to work (optional),
+# materialized: keep the stat up to date in a rollup table, see binder.rollups (optional),
 Stat = namedtuple(
 	'Stat',
-	['expr', 'filters', 'group_by', 'annotations', 'min_value', 'max_values'],
-	defaults=[{}, None, [], None, None],
+	['expr', 'filters', 'group_by', 'annotations', 'min_value', 'max_values', 'materialized'],
+	defaults=[{}, None, [], None, None, False],
 )
 
 
@@ -78,6 +86,39 @@ def get_joins_from_queryset(queryset):
 	return lines
 
 
+def get_multi_valued_aliases(queryset):
+	"""
+	Returns the aliases of the joins of a queryset which follow a to many
+	relation, and can thus return every row multiple times.
+	"""
+	return {
+		alias for alias, join in queryset.query.alias_map.items()
+		if getattr(join, 'join_field', None) is not None
+		and (join.join_field.one_to_many or join.join_field.many_to_many)
+	}
+
+
+def undefer_fields(queryset, names):
+	"""
+	Returns the queryset with the fields of the given names loaded, also
+	when they were deferred by defer() or left out by only(). Accessing a
+	deferred field refreshes it from the database, one query per object.
+	"""
+	names = frozenset(names)
+	loaded, defer = queryset.query.deferred_loading
+	if defer:
+		if not loaded & names:
+			return queryset
+		loaded = loaded - names
+	else:
+		if names <= loaded:
+			return queryset
+		loaded = loaded | names
+	queryset = queryset._chain()
+	queryset.query.deferred_loading = (frozenset(loaded), defer)
+	return queryset
+
+
 def q_get_flat_filters(q):
 	"""
 	Given a Q-object returns an iterator of all filters used in this Q-object.
@@ -269,7 +310,7 @@ RelatedModel = namedtuple('RelatedModel', ['fieldname', 'model', 'reverse_fieldn
 FilterDescription = namedtuple('FilterDescription', ['filter', 'need_distinct'])
 
 # Stolen and improved from https://stackoverflow.com/a/30462851
-def image_transpose_exif(im):
+def image_exif_transpose_sequence(im):
 	exif_orientation_tag = 0x0112  # contains an integer, 1 through 8
 	exif_transpose_sequences = [   # corresponding to the following
 		[],
@@ -283,13 +324,18 @@ def image_transpose_exif(im):
 	]
 
 	try:
-		if im._getexif() is not None:
-			seq = exif_transpose_sequences[im._getexif()[exif_orientation_tag] - 1]
-			return functools.reduce(lambda im, op: im.transpose(op), seq, im)
+		exif = im._getexif()
+		if exif is not None:
+			return exif_transpose_sequences[exif[exif_orientation_tag] - 1]
 		else:
-			return im
-	except KeyError:
-		return im
+			return []
+	except (KeyError, IndexError):
+		return []
+
+
+def image_transpose_exif(im):
+	seq = image_exif_transpose_sequence(im)
+	return functools.reduce(lambda im, op: im.transpose(op), seq, im)
 
 
 def getsubclasses(cls):
@@ -420,9 +466,12 @@ class ModelView(View):
 	limit_max = None
 
 	# Size limit (in MB, floats ok) of uploaded files.
-	# NOTE: files are fully uploaded before this size check is performed, so
-	# this is not an adequate protection against DoS attacks. Also, rejecting
-	# a file after a potentially lengthy upload is poor UX.
+	# 10 limits all file fields on this model to 10 MB.
+	# {'foo': 10, 'bar': 100} limits field foo to 10 MB and bar to 100 MB.
+	# Like image_resize_threshold, a dict will KeyError if you don't specify
+	# all file fields. The size and extension of a file are checked while it
+	# is uploaded, so an upload is aborted as soon as it exceeds the limit
+	# (see binder.uploads for when the CsrfViewMiddleware is used).
 	max_upload_size = 10
 
 	# If set, this will be passed in the meta.comment field in GET replies,
@@ -445,6 +494,9 @@ class ModelView(View):
 	# collections.defaultdict(lambda: 512, foo=1024)
 	image_resize_threshold = 512
 	image_format_override = None
+	# Images over this width/height (or the resize threshold, if larger) are
+	# refused, to prevent DoS.
+	image_size_limit = 4096
 
 	# A dict that looks like:
 	#  name: {
@@ -470,6 +522,13 @@ class ModelView(View):
 	# These statistics can then be used in the stats view
 	stats = {}
 
+	# When set, the results of stats are cached for this many seconds, per
+	# stat, filters and scoping. The cache is invalidated when the model, or
+	# one of the models in stats_cache_models, is written. The cache used is
+	# set by the BINDER_STATS_CACHE setting ('default' by default).
+	stats_cache_timeout = None
+	stats_cache_models = []
+
 	@property
 	def AggStrategy(self):
 		if connections[self.model.objects.db].vendor == 'mysql':
@@ -509,8 +568,13 @@ class ModelView(View):
 		logger.info('request parameters: {}'.format(dict(request.GET)))
 		logger.debug('cookies: {}'.format(request.COOKIES))
 
+		self._install_upload_handler(request, kwargs)
+
 		if not self.log_request_body:
 			body = ' censored.'
+		elif request.META.get('CONTENT_TYPE', '').lower().startswith('multipart/form-data'):
+			# Reading the body would read all uploaded files into memory
+			body = ' not logged for multipart.'
 		else:
 			# FIXME: ugly workaround, remove when Django bug fixed
 			# Try/except because https://code.djangoproject.com/ticket/27005
@@ -570,6 +634,76 @@ class ModelView(View):
 		return response
 
 
+	def _install_upload_handler(self, request, kwargs):
+		# Too late when the body was already parsed
+		if hasattr(request, '_files') or getattr(request, '_binder_upload_handler_installed', False):
+			return
+		if not request.META.get('CONTENT_TYPE', '').lower().startswith('multipart/form-data'):
+			return
+
+		if 'file_field' in kwargs:
+			file_field = kwargs['file_field']
+
+			def get_limits(field_name):
+				return self._get_upload_limits(file_field)
+		else:
+			def get_limits(field_name):
+				# Files in a multipart body are sent as file:<path>, where the
+				# last key of the path is the field the file is for. Only
+				# fields of this model (<field> or data.<index>.<field>) get
+				# their own limits, files of related objects get the global
+				# limits.
+				if field_name.startswith('file:'):
+					keys = list(split_path(field_name[5:]))
+					if len(keys) == 1 or (len(keys) == 3 and keys[0] == 'data'):
+						field_name = keys[-1]
+					else:
+						field_name = None
+				return self._get_upload_limits(field_name)
+
+		request.upload_handlers.insert(0, UploadLimitHandler(request, get_limits))
+		request._binder_upload_handler_installed = True
+
+
+	def _get_max_upload_size(self, field):
+		try:
+			return self.max_upload_size[field]
+		except TypeError:
+			return self.max_upload_size
+
+
+	def _get_allowed_extensions(self, field):
+		if isinstance(field, models.ImageField):
+			return ['png', 'gif', 'jpg', 'jpeg']
+		elif isinstance(field, BinderFileField):
+			return field.allowed_extensions
+		else:
+			return None
+
+
+	def _get_upload_limits(self, field_name):
+		"""
+		Returns the max size in bytes and the allowed extensions of a file
+		uploaded for the given field name, which are checked while the file
+		is received. For files which are not for a file field of this view
+		(but for example for a related model) only the largest size limit is
+		checked, the rest is checked when the file is stored.
+		"""
+		try:
+			field = None if field_name is None else self.model._meta.get_field(field_name)
+		except FieldDoesNotExist:
+			field = None
+
+		if isinstance(field, models.FileField):
+			return self._get_max_upload_size(field_name) * 10**6, self._get_allowed_extensions(field)
+
+		try:
+			max_upload_size = max(self.max_upload_size.values())
+		except AttributeError:
+			max_upload_size = self.max_upload_size
+		return max_upload_size * 10**6, None
+
+
 	# This returns a (cached) filterclass for a field class.
 	def get_field_filter(self, field_class, reset=False):
 		f = not reset and getattr(self, '_field_filters', None)
@@ -641,6 +775,13 @@ class ModelView(View):
 		else:
 			annotations &= set(self.shown_annotations)
 
+		# Make sure the shown fields are loaded, a deferred field would be
+		# refreshed for every object. File fields are serialized from the
+		# loaded value, and can not be refreshed at all.
+		queryset = undefer_fields(queryset, [f.attname for f in fields])
+
+		signed_url_max_age = downloads.get_signed_url_max_age()
+
 		# So now annotations are only being used for showing, so we filter out
 		# all that do not have to be shown
 		to_annotate = {
@@ -698,20 +839,36 @@ class ModelView(View):
 
 			data = {}
 			for f in fields:
-				if isinstance(f, models.FileField):
-					file = getattr(obj, f.attname)
-					if file:
+				if isinstance(f, BinderFileField):
+					# Only the stored values are needed, so do not construct
+					# a BinderFieldFile. Never hash the file here, that would
+					# read every file in the list from storage.
+					file = f.get_stored_file(obj)
+					if file.name:
 						# {router-view-instance}
-						data[f.name] = self.router.model_route(self.model, obj.id, f)
 						# {duplicate-binder-file-field-hash-code}
-						if isinstance(f, BinderFileField):
-							data[f.name] += '?h={}&content_type={}&filename={}'.format(
-								file.content_hash,
-								file.content_type or '',
+						content_type = file.content_type
+						if content_type is None:
+							content_type, _ = mimetypes.guess_type(file.name)
+						if f.serve_directly and signed_url_max_age:
+							data[f.name] = downloads.get_signed_url(
+								self.router.model_route(self.model), self.model, f.name,
+								file.name, file.content_hash, content_type, signed_url_max_age,
+							)
+						else:
+							data[f.name] = self.router.model_route(self.model, obj.id, f) + '?h={}&content_type={}&filename={}'.format(
+								file.content_hash or '',
+								content_type or '',
 								os.path.basename(file.name),
 							)
 					else:
 						data[f.name] = None
+				elif isinstance(f, models.FileField):
+					if obj.__dict__[f.attname]:
+						# {router-view-instance}
+						data[f.name] = self.router.model_route(self.model, obj.id, f)
+					else:
+						data[f.name] = None
 				else:
 					data[f.name] = getattr(obj, f.attname)
 
@@ -1984,6 +2141,8 @@ class ModelView(View):
 
 
 	def _clean_image_file(self, field, value):
+		# The image is decoded and encoded at most once: EXIF orientation,
+		# resizing and format changes are all applied to the same decode.
 		try:
 			img = Image.open(value)
 		except Exception:
@@ -1993,15 +2152,13 @@ class ModelView(View):
 		if not format in ('png', 'gif', 'jpeg'):
 			raise BinderFileTypeIncorrect([{'extension': t, 'mimetype': 'image/' + t} for t in ['jpeg', 'png', 'gif']])
 
-		width, height = img.size
-		if format == 'jpeg':
-			img2 = image_transpose_exif(img)
+		transpose = image_exif_transpose_sequence(img) if format == 'jpeg' else []
+		# Rotating by 90 degrees swaps the width and height
+		swap = Image.ROTATE_90 in transpose or Image.ROTATE_270 in transpose
 
-			if img2 != img:
-				value.seek(0)  # Do not append to the existing file!
-				value.truncate()
-				img2.save(value, 'jpeg')
-				img = img2
+		width, height = img.size
+		if swap:
+			width, height = height, width
 
 		# Determine resize threshold
 		try:
@@ -2019,29 +2176,23 @@ class ModelView(View):
 		except AttributeError:
 			format_override = self.image_format_override
 
-		changes = False
+		changes = bool(transpose)
 
-		# FIXME: hardcoded max
 		# Flat out refuse images exceeding this size, to prevent DoS.
-		width_limit, height_limit = max(max_width, 4096), max(max_height, 4096)
+		width_limit, height_limit = max(max_width, self.image_size_limit), max(max_height, self.image_size_limit)
 		if width > width_limit or height > height_limit:
 			raise BinderImageSizeExceeded(width_limit, height_limit)
 
-		# Resize images that are too large.
-		if width > max_width or height > max_height:
-			img.thumbnail((max_width, max_height), Image.LANCZOS)
+		resize = width > max_width or height > max_height
+		if resize:
+			# Let JPEG decode at a lower resolution which is still at least
+			# the target size, which is much faster and uses less memory
+			img.draft(img.mode, (max_height, max_width) if swap else (max_width, max_height))
 			logger.info('image dimensions ({}x{}) exceeded ({}, {}), resizing.'.format(width, height, max_width, max_height))
-			if img.mode not in ["1", "L", "P", "RGB", "RGBA"]:
-				img = img.convert("RGB")
 			if format != 'jpeg':
 				format = 'png'
 			changes = True
 
-		# Saving a JPEG with mode RGBA will crash because JPEG does not support
-		# an alpha channel, so in this case we convert to RGB
-		if format_override == 'jpeg' and img.mode == 'RGBA':
-			img = img.convert('RGB')
-
 		if format_override and format != format_override:
 			format = format_override
 			changes = True
@@ -2051,11 +2202,25 @@ class ModelView(View):
 			ext = '.' + format
 			changes = True
 
-		if changes:
-			filename = name + ext
-			value = ContentFile(b'', name=filename)
-			img.save(value, format)
+		if not changes:
+			return value
 
+		# Transpose after the (draft) decode, so it is done on fewer pixels
+		for op in transpose:
+			img = img.transpose(op)
+
+		if resize:
+			img.thumbnail((max_width, max_height), Image.LANCZOS)
+			if img.mode not in ["1", "L", "P", "RGB", "RGBA"]:
+				img = img.convert("RGB")
+
+		# Saving a JPEG with mode RGBA will crash because JPEG does not support
+		# an alpha channel, so in this case we convert to RGB
+		if format == 'jpeg' and img.mode == 'RGBA':
+			img = img.convert('RGB')
+
+		value = ContentFile(b'', name=name + ext)
+		img.save(value, format)
 		return value
 
 
@@ -2163,15 +2328,11 @@ class ModelView(View):
 						raise BinderFieldTypeError(self.model.__name__, field)
 
 					if value is not None:
-						if value.size > self.max_upload_size * 10**6:
-							raise BinderFileSizeExceeded(self.max_upload_size)
+						max_upload_size = self._get_max_upload_size(field)
+						if value.size > max_upload_size * 10**6:
+							raise BinderFileSizeExceeded(max_upload_size)
 
-						if isinstance(f, models.ImageField):
-							allowed_extensions = ['png', 'gif', 'jpg', 'jpeg']
-						elif isinstance(f, BinderFileField):
-							allowed_extensions = f.allowed_extensions
-						else:
-							allowed_extensions = None
+						allowed_extensions = self._get_allowed_extensions(f)
 
 						if allowed_extensions is not None:
 							extension = os.path.splitext(value.name)[1][1:].lower()
@@ -2688,6 +2849,7 @@ class ModelView(View):
 			else:
 				parser = MultiPartParser(request.META, request, request.upload_handlers)
 				fields, files = parser.parse()
+			check_upload(request)
 			try:
 				data = fields['data']
 			except KeyError:
@@ -2906,25 +3068,73 @@ class ModelView(View):
 			if not file_field:
 				raise BinderNotFound(file_field_name)
 
-			guess = mimetypes.guess_type(file_field.name)
-			content_type = (guess and guess[0]) or 'application/octet-stream'
 			serve_directly = isinstance(field, BinderFileField) and field.serve_directly
 
-			is_video = content_type and content_type.startswith('video/')
+			# The url of a file contains its hash, so a request with the
+			# current hash will always get the same file
+			content_hash = getattr(file_field, 'stored_content_hash', None)
+			if content_hash and request.GET.get('h') == content_hash:
+				cache_control = 'private, max-age=31536000, immutable'
+			else:
+				cache_control = None
 
 			try:
+				etag = downloads.get_etag(file_field)
+
+				thumbnail_params = None
+				if isinstance(field, BinderImageField):
+					thumbnail_params = thumbnails.get_params(request.GET)
+				if thumbnail_params is not None:
+					# The etag of a thumbnail follows from the image and the
+					# parameters, so it is only generated when it is served
+					source_hash = self._get_thumbnail_source_hash(file_field)
+					etag = '"{}"'.format(thumbnails.get_key(source_hash, thumbnail_params))
+
+				# Only look at the storage when there is no hash to compare
+				if etag is None and not serve_directly:
+					last_modified = downloads.get_last_modified(file_field)
+				else:
+					last_modified = None
+
+				resp = downloads.get_not_modified_response(request, etag, last_modified)
+				if resp is not None:
+					if cache_control is not None:
+						resp['Cache-Control'] = cache_control
+					return resp
+
+				served_file = file_field
+				if thumbnail_params is not None:
+					served_file = self._get_thumbnail(obj, field, file_field, source_hash, thumbnail_params)
+
+				guess = mimetypes.guess_type(served_file.name)
+				content_type = (guess and guess[0]) or 'application/octet-stream'
+
 				if serve_directly:
-					resp = HttpResponse(content_type=content_type)
-					resp[settings.INTERNAL_MEDIA_HEADER] = os.path.join(settings.INTERNAL_MEDIA_LOCATION, file_field.name)
-					# if the filefield does not start with '/' it is likely a http address (S3) instead of path
-					# and because of that we set the redirect url
-					if not file_field.url.startswith('/'):
-						resp['redirect_url'] = file_field.url
+					# Ranges are handled by the server which serves the file
+					resp = downloads.get_direct_response(served_file.storage, served_file.name, content_type)
 				else:
-					file_handle = file_field.open('rb')
-					resp = FileResponse(file_handle, content_type=content_type)
-					if is_video:
-						resp['Accept-Ranges'] = 'bytes'
+					file_handle = served_file.open('rb')
+					size = served_file.size
+					try:
+						byte_range = downloads.parse_range(request, size, etag, last_modified)
+					except downloads.RangeNotSatisfiable:
+						file_handle.close()
+						resp = HttpResponse(status=416)
+						resp['Content-Range'] = 'bytes */{}'.format(size)
+						return resp
+
+					if byte_range is None:
+						resp = FileResponse(file_handle, content_type=content_type)
+					else:
+						start, end = byte_range
+						resp = StreamingHttpResponse(downloads.FileRange(file_handle, start, end), status=206, content_type=content_type)
+						resp['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+						resp['Content-Length'] = str(end - start + 1)
+					resp['Accept-Ranges'] = 'bytes'
+
+				downloads.set_validators(resp, etag, last_modified)
+				if cache_control is not None:
+					resp['Cache-Control'] = cache_control
 			except FileNotFoundError:
 				logger.error('Expected file {} not found'.format(file_field.name))
 				raise BinderNotFound(file_field_name)
@@ -2939,7 +3149,9 @@ class ModelView(View):
 		if request.method == 'POST':
 			try:
 				# Take an arbitrary uploaded file
-				file = next(request.FILES.values())
+				files = request.FILES
+				check_upload(request)
+				file = next(files.values())
 			except StopIteration:
 				raise BinderRequestError('File POST should use multipart/form-data (with an arbitrary key for the file data).')
 
@@ -2953,11 +3165,18 @@ class ModelView(View):
 			# {duplicate-binder-file-field-hash-code}
 			if isinstance(field, BinderFileField):
 				file_field = getattr(obj, file_field_name)
-				path += '?h={}&content_type={}&filename={}'.format(
-					file_field.content_hash,
-					file_field.content_type or '',
-					os.path.basename(file_field.name),
-				)
+				signed_url_max_age = downloads.get_signed_url_max_age()
+				if field.serve_directly and signed_url_max_age:
+					path = downloads.get_signed_url(
+						self.router.model_route(self.model), self.model, field.name,
+						file_field.name, file_field.content_hash, file_field.content_type, signed_url_max_age,
+					)
+				else:
+					path += '?h={}&content_type={}&filename={}'.format(
+						file_field.content_hash,
+						file_field.content_type or '',
+						os.path.basename(file_field.name),
+					)
 
 			return JsonResponse({'data': {file_field_name: path}})
 
@@ -2974,6 +3193,29 @@ class ModelView(View):
 
 
 
+	def _get_thumbnail_source_hash(self, file_field):
+		"""
+		Returns the content hash of the image which thumbnails are made of.
+		"""
+		content_hash = file_field.stored_content_hash or file_field.content_hash
+		if not content_hash:
+			raise FileNotFoundError(file_field.name)
+		return content_hash
+
+
+
+	def _get_thumbnail(self, obj, field, file_field, content_hash, params):
+		"""
+		Returns the file of a thumbnail of the image, which is generated
+		when it is not cached yet.
+		"""
+		name = thumbnails.get_thumbnail(file_field, content_hash, params)
+		thumbnail = FieldFile(obj, field, name)
+		thumbnail.storage = default_storage
+		return thumbnail
+
+
+
 	def filefield_get_name(self, instance=None, request=None, file_field=None):
 		try:
 			method = getattr(self, 'filefield_get_name_' + file_field.field.name)
@@ -3000,20 +3242,24 @@ class ModelView(View):
 			return history.view_changesets(request, changesets.order_by('-id'), self.model, pk)
 
 
-	@list_route('stats', methods=['GET'])
-	def stats_view(self, request):
+	def _get_stats_include_annotations(self):
 		# We only apply annotations when used, so we can just pretend everything is included to simplify stuff
 		try:
 			annotations = self.model.Annotations
 		except AttributeError:
-			include_annotations = {'': []}
+			return {'': []}
 		else:
-			include_annotations = {'': [
+			return {'': [
 				attr
 				for attr in dir(annotations)
 				if not (attr.startswith('__') and attr.endswith('__'))
 			]}
 
+
+	@list_route('stats', methods=['GET'])
+	def stats_view(self, request):
+		include_annotations = self._get_stats_include_annotations()
+
 		queryset, annotations = self._get_filtered_queryset_base(request, None, include_annotations)
 
 		try:
@@ -3023,23 +3269,201 @@ class ModelView(View):
 		else:
 			stats = stats.split(',')
 
-		return JsonResponse({
-			stat: self._get_stat(request, queryset, stat, annotations.copy(), include_annotations)
-			for stat in stats
-		})
+		if self.stats_cache_timeout:
+			return JsonResponse(self._get_cached_stats(request, queryset, stats, annotations, include_annotations))
 
+		return JsonResponse(self._get_stats(request, queryset, stats, annotations, include_annotations))
 
-	def _get_stat(self, request, queryset, stat, annotations, include_annotations):
-		# NOTE: uses annotations! If called multiple times, provide a copy
-		# Get stat definition
+
+	def _get_cached_stats(self, request, queryset, names, annotations, include_annotations):
+		"""
+		Like _get_stats, but gets the stats from the stats cache when possible.
+		Every stat gets a cached flag, telling whether it came from the cache.
+		"""
+		prefix = stats_cache.get_key(self, queryset, [self.model, *self.stats_cache_models])
+		if prefix is None:
+			result = self._get_stats(request, queryset, names, annotations, include_annotations)
+			return {name: {**value, 'cached': False} for name, value in result.items()}
+
+		keys = {name: f'{prefix}:{name}' for name in names}
+		cached = stats_cache.get_many(keys.values())
+
+		missing = [name for name in keys if keys[name] not in cached]
+		result = {}
+		if missing:
+			result = self._get_stats(request, queryset, missing, annotations, include_annotations)
+			stats_cache.set_many({keys[name]: value for name, value in result.items()}, self.stats_cache_timeout)
+
+		return {
+			name: (
+				{**cached[keys[name]], 'cached': True}
+				if keys[name] in cached else
+				{**result[name], 'cached': False}
+			)
+			for name in names
+		}
+
+
+	def _get_stats(self, request, queryset, names, annotations, include_annotations):
+		"""
+		Get the stats with the given names, with as few queries as possible.
+
+		Stats without group_by are computed with a single aggregate() call,
+		where the filters of a stat become the filter of its aggregate.
+		Grouped stats with the same group_by and filters are computed with a
+		single grouped query. Materialized stats come from their rollup when
+		possible. Other stats (with filters which need a distinct
+		queryset, or an expr which is not a plain aggregate) fall back to
+		_get_stat. Stats which join a to many relation multiply the rows the
+		other stats are computed over, so they are computed on their own.
+		"""
+		result = {}
+		aggregates = {}
+		required_annotations = set()
+		groups = {}
+
+		for name in names:
+			stat = self._get_stat_definition(name)
+
+			if stat.materialized:
+				rollup = stat_rollups.get(self, name, stat, queryset, request)
+				if rollup is not None:
+					if stat.group_by is None:
+						result[name] = {'value': rollup['value'], 'filters': stat.filters}
+					else:
+						result[name] = self._get_grouped_stat_result(stat, rollup['value'])
+					continue
+
+			if stat.group_by is not None:
+				key = (stat.group_by, repr(sorted(stat.filters.items())))
+				if self._stat_joins_to_many(queryset, stat.expr, stat.annotations, annotations, stat.group_by.replace('.', '__')):
+					key += (name,)
+				groups.setdefault(key, []).append(name)
+				continue
+
+			aggregate = self._get_stat_aggregate(request, stat, annotations, include_annotations)
+			if aggregate is not None and self._stat_joins_to_many(queryset, *aggregate, annotations):
+				aggregate = None
+			if aggregate is None:
+				result[name] = self._get_stat(request, queryset, name, annotations.copy(), include_annotations)
+			else:
+				aggregates[name], stat_annotations = aggregate
+				required_annotations.update(stat_annotations)
+
+		if aggregates:
+			aggregate_queryset = queryset
+			aggregate_annotations = annotations.copy()
+			for key in required_annotations:
+				try:
+					expr = aggregate_annotations.pop(key)
+				except KeyError:
+					pass
+				else:
+					aggregate_queryset = aggregate_queryset.annotate(**{key: expr})
+
+			aliases = {name: f'_binder_stat_{i}' for i, name in enumerate(aggregates)}
+			values = aggregate_queryset.aggregate(**{aliases[name]: expr for name, expr in aggregates.items()})
+			for name in aggregates:
+				result[name] = {
+					'value': values[aliases[name]],
+					'filters': self._get_stat_definition(name).filters,
+				}
+
+		for group_names in groups.values():
+			stats = [self._get_stat_definition(name) for name in group_names]
+			group_annotations = annotations.copy()
+			group_queryset = self._filter_stat_queryset(request, queryset, stats[0], group_annotations, include_annotations)
+			for stat in stats[1:]:
+				for key in stat.annotations:
+					try:
+						expr = group_annotations.pop(key)
+					except KeyError:
+						pass
+					else:
+						group_queryset = group_queryset.annotate(**{key: expr})
+
+			group_by = stats[0].group_by.replace('.', '__')
+			aliases = [f'_binder_stat_{i}' for i in range(len(stats))]
+			values = [{} for _ in stats]
+			for key, *stat_values in (
+				group_queryset
+				.order_by()
+				.exclude(**{group_by: None})
+				.values(group_by)
+				.annotate(**{alias: stat.expr for alias, stat in zip(aliases, stats)})
+				.values_list(group_by, *aliases)
+			):
+				# The jsonloads/jsondumps is to make sure we can handle different
+				# types as keys, an example is dates.
+				key = jsonloads(jsondumps(key))
+				for value, stat_value in zip(values, stat_values):
+					value[key] = stat_value
+
+			for name, stat, value in zip(group_names, stats, values):
+				result[name] = self._get_grouped_stat_result(stat, value)
+
+		return {name: result[name] for name in names}
+
+
+	def _get_stat_definition(self, name):
 		try:
-			stat = self.stats[stat]
+			return self.stats[name]
 		except KeyError:
 			try:
-				stat = DEFAULT_STATS[stat]
+				return DEFAULT_STATS[name]
 			except KeyError:
-				raise BinderRequestError(f'unknown stat: {stat}')
+				raise BinderRequestError(f'unknown stat: {name}')
+
 
+	def _stat_joins_to_many(self, queryset, expr, stat_annotations, annotations, group_by=None):
+		"""
+		Returns whether the expression of a stat, or the annotations it
+		needs, add a join over a to many relation to the queryset.
+		"""
+		probe = queryset
+		for key in stat_annotations:
+			if key in annotations:
+				probe = probe.annotate(**{key: annotations[key]})
+		if group_by is not None:
+			queryset = queryset.values(group_by)
+			probe = probe.values(group_by)
+		probe = probe.annotate(_binder_stat=expr)
+		return bool(get_multi_valued_aliases(probe) - get_multi_valued_aliases(queryset))
+
+
+	def _get_stat_aggregate(self, request, stat, annotations, include_annotations):
+		"""
+		Returns the aggregate of a stat without group_by, with the filters of
+		the stat as filter of the aggregate, and the names of the annotations
+		it needs. Returns None when the stat can not be computed like this.
+		"""
+		if not stat.filters:
+			return stat.expr, stat.annotations
+
+		if not isinstance(stat.expr, models.Aggregate) or not isinstance(stat.expr.filter, (Q, type(None))):
+			return None
+
+		stat_filter = None
+		stat_annotations = list(stat.annotations)
+		for key, value in stat.filters.items():
+			q, distinct = self._parse_filter(key, value, request, include_annotations)
+			if distinct:
+				# The filter joins a to many relation, only the rows of a
+				# distinct queryset can be aggregated
+				return None
+			for lookup in q_get_flat_filters(q):
+				head = lookup.split('__', 1)[0]
+				if head in annotations:
+					stat_annotations.append(head)
+			stat_filter = q if stat_filter is None else stat_filter & q
+
+		expr = stat.expr.copy()
+		expr.filter = stat_filter if expr.filter is None else expr.filter & stat_filter
+		return expr, stat_annotations
+
+
+	def _filter_stat_queryset(self, request, queryset, stat, annotations, include_annotations):
+		# NOTE: uses annotations! If called multiple times, provide a copy
 		# Apply filters
 		for key, value in stat.filters.items():
 			q, distinct = self._parse_filter(key, value, request, include_annotations)
@@ -3056,6 +3480,16 @@ class ModelView(View):
 			else:
 				queryset = queryset.annotate(**{key: expr})
 
+		return queryset
+
+
+	def _get_stat(self, request, queryset, stat, annotations, include_annotations):
+		# NOTE: uses annotations! If called multiple times, provide a copy
+		# Get stat definition
+		stat = self._get_stat_definition(stat)
+
+		queryset = self._filter_stat_queryset(request, queryset, stat, annotations, include_annotations)
+
 		if stat.group_by is None:
 			# No group by so just return a simple stat
 			return {
@@ -3079,6 +3513,10 @@ class ModelView(View):
 			)
 		}
 
+		return self._get_grouped_stat_result(stat, value)
+
+
+	def _get_grouped_stat_result(self, stat, value):
 		other = 0
 		if stat.min_value is not None:
 			min_value = stat.min_value * sum(value.values())
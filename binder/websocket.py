@@ -1,61 +1,415 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
 from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
 
 from .json import jsondumps
 import requests
 from requests.exceptions import RequestException
 
 
+logger = logging.getLogger(__name__)
+
+
 class RoomController(object):
-    def __init__(self):
+    """
+    Collects the rooms a user may subscribe to from the get_rooms_for_user
+    of all registered views.
+
+    Views may also implement get_rooms_for_users(users), returning a list
+    with the rooms of every user in the same order, which is used to list
+    the rooms of many users at once.
+
+    When cache_timeout (in seconds) is given, the rooms of a user are cached
+    for that long. Call invalidate() when the rooms of users change, or use
+    invalidate_on() to do so whenever instances of a model change.
+    """
+
+    def __init__(self, cache_timeout=0, cache_size=10000):
         self.room_listings = []
+        self.cache_timeout = cache_timeout
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
 
     def register(self, superclass):
         for view in superclass.__subclasses__():
             if view.register_for_model and view.model is not None:
                 listing = getattr(view, 'get_rooms_for_user', None)
+                batch_listing = getattr(view, 'get_rooms_for_users', None)
+
+                if not (batch_listing and callable(batch_listing)):
+                    batch_listing = None
+                if not (listing and callable(listing)):
+                    listing = None
 
-                if listing and callable(listing):
-                    self.room_listings.append(listing)
+                if listing or batch_listing:
+                    self.room_listings.append((listing, batch_listing))
 
             self.register(view)
 
         return self
 
+    def _merge(self, room_lists):
+        # Deduplicate rooms, keeping the order in which they were listed
+        rooms = OrderedDict()
+        for room_list in room_lists:
+            for room in room_list:
+                rooms.setdefault(jsondumps(room), room)
+        return list(rooms.values())
+
+    def _cache_get(self, key):
+        if not self.cache_timeout or key is None:
+            return None
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return list(entry[1])
+
+    def _cache_set(self, key, rooms):
+        if not self.cache_timeout or key is None:
+            return
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_timeout, list(rooms))
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
     def list_rooms_for_user(self, user):
-        rooms = []
+        key = getattr(user, 'pk', None)
+        rooms = self._cache_get(key)
+        if rooms is not None:
+            return rooms
 
-        for listing in self.room_listings:
-            rooms += listing(user)
+        room_lists = []
+        for listing, batch_listing in self.room_listings:
+            if listing:
+                room_lists.append(listing(user))
+            else:
+                room_lists.append(batch_listing([user])[0])
 
+        rooms = self._merge(room_lists)
+        self._cache_set(key, rooms)
         return rooms
 
+    def list_rooms_for_users(self, users):
+        """
+        Returns a list with the rooms of every user, in the same order as
+        users. Views implementing get_rooms_for_users are called once for
+        all users which are not cached.
+        """
+        result = [self._cache_get(getattr(user, 'pk', None)) for user in users]
+        missing = [i for i, rooms in enumerate(result) if rooms is None]
+        if not missing:
+            return result
 
-def trigger(data, rooms):
-    if 'rabbitmq' in getattr(settings, 'HIGH_TEMPLAR', {}):
-        connection = None
+        missing_users = [users[i] for i in missing]
+        room_lists = [[] for _ in missing]
+        for listing, batch_listing in self.room_listings:
+            if batch_listing:
+                listed = batch_listing(missing_users)
+            else:
+                listed = [listing(user) for user in missing_users]
+            for room_list, rooms in zip(room_lists, listed):
+                room_list.append(rooms)
+
+        for i, user, room_list in zip(missing, missing_users, room_lists):
+            result[i] = self._merge(room_list)
+            self._cache_set(getattr(user, 'pk', None), result[i])
+        return result
+
+    def invalidate(self, *users):
+        """
+        Remove the cached rooms of the given users (or user ids), or of all
+        users when called without arguments.
+        """
+        with self._lock:
+            if not users:
+                self._cache.clear()
+            for user in users:
+                self._cache.pop(getattr(user, 'pk', user), None)
+
+    def invalidate_on(self, *models):
+        """
+        Clear the cache whenever an instance of one of the models is saved
+        or deleted, for models which determine the rooms of users. For m2m
+        fields, pass the through model.
+        """
+        for model in models:
+            for signal in (post_save, post_delete, m2m_changed):
+                signal.connect(self._invalidate_receiver, sender=model, weak=False)
+        return self
+
+    def _invalidate_receiver(self, sender, **kwargs):
+        self.invalidate()
+
+
+class RabbitMQPublisher(object):
+    """
+    Publishes triggers to RabbitMQ over a pool of persistent connections.
+
+    pika connections are not thread safe, so every publish takes a connection
+    (with its channel) out of the pool and returns it afterwards. At most
+    pool_size idle connections are kept open. A pooled connection which was
+    closed in the meantime (for example by the broker after missed
+    heartbeats) is replaced by a new one, and the publish is retried.
+    """
+
+    def __init__(self, pool_size=4):
+        self.pool_size = pool_size
+        self._pool = []
+        self._lock = threading.Lock()
+        self._key = None
+        self._pid = None
+
+    def _get_key(self):
+        config = settings.HIGH_TEMPLAR['rabbitmq']
+        return (config['host'], config['username'], config['password'])
+
+    def _connect(self, key):
+        import pika
+        host, username, password = key
+        connection_credentials = pika.PlainCredentials(username, password)
+        connection_parameters = pika.ConnectionParameters(host, credentials=connection_credentials)
+        connection = pika.BlockingConnection(parameters=connection_parameters)
+        return connection, connection.channel()
+
+    def _close(self, connection):
         try:
-            import pika
-            from pika import BlockingConnection
-            connection_credentials = pika.PlainCredentials(settings.HIGH_TEMPLAR['rabbitmq']['username'],
-                                                           settings.HIGH_TEMPLAR['rabbitmq']['password'])
-            connection_parameters = pika.ConnectionParameters(settings.HIGH_TEMPLAR['rabbitmq']['host'],
-                                                              credentials=connection_credentials)
-            connection = BlockingConnection(parameters=connection_parameters)
-            channel = connection.channel()
-
-            channel.basic_publish('hightemplar', routing_key='*', body=jsondumps({
-                'data': data,
-                'rooms': rooms,
-            }))
-        finally:
-            if connection and not connection.is_closed:
+            if not connection.is_closed:
                 connection.close()
+        except Exception:
+            pass
+
+    def _acquire(self, key):
+        """
+        Returns a (connection, channel, pooled) tuple.
+        """
+        stale = []
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked, the sockets of the pool are shared with the parent
+                self._pool = []
+                self._pid = os.getpid()
+            if self._key != key:
+                # Settings changed, so the pool connects to the wrong broker
+                stale, self._pool = self._pool, []
+                self._key = key
+
+            pooled = None
+            while self._pool:
+                connection, channel = self._pool.pop()
+                if connection.is_open and channel.is_open:
+                    pooled = (connection, channel, True)
+                    break
+                stale.append((connection, channel))
+
+        for connection, _ in stale:
+            self._close(connection)
+
+        if pooled is not None:
+            return pooled
+        return self._connect(key) + (False,)
+
+    def _release(self, key, connection, channel):
+        with self._lock:
+            if key == self._key and len(self._pool) < self.pool_size:
+                self._pool.append((connection, channel))
+                return
+        self._close(connection)
+
+    def publish(self, body):
+        from pika.exceptions import AMQPError
+
+        key = self._get_key()
+        while True:
+            connection, channel, pooled = self._acquire(key)
+            try:
+                channel.basic_publish('hightemplar', routing_key='*', body=body)
+            except AMQPError:
+                self._close(connection)
+                if pooled:
+                    # The connection may have gone stale while it was in
+                    # the pool, try again with the next one.
+                    continue
+                raise
+            except BaseException:
+                self._close(connection)
+                raise
+            self._release(key, connection, channel)
+            return
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, []
+        for connection, _ in pool:
+            self._close(connection)
+
+
+rabbitmq_publisher = RabbitMQPublisher()
+
+_http = threading.local()
+
+
+def get_http_session():
+    """
+    Returns the requests session of the current thread, which keeps the
+    connections to HIGH_TEMPLAR_URL alive between triggers.
+    """
+    session = getattr(_http, 'session', None)
+    if session is None:
+        session = _http.session = requests.Session()
+    return session
+
+
+def trigger(data, rooms):
+    body = jsondumps({
+        'data': data,
+        'rooms': rooms,
+    })
+    if 'rabbitmq' in getattr(settings, 'HIGH_TEMPLAR', {}):
+        rabbitmq_publisher.publish(body)
     if getattr(settings, 'HIGH_TEMPLAR_URL', None):
         url = getattr(settings, 'HIGH_TEMPLAR_URL')
         try:
-            requests.post('{}/trigger/'.format(url), data=jsondumps({
-                'data': data,
-                'rooms': rooms,
-            }))
+            get_http_session().post('{}/trigger/'.format(url), data=body)
         except RequestException:
             pass
+
+
+class TriggerMetrics(object):
+    """
+    Counts the triggers queued by trigger_on_commit, and the messages that
+    were actually sent for them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.sent = 0
+
+    def record(self, queued, sent):
+        with self._lock:
+            self.queued += queued
+            self.sent += sent
+
+    @property
+    def collapsed(self):
+        return self.queued - self.sent
+
+    def reset(self):
+        with self._lock:
+            self.queued = 0
+            self.sent = 0
+
+
+trigger_metrics = TriggerMetrics()
+
+
+class TriggerBatch(object):
+    """
+    The triggers queued during one transaction. Triggers with the same data
+    are collapsed into one message, published to the union of their rooms.
+    """
+
+    def __init__(self):
+        self.messages = {}
+        self.queued = 0
+
+    def add(self, data, rooms):
+        self.queued += 1
+        message = self.messages.setdefault(jsondumps(data), (data, {}))
+        for room in rooms:
+            message[1].setdefault(jsondumps(room), room)
+
+    def flush(self):
+        messages = [(data, list(rooms.values())) for data, rooms in self.messages.values()]
+        trigger_metrics.record(self.queued, len(messages))
+        self.messages = {}
+        self.queued = 0
+
+        if getattr(settings, 'HIGH_TEMPLAR_TRIGGER_IN_BACKGROUND', False):
+            trigger_worker.put(messages)
+        else:
+            send_triggers(messages)
+
+
+class TriggerWorker(object):
+    """
+    Sends batches of triggers from a background thread, so the request does
+    not wait for them.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put(self, messages):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='binder-websocket-trigger', daemon=True)
+                self._thread.start()
+        self._queue.put(messages)
+
+    def join(self):
+        """
+        Wait until all queued batches are sent.
+        """
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            messages = self._queue.get()
+            try:
+                send_triggers(messages)
+            except Exception:
+                logger.exception('Error sending websocket triggers')
+            finally:
+                self._queue.task_done()
+
+
+trigger_worker = TriggerWorker()
+
+
+def send_triggers(messages):
+    for data, rooms in messages:
+        trigger(data, rooms)
+
+
+def trigger_on_commit(data, rooms, using=None):
+    """
+    Like trigger, but only sends the trigger when the current transaction
+    commits, and not at all when it is rolled back. All triggers of a
+    transaction are sent together, with duplicates collapsed (see
+    TriggerBatch). Outside of a transaction the trigger is sent immediately.
+
+    Note that triggers queued inside a savepoint which is rolled back are
+    still sent when the outer transaction commits.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        trigger_metrics.record(1, 1)
+        trigger(data, rooms)
+        return
+
+    batch = getattr(connection, 'binder_trigger_batch', None)
+    # When the transaction was rolled back, the hook of the batch is gone
+    if batch is None or not any(hook[1] == batch.flush for hook in connection.run_on_commit):
+        batch = connection.binder_trigger_batch = TriggerBatch()
+        transaction.on_commit(batch.flush, using=using)
+    batch.add(data, rooms)
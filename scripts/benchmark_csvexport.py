@@ -0,0 +1,96 @@
+#! /usr/bin/python3
+"""
+Benchmark the row generation of CsvExportView, for typical column shapes.
+
+Usage: scripts/benchmark_csvexport.py [rows] [columns]
+
+This only measures turning get() style data into rows, no database is used.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import django # noqa
+from django.conf import settings # noqa
+
+settings.configure(INSTALLED_APPS=[
+	'django.contrib.auth',
+	'django.contrib.contenttypes',
+	'binder',
+])
+django.setup()
+
+from binder.plugins.views.csvexport import CsvExportView # noqa
+
+
+
+def make_data(rows):
+	caretakers = [{'id': i, 'name': 'caretaker {}'.format(i), 'contact': {'phone': str(i)}} for i in range(100)]
+	animals = [{'id': i, 'name': 'animal {}'.format(i), 'caretaker': i % 100} for i in range(1000)]
+	data = [
+		{
+			'id': i,
+			'name': 'zoo {}'.format(i),
+			'founded': '2000-01-01',
+			'visitors': i * 10,
+			'address': {'street': 'street {}'.format(i), 'city': 'city {}'.format(i % 50)},
+			'director': i % 100,
+			'animals': [(i + j) % 1000 for j in range(3)],
+		}
+		for i in range(rows)
+	]
+	return {
+		'data': data,
+		'with': {'caretaker': caretakers, 'animal': animals},
+		'with_mapping': {'director': 'caretaker', 'animals': 'animal', 'animals.caretaker': 'caretaker'},
+	}
+
+
+
+SHAPES = {
+	'field': ['id', 'name', 'founded', 'visitors'],
+	'nested dict': ['address.street', 'address.city'],
+	'to one': ['director.name', 'director.contact.phone'],
+	'to many': ['animals.name', 'animals.caretaker.name'],
+	'callback': ['name'],
+}
+
+
+
+def column_map(keys, columns, callback=False):
+	result = []
+	for i in range(columns):
+		key = keys[i % len(keys)]
+		if callback:
+			result.append((key, 'column {}'.format(i), lambda value, row, mapping: value.upper()))
+		else:
+			result.append((key, 'column {}'.format(i)))
+	return result
+
+
+
+def run(view, parent_data, columns):
+	start = time.perf_counter()
+	for _ in view._get_rows(parent_data):
+		pass
+	return time.perf_counter() - start
+
+
+
+if __name__ == '__main__':
+	rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	columns = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+	parent_data = make_data(rows)
+	view = CsvExportView()
+
+	print('{} rows x {} columns'.format(rows, columns))
+	all_keys = [key for name, keys in SHAPES.items() if name != 'callback' for key in keys]
+	shapes = dict(SHAPES, mixed=all_keys)
+	for name, keys in shapes.items():
+		view.csv_settings = CsvExportView.CsvExportSettings([], column_map(keys, columns, callback=name == 'callback'))
+		duration = run(view, parent_data, columns)
+		print('  {:<12} {:>8.3f}s {:>10.0f} rows/s'.format(name, duration, rows / duration))
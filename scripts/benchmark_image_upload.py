@@ -0,0 +1,97 @@
+#! /usr/bin/python3
+"""
+Benchmark ModelView._clean_image_file on large phone photos.
+
+Usage: scripts/benchmark_image_upload.py [runs]
+
+Every photo is a JPEG with an EXIF orientation (like phones make them),
+which is rotated and resized to the resize threshold. Every run is done in
+a forked process, to measure its CPU time and the growth of the peak
+memory (max RSS) of that process.
+"""
+
+import os
+import resource
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import django # noqa
+from django.conf import settings # noqa
+
+settings.configure(INSTALLED_APPS=[
+	'django.contrib.auth',
+	'django.contrib.contenttypes',
+	'binder',
+])
+django.setup()
+
+from django.core.files.uploadedfile import SimpleUploadedFile # noqa
+from PIL import Image # noqa
+
+from binder.views import ModelView # noqa
+
+
+
+PHOTOS = {
+	'12 MP': (4000, 3000),
+	'24 MP': (6000, 4000),
+	'48 MP': (8000, 6000),
+}
+
+
+
+def make_photo(width, height):
+	# Noise on gradients, so it compresses like a photo
+	r = Image.linear_gradient('L').resize((width, height))
+	g = Image.effect_noise((width, height), 40)
+	b = r.transpose(Image.ROTATE_180)
+	img = Image.merge('RGB', (r, g, b))
+
+	exif = Image.Exif()
+	exif[0x0112] = 6
+	with BytesIO() as f:
+		img.save(f, 'jpeg', quality=90, exif=exif.tobytes())
+		return f.getvalue()
+
+
+
+def run(view, content):
+	read, write = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read)
+		value = SimpleUploadedFile('photo.jpg', content)
+		rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		cpu_start = time.process_time()
+		view._clean_image_file('picture', value)
+		cpu = time.process_time() - cpu_start
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+		os.write(write, '{} {}'.format(cpu, rss).encode())
+		os._exit(0)
+
+	os.close(write)
+	with os.fdopen(read) as f:
+		cpu, rss = f.read().split()
+	os.waitpid(pid, 0)
+	# ru_maxrss is in KB on Linux
+	return float(cpu), int(rss) / 1024
+
+
+
+if __name__ == '__main__':
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+
+	view = ModelView()
+	view.image_resize_threshold = 1024
+	view.image_size_limit = 8192
+
+	print('{:<8} {:>9} {:>10} {:>14}'.format('photo', 'size', 'cpu', 'peak memory'))
+	for name, (width, height) in PHOTOS.items():
+		content = make_photo(width, height)
+		results = [run(view, content) for _ in range(runs)]
+		cpu = min(cpu for cpu, rss in results)
+		rss = min(rss for cpu, rss in results)
+		print('{:<8} {:>7.1f}MB {:>9.3f}s {:>11.1f}MB'.format(name, len(content) / 10**6, cpu, rss))
@@ -54,6 +54,7 @@ if not settings.configured:
 			'django.contrib.sessions',
 			'binder',
 			'binder.plugins.token_auth',
+			'binder.plugins.export_jobs',
 			'tests',
 			'tests.testapp',
 		],
@@ -64,6 +65,7 @@ if not settings.configured:
 			'contenttypes': None,
 			'binder': None,
 			'token_auth': None,
+			'export_jobs': None,
 		},
 		'USE_TZ': True,
 		'TIME_ZONE': 'UTC',
@@ -1,5 +1,5 @@
 from PIL import Image
-from binder.plugins.views.csvexport import ExcelFileAdapter
+from binder.plugins.views.csvexport import ExcelFileAdapter, RequestAwareAdapter, CsvExportView
 from os import urandom
 from tempfile import NamedTemporaryFile
 import io
@@ -10,10 +10,27 @@ from django.contrib.auth.models import User
 
 from ..testapp.models import Picture, Animal, Caretaker
 from ..testapp.views import PictureView
+from ..utils import CommittingTestCase, temp_imagefile
 import csv
 import openpyxl
 
-class CsvExportTest(TestCase):
+class StreamingMixin:
+
+	def _streaming(self, limit=None):
+		csv_settings = PictureView.csv_settings
+		old_settings = (csv_settings.streaming, csv_settings.chunk_size, csv_settings.limit, csv_settings.csv_adapter)
+		# The download_csv and download_excel endpoints change the adapter
+		csv_settings.csv_adapter = RequestAwareAdapter
+		csv_settings.streaming = True
+		csv_settings.chunk_size = 2
+		csv_settings.limit = limit
+
+		def restore():
+			csv_settings.streaming, csv_settings.chunk_size, csv_settings.limit, csv_settings.csv_adapter = old_settings
+		self.addCleanup(restore)
+
+
+class CsvExportTest(StreamingMixin, TestCase):
 
 	@staticmethod
 	def image(width, height):
@@ -206,7 +223,145 @@ class CsvExportTest(TestCase):
 
 		PictureView.csv_settings.limit = old_limit;
 
+	def test_streaming_csv_download(self):
+		self._streaming()
+		PictureView.csv_settings.streaming = False
+		expected = self.client.get('/picture/download/').content.decode('utf-8')
+
+		PictureView.csv_settings.streaming = True
+		response = self.client.get('/picture/download/')
+		self.assertEqual(200, response.status_code)
+		self.assertTrue(response.streaming)
+		self.assertEqual('attachment; filename="download.csv"', response['Content-Disposition'])
+		content = b''.join(response.streaming_content).decode('utf-8')
+
+		self.assertEqual(expected, content)
+		data = list(csv.reader(io.StringIO(content)))
+		self.assertEqual(4, len(data))
+		self.assertEqual(data[3], [str(self.pictures[2].id), str(self.pictures[2].animal_id), str(self.pictures[2].id ** 2)])
+
+	def test_streaming_csv_download_limit(self):
+		self._streaming(limit=1)
+		response = self.client.get('/picture/download/')
+		self.assertEqual(200, response.status_code)
+		data = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+
+		self.assertEqual(2, len(data))
+		self.assertEqual(data[1], [str(self.pictures[0].id), str(self.pictures[0].animal_id), str(self.pictures[0].id ** 2)])
+
+	def test_streaming_csv_download_filtered_and_ordered(self):
+		self._streaming()
+		response = self.client.get('/picture/download/?order_by=-id&.id:not={}'.format(self.pictures[1].id))
+		self.assertEqual(200, response.status_code)
+		data = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+
+		self.assertEqual([str(self.pictures[2].id), str(self.pictures[0].id)], [row[0] for row in data[1:]])
+
+	def test_streaming_excel_download(self):
+		self._streaming()
+		response = self.client.get('/picture/download/?response_type=xlsx')
+		self.assertEqual(200, response.status_code)
+
+		with NamedTemporaryFile(suffix='.xlsx') as tmp:
+			tmp.write(b''.join(response.streaming_content))
+			tmp.flush()
+
+			wb = openpyxl.load_workbook(tmp.name)
+			self.assertEqual(1, len(wb._sheets))
+			_values = list(wb._sheets[0].values)
+
+			self.assertEqual(list(_values[0]), ['picture identifier', 'animal identifier', 'squared picture identifier'])
+			for i, picture in enumerate(self.pictures):
+				self.assertEqual(list(_values[i + 1]), [picture.id, str(picture.animal_id), picture.id ** 2])
+
+class StreamingCommitTest(StreamingMixin, CommittingTestCase):
+	"""
+	The chunks after the first are exported after the transaction of the
+	request was committed.
+	"""
+
+	def setUp(self):
+		super().setUp()
+		animal = Animal.objects.create(name='test')
+		self.addCleanup(animal.delete)
+		self.pictures = []
+		for i in range(5):
+			picture = Picture(animal=animal)
+			with temp_imagefile(10, 10, 'jpeg') as file:
+				picture.file.save('picture.jpg', File(file), save=False)
+				picture.original_file.save('picture_copy.jpg', File(file), save=False)
+			picture.save()
+			self.addCleanup(picture.delete)
+			self.pictures.append(picture)
+
+		u = User(username='testuser', is_active=True, is_superuser=True)
+		u.set_password('test')
+		u.save()
+		self.addCleanup(u.delete)
+		self.client = Client()
+		self.assertTrue(self.client.login(username='testuser', password='test'))
+		self.addCleanup(self.client.logout)
+
+		self._streaming()
+
+	def test_streaming_more_than_chunk_size(self):
+		response = self.client.get('/picture/download/')
+		self.assertEqual(200, response.status_code)
+		data = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+
+		self.assertEqual([str(p.id) for p in self.pictures], [row[0] for row in data[1:]])
+
+
 class TestExcelFileAdapter(TestCase):
     def test_one_sheet_after_init(self):
         file_adapter = ExcelFileAdapter(None)
         self.assertEqual(len(file_adapter.work_book.worksheets), 1)
+
+
+class TestColumnAccessors(TestCase):
+	def setUp(self):
+		self.view = CsvExportView()
+		self.parent_data = {
+			'data': [
+				{'id': 1, 'name': 'Artis', 'address': {'city': 'Amsterdam'}, 'director': 10, 'animals': [20, 21]},
+				{'id': 2, 'name': 'Blijdorp', 'address': {'city': 'Rotterdam'}, 'director': 11, 'animals': []},
+			],
+			'with': {
+				'caretaker': [{'id': 10, 'name': 'Foo', 'contact': {'phone': '123'}}, {'id': 11, 'name': 'Bar', 'contact': {'phone': '456'}}],
+				'animal': [{'id': 20, 'name': 'Lion', 'caretaker': 10}, {'id': 21, 'name': 'Tiger', 'caretaker': 11}],
+			},
+			'with_mapping': {
+				'director': 'caretaker',
+				'animals': 'animal',
+				'animals.caretaker': 'caretaker',
+			},
+		}
+
+	def rows(self, column_map):
+		self.view.csv_settings = CsvExportView.CsvExportSettings([], column_map, multi_value_delimiter=', ')
+		return list(self.view._get_rows(self.parent_data))
+
+	def test_column_shapes(self):
+		self.assertEqual([
+			[1, 'Amsterdam', 'Foo', '123', 'Lion, Tiger', 'Foo, Bar', 'ARTIS'],
+			[2, 'Rotterdam', 'Bar', '456', '', '', 'BLIJDORP'],
+		], self.rows([
+			('id', 'ID'),
+			('address.city', 'City'),
+			('director.name', 'Director'),
+			('director.contact.phone', 'Phone'),
+			('animals.name', 'Animals'),
+			('animals.caretaker.name', 'Caretakers'),
+			('name', 'Name', lambda name, row, mapping: name.upper()),
+		]))
+
+	def test_callback_gets_key_mapping_and_lists_are_joined(self):
+		self.assertEqual([['Lion, Tiger'], ['']], self.rows([
+			('animals', 'Animals', lambda ids, row, mapping: [mapping['animal'][i]['name'] for i in ids]),
+		]))
+
+	def test_missing_key(self):
+		with self.assertRaises(Exception):
+			self.rows([('nonexistent', 'Foo')])
+		with self.assertRaises(Exception):
+			self.rows([('nonexistent.name', 'Foo')])
@@ -0,0 +1,187 @@
+from PIL import Image
+from os import urandom
+from tempfile import NamedTemporaryFile
+from datetime import timedelta
+import csv
+import io
+
+from django.test import TestCase, Client, override_settings
+from django.core.files import File
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.utils import timezone
+import openpyxl
+
+from binder.json import jsonloads
+from binder.plugins.export_jobs.models import ExportJob
+from binder.plugins.views.csvexport import RequestAwareAdapter
+
+from ..testapp.models import Picture, Animal
+from ..testapp.views import PictureView
+from ..utils import CommittingTestCase
+
+
+class ExportJobMixin:
+
+	def setUp(self):
+		super().setUp()
+		animal = Animal(name='test')
+		animal.save()
+
+		self.pictures = []
+		for i in range(3):
+			picture = Picture(animal=animal)
+			with NamedTemporaryFile(suffix='.jpg') as file:
+				Image.frombytes('RGB', (10, 10), urandom(10 * 10 * 3)).save(file, 'jpeg')
+				file.seek(0)
+				picture.file.save('picture.jpg', File(file), save=False)
+				picture.original_file.save('picture_copy.jpg', File(file), save=False)
+			picture.save()
+			self.pictures.append(picture)
+
+		self.user = User(username='testuser', is_active=True, is_superuser=True)
+		self.user.set_password('test')
+		self.user.save()
+		self.client = Client()
+		r = self.client.login(username='testuser', password='test')
+		self.assertTrue(r)
+
+		csv_settings = PictureView.csv_settings
+		old_settings = (csv_settings.background, csv_settings.chunk_size, csv_settings.csv_adapter)
+		# The download_csv and download_excel endpoints change the adapter
+		csv_settings.csv_adapter = RequestAwareAdapter
+		csv_settings.background = True
+		csv_settings.chunk_size = 2
+
+		def restore():
+			csv_settings.background, csv_settings.chunk_size, csv_settings.csv_adapter = old_settings
+		self.addCleanup(restore)
+
+
+class ExportJobTest(ExportJobMixin, TestCase):
+
+	def _run(self):
+		call_command('run_export_jobs', '--once', stdout=io.StringIO())
+
+	def _read(self, job):
+		self.addCleanup(job.file.delete, save=False)
+		with job.file.open('rb') as f:
+			return f.read()
+
+	def test_download_in_background(self):
+		response = self.client.get('/picture/download/?background=true&order_by=-id')
+		self.assertEqual(200, response.status_code)
+		data = jsonloads(response.content)
+		self.assertEqual('queued', data['status'])
+
+		job = ExportJob.objects.get(pk=data['id'])
+		self.assertEqual(self.user, job.user)
+		self.assertEqual('/picture/download/', job.path)
+		self.assertEqual('order_by=-id', job.params)
+
+		self._run()
+
+		job.refresh_from_db()
+		self.assertEqual('done', job.status, job.error)
+		self.assertEqual(3, job.progress)
+		self.assertEqual(3, job.total)
+		self.assertIsNotNone(job.finished_at)
+		self.assertTrue(job.file.name.startswith('export_jobs/download'))
+
+		rows = list(csv.reader(io.StringIO(self._read(job).decode('utf-8'))))
+		self.assertEqual(['picture identifier', 'animal identifier', 'squared picture identifier'], rows[0])
+		self.assertEqual([str(p.id) for p in reversed(self.pictures)], [row[0] for row in rows[1:]])
+
+	def test_download_excel_in_background(self):
+		response = self.client.get('/picture/download/?background=true&response_type=xlsx')
+		self.assertEqual(200, response.status_code)
+
+		self._run()
+
+		job = ExportJob.objects.get(pk=jsonloads(response.content)['id'])
+		self.assertEqual('done', job.status, job.error)
+		self.assertTrue(job.file.name.endswith('.xlsx'))
+
+		with NamedTemporaryFile(suffix='.xlsx') as tmp:
+			tmp.write(self._read(job))
+			tmp.flush()
+			values = list(openpyxl.load_workbook(tmp.name)._sheets[0].values)
+		self.assertEqual(4, len(values))
+
+	def test_job_can_be_downloaded_and_listed(self):
+		response = self.client.get('/picture/download/?background=true')
+		job_id = jsonloads(response.content)['id']
+		self._run()
+		self.addCleanup(lambda: ExportJob.objects.get(pk=job_id).file.delete(save=False))
+
+		response = self.client.get('/export_job/{}/'.format(job_id))
+		self.assertEqual(200, response.status_code)
+		data = jsonloads(response.content)['data']
+		self.assertEqual('done', data['status'])
+		self.assertEqual('/export_job/{}/file/'.format(job_id), data['file'])
+
+		response = self.client.get(data['file'])
+		self.assertEqual(200, response.status_code)
+		self.assertTrue(b''.join(response.streaming_content).startswith(b'picture identifier'))
+
+	def test_background_must_be_enabled(self):
+		PictureView.csv_settings.background = False
+		response = self.client.get('/picture/download/?background=true')
+		self.assertEqual(418, response.status_code)
+		self.assertEqual(0, ExportJob.objects.count())
+
+	def test_invalid_filter_is_rejected_when_queued(self):
+		response = self.client.get('/picture/download/?background=true&.nonexistent=1')
+		self.assertEqual(418, response.status_code)
+		self.assertEqual(0, ExportJob.objects.count())
+
+	def test_failed_job(self):
+		job = ExportJob.objects.create(user=self.user, path='/picture/download/', params='.nonexistent=1')
+		self._run()
+
+		job.refresh_from_db()
+		self.assertEqual('failed', job.status)
+		self.assertIn('RequestError', job.error)
+		self.assertFalse(job.file)
+
+	@override_settings(BINDER_EXPORT_JOB_TIMEOUT=timedelta(hours=1))
+	def test_stale_running_job_is_claimed_again(self):
+		stale = ExportJob.objects.create(user=self.user, path='/picture/download/', status='running')
+		ExportJob.objects.filter(pk=stale.pk).update(started_at=timezone.now() - timedelta(hours=2))
+		running = ExportJob.objects.create(user=self.user, path='/picture/download/', status='running', started_at=timezone.now())
+
+		self.assertEqual(stale, ExportJob.objects.claim())
+		self.assertIsNone(ExportJob.objects.claim())
+		running.refresh_from_db()
+		self.assertEqual('running', running.status)
+
+
+class ExportJobCommitTest(ExportJobMixin, CommittingTestCase):
+	"""
+	The worker reads the streamed export after the transaction of the view
+	was committed.
+	"""
+
+	def setUp(self):
+		super().setUp()
+		self.addCleanup(self.client.logout)
+		self.addCleanup(self.user.delete)
+		for picture in self.pictures:
+			self.addCleanup(picture.delete)
+		self.addCleanup(self.pictures[0].animal.delete)
+
+	def test_job_larger_than_chunk_size(self):
+		response = self.client.get('/picture/download/?background=true')
+		self.assertEqual(200, response.status_code)
+		job = ExportJob.objects.get(pk=jsonloads(response.content)['id'])
+		self.addCleanup(job.delete)
+
+		call_command('run_export_jobs', '--once', stdout=io.StringIO())
+
+		job.refresh_from_db()
+		self.assertEqual('done', job.status, job.error)
+		self.assertEqual(3, job.total)
+		self.addCleanup(job.file.delete, save=False)
+		with job.file.open('rb') as f:
+			rows = list(csv.reader(io.StringIO(f.read().decode('utf-8'))))
+		self.assertEqual([str(p.id) for p in self.pictures], [row[0] for row in rows[1:]])
@@ -0,0 +1,86 @@
+import os
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.test import TestCase, RequestFactory, override_settings
+
+from binder.views import ModelView
+from binder.plugins.views import FileHashView
+from binder.plugins.views.file_hash_view import file_hash_cache
+
+from ..testapp.models import Picture, Animal
+from ..testapp.urls import router
+
+
+class PictureHashView(FileHashView, ModelView):
+	model = Picture
+	register_for_model = False
+	file_fields = ['file', 'original_file']
+
+
+class FileHashViewTest(TestCase):
+
+	def setUp(self):
+		super().setUp()
+		file_hash_cache.clear()
+		self.addCleanup(file_hash_cache.clear)
+
+		self.request = RequestFactory().get('/picture/')
+		self.request.user = User(username='testuser', is_active=True, is_superuser=True)
+		self.view = PictureHashView(router=router)
+
+		out = BytesIO()
+		Image.new('RGB', (10, 10)).save(out, 'jpeg')
+		content = out.getvalue()
+
+		animal = Animal.objects.create(name='test')
+		self.pictures = []
+		for _ in range(3):
+			picture = Picture(animal=animal)
+			picture.file.save('picture.jpg', ContentFile(content), save=False)
+			picture.original_file.save('picture_copy.jpg', ContentFile(content), save=False)
+			picture.save()
+			self.pictures.append(picture)
+
+	def test_list_queries_once(self):
+		with self.assertNumQueries(1):
+			data = self.view._get_objs(Picture.objects.order_by('pk'), self.request)
+
+		for picture, obj in zip(self.pictures, data):
+			url, params = obj['file'].split('?')
+			self.assertEqual('/picture/{}/file/'.format(picture.pk), url)
+			self.assertRegex(params, r'^h=[0-9a-f]{32}&content_type=image/jpeg$')
+
+	def test_stat_cached_per_path(self):
+		with mock.patch('binder.plugins.views.file_hash_view.getmtime', wraps=os.path.getmtime) as getmtime:
+			first = self.view._get_objs(Picture.objects.order_by('pk'), self.request)
+			self.assertEqual(6, getmtime.call_count)
+
+			second = self.view._get_objs(Picture.objects.order_by('pk'), self.request)
+			self.assertEqual(6, getmtime.call_count)
+			self.assertEqual(first, second)
+
+	@override_settings(BINDER_FILE_HASH_CACHE_TIMEOUT=0)
+	def test_stat_cache_disabled(self):
+		with mock.patch('binder.plugins.views.file_hash_view.getmtime', wraps=os.path.getmtime) as getmtime:
+			self.view._get_objs(Picture.objects.order_by('pk'), self.request)
+			self.view._get_objs(Picture.objects.order_by('pk'), self.request)
+			self.assertEqual(12, getmtime.call_count)
+
+	def test_stat_cache_expires(self):
+		path = self.pictures[0].file.path
+		url_hash = file_hash_cache.get_hash(path)
+		os.utime(path, (0, 0))
+		self.assertEqual(url_hash, file_hash_cache.get_hash(path))
+
+		with mock.patch('binder.plugins.views.file_hash_view.time.monotonic', return_value=10 ** 9):
+			self.assertNotEqual(url_hash, file_hash_cache.get_hash(path))
+
+	def test_missing_file_has_no_hash(self):
+		os.unlink(self.pictures[0].file.path)
+		data = self.view._get_objs(Picture.objects.filter(pk=self.pictures[0].pk), self.request)
+		self.assertEqual('/picture/{}/file/?content_type=image/jpeg'.format(self.pictures[0].pk), data[0]['file'])
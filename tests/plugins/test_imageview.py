@@ -1,4 +1,5 @@
 import json
+from unittest import mock
 from PIL import Image
 from os import urandom
 from tempfile import NamedTemporaryFile
@@ -6,8 +7,14 @@ from tempfile import NamedTemporaryFile
 from django.test import TestCase, Client
 from django.core.files import File
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from ..testapp.models import Picture, Animal
+from binder.plugins.views import ImageView
+from binder.plugins.views import image as image_views
+
+from ..testapp.models import Picture, Animal, Zoo
+from ..testapp.views import PictureView
 
 
 
@@ -95,3 +102,82 @@ class ImageTest(TestCase):
 		self.assertEqual((50, 100), original_file.size)
 		picture.original_file.close()
 		picture.file.close()
+
+	def testRotateMultipleInOneQuery(self):
+		pictures = [self._get_picture(50, 100) for _ in range(3)]
+
+		with CaptureQueriesContext(connection) as queries:
+			result = self.client.patch('/picture/rotate/', data=json.dumps({
+				"ids": [p.id for p in pictures] + [pictures[0].id], "angle": -90,
+			}))
+		self.assertEqual(200, result.status_code)
+
+		picture_queries = [q for q in queries.captured_queries if Picture._meta.db_table in q['sql']]
+		self.assertEqual(1, len(picture_queries))
+
+		for picture in pictures:
+			# Rotated once, even though the id was given twice
+			with Image.open(picture.file.path) as file:
+				self.assertEqual((100, 50), file.size)
+
+	def testMissingIdsReportedTogether(self):
+		picture = self._get_picture(50, 100)
+		result = self.client.patch('/picture/rotate/', data=json.dumps({
+			"ids": [picture.id, picture.id + 100, 'foo', picture.id + 101], "angle": -90,
+		}))
+		self.assertEqual(400, result.status_code)
+
+		errors = json.loads(result.content)['errors']['ids']
+		self.assertEqual([
+			'ImageObject with id foo not found',
+			'ImageObject with id {} not found'.format(picture.id + 100),
+			'ImageObject with id {} not found'.format(picture.id + 101),
+		], errors)
+
+		# Nothing was rotated
+		with Image.open(picture.file.path) as file:
+			self.assertEqual((50, 100), file.size)
+
+	def testTransformWithoutWorkers(self):
+		pictures = [self._get_picture(50, 100) for _ in range(3)]
+
+		with mock.patch.object(PictureView, 'image_workers', 1), \
+				mock.patch.object(image_views.image_operations, 'ProcessPoolExecutor') as executor:
+			result = self.client.patch('/picture/crop/', data=json.dumps({
+				"ids": [p.id for p in pictures], "x_1": 10,
+				"x_2": 40, "y_1": 20, "y_2": 30
+			}))
+		self.assertEqual(200, result.status_code)
+
+		executor.assert_not_called()
+		for picture in pictures:
+			with Image.open(picture.file.path) as file:
+				self.assertEqual((30, 10), file.size)
+
+	def testWorkerPoolIsShared(self):
+		self.addCleanup(image_views.image_operations._pools.pop, (3, 'spawn'), None)
+		with mock.patch.object(image_views.image_operations, 'ProcessPoolExecutor') as executor:
+			pool = image_views.image_operations.get_pool(3, 'spawn')
+			self.assertIs(pool, image_views.image_operations.get_pool(3, 'spawn'))
+		executor.assert_called_once()
+		self.assertEqual(3, executor.call_args.kwargs['max_workers'])
+		self.assertEqual('spawn', executor.call_args.kwargs['mp_context'].get_start_method())
+
+	def testContentHashUpdated(self):
+		class ZooImageView(ImageView):
+			model = Zoo
+			image_name = 'binder_picture'
+
+		zoo = Zoo(name='Artis')
+		zoo.binder_picture.save('picture.jpg', File(ImageTest.temp_imagefile(50, 100, 'jpeg')), save=False)
+		zoo.save()
+		old_hash = zoo.binder_picture.content_hash
+
+		view = ZooImageView()
+		images = view._get_images({'ids': [zoo.id]}, None)
+		view._transform_images(images, image_views.image_operations.rotate, lambda image: (90,))
+
+		zoo.refresh_from_db()
+		self.assertNotEqual(old_hash, zoo.binder_picture.stored_content_hash)
+		with zoo.binder_picture.open('rb') as fh:
+			self.assertEqual(zoo.binder_picture.calculate_hash(fh), zoo.binder_picture.stored_content_hash)
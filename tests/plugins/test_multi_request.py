@@ -1,7 +1,9 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.contrib.auth.models import User
 
 from binder.json import jsonloads, jsondumps
+from binder.plugins.views.multi_request import get_dependencies, get_waves, get_handler, parse_request, SubResponse
+from binder.json import JsonResponse
 
 from ..testapp.models import Animal
 
@@ -87,9 +89,121 @@ class MultiRequestTest(TestCase):
 		with self.assertRaises(Animal.DoesNotExist):
 			Animal.objects.get(pk=response[0]['body']['id'])
 
+	def test_handler_is_reused(self):
+		handler = get_handler()
+		self.assertIs(handler, get_handler())
+
+		# Changing the middleware rebuilds the handler
+		with override_settings(MIDDLEWARE=[]):
+			self.assertIsNot(handler, get_handler())
+
+	def test_sub_response_body_is_only_decoded_when_used(self):
+		res_data = SubResponse(JsonResponse({'id': 1, 'name': 'Foo'}))
+		self.assertNotIn('body', res_data)
+		self.assertEqual(
+			{'status': 200, 'body': {'id': 1, 'name': 'Foo'}, 'content_type': 'application/json'},
+			jsonloads(res_data.encode()),
+		)
+		self.assertNotIn('body', res_data)
+
+		self.assertEqual(1, res_data['body']['id'])
+		self.assertEqual(
+			{'status': 200, 'body': {'id': 1, 'name': 'Foo'}, 'content_type': 'application/json'},
+			jsonloads(res_data.encode()),
+		)
+
+	def test_transform_with_whole_response_as_source(self):
+		responses = {0: SubResponse(JsonResponse({'id': 1, 'name': 'Foo'}))}
+		req = parse_request({
+			'method': 'POST',
+			'path': '/animal/',
+			'body': {'name': 'Bar', 'response': None},
+			'transforms': [{'source': [0], 'target': ['body', 'response']}],
+		}, ['POST'], responses, RequestFactory().post('/multi/'))
+		self.assertEqual(
+			{'status': 200, 'body': {'id': 1, 'name': 'Foo'}, 'content_type': 'application/json'},
+			jsonloads(req.body)['response'],
+		)
+
 	def test_invalid_method(self):
 		response = self.client.put(
 			'/multi/', data=b'[]',
 			content_type='application/json',
 		)
 		self.assertEqual(response.status_code, 405)
+
+
+class MultiRequestParallelTest(TestCase):
+	def test_waves(self):
+		requests = [
+			{'method': 'GET', 'path': '/a/'},
+			{'method': 'GET', 'path': '/b/', 'transforms': [{'source': ['a', 'body'], 'target': ['path', 'x']}]},
+			{'method': 'GET', 'path': '/c/'},
+			{'method': 'GET', 'path': '/d/', 'transforms': [
+				{'source': ['b', 'body'], 'target': ['path', 'x']},
+				{'source': [2, 'body'], 'target': ['path', 'y']},
+			]},
+			# Refers to a later request, so this will fail like it does sequentially
+			{'method': 'GET', 'path': '/e/', 'transforms': [{'source': [5, 'body'], 'target': ['path', 'x']}]},
+			{'method': 'GET', 'path': '/f/', 'transforms': 'invalid'},
+		]
+		keys = ['a', 'b', 2, 3, 4, 5]
+
+		dependencies = get_dependencies(keys, requests)
+		self.assertEqual([{}, {'a': 0}, {}, {'b': 1, 2: 2}, {}, {}], dependencies)
+		self.assertEqual([[0, 2, 4, 5], [1], [3]], get_waves(dependencies))
+
+	def test_duplicate_keys_refer_to_last_earlier_request(self):
+		requests = [
+			{'method': 'GET', 'path': '/a/'},
+			{'method': 'GET', 'path': '/b/', 'transforms': [{'source': ['a', 'body'], 'target': ['path', 'x']}]},
+			{'method': 'GET', 'path': '/c/'},
+		]
+
+		self.assertEqual([{}, {'a': 0}, {}], get_dependencies(['a', 1, 'a'], requests))
+
+	@override_settings(BINDER_MULTI_REQUEST_WORKERS=4)
+	def test_parallel_get_batch(self):
+		requests = [
+			{'method': 'GET', 'path': '/custom/route/'},
+			{
+				'method': 'GET',
+				'path': '/custom/route/{custom}/',
+				'transforms': [{
+					'source': ['first', 'body', 'custom'],
+					'target': ['path', 'custom'],
+				}],
+			},
+			{'method': 'GET', 'path': '/custom/route/', 'key': 'first'},
+			{'method': 'GET', 'path': '/custom/route/'},
+		]
+		requests[0]['key'] = 'first'
+
+		response = Client().generic('GET', '/multi/', jsondumps(requests), content_type='application/json')
+		self.assertEqual(response.status_code, 200)
+		response = jsonloads(response.content)
+		self.assertEqual(4, len(response))
+		for res in response:
+			self.assertEqual(200, res['status'])
+			self.assertEqual({'custom': True}, res['body'])
+
+	@override_settings(BINDER_MULTI_REQUEST_WORKERS=4)
+	def test_parallel_get_batch_stops_at_first_failure(self):
+		requests = [
+			{'method': 'GET', 'path': '/custom/route/'},
+			{
+				'method': 'GET',
+				'path': '/custom/route/',
+				'transforms': [{
+					'source': [0, 'body', 'nonexistent'],
+					'target': ['path', 'custom'],
+				}],
+			},
+			{'method': 'GET', 'path': '/custom/route/'},
+		]
+
+		response = Client().generic('GET', '/multi/', jsondumps(requests), content_type='application/json')
+		self.assertEqual(response.status_code, 418)
+		response = jsonloads(response.content)
+		self.assertEqual([200, 418], [res['status'] for res in response])
+		self.assertEqual('RequestError', response[1]['body']['code'])
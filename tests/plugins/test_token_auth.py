@@ -8,6 +8,7 @@ from django.core.management import call_command
 from django.core.management.base import CommandError
 
 from binder.plugins.token_auth.models import Token
+from binder.plugins.token_auth.cache import token_cache
 from binder.json import jsonloads
 
 from ..compare import assert_json, ANY, EXTRA
@@ -94,6 +95,114 @@ class TokenAuthTest(TestCase):
 
 
 
+@override_settings(
+	BINDER_TOKEN_EXPIRE_TIME=timedelta(days=1),
+	BINDER_TOKEN_EXPIRE_BASE='last_used_at',
+	BINDER_TOKEN_CACHE_TIMEOUT=60,
+	BINDER_TOKEN_LAST_USED_INTERVAL=timedelta(minutes=5),
+)
+class TokenAuthCacheTest(TestCase):
+
+	def setUp(self):
+		token_cache.clear()
+		self.user = User.objects.create_user(username='foo', password='bar', is_superuser=True)
+		self.token = Token(user=self.user)
+		self.token.save()
+		self.client = Client(HTTP_AUTHORIZATION='Token ' + self.token.token)
+
+	def tearDown(self):
+		token_cache.clear()
+
+	def test_cached_token_is_used(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		# Queryset updates bypass invalidation, so this proves the cache is hit
+		Token.objects.filter(pk=self.token.pk).update(token='foo')
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+		self.assertEqual(jsonloads(res.content)['username'], 'foo')
+
+	@override_settings(BINDER_TOKEN_CACHE_BACKEND='default')
+	def test_shared_cache_backend(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		token_cache.clear()
+		Token.objects.filter(pk=self.token.pk).update(token='foo')
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		# Clears the local cache, deleting must clear the shared cache too
+		token_cache.clear()
+		Token.objects.filter(pk=self.token.pk).update(token=self.token.token)
+		self.token.delete()
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 404)
+
+	def test_deleted_token_is_invalidated(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		self.token.delete()
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 404)
+
+	def test_changed_token_is_invalidated(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		self.token.token = 'foo'
+		self.token.save()
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 404)
+
+	def test_changed_user_is_invalidated(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		self.user.username = 'baz'
+		self.user.save()
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+		self.assertEqual(jsonloads(res.content)['username'], 'baz')
+
+	def test_last_used_at_writes_are_coalesced(self):
+		last_used_at = self.token.last_used_at - timedelta(minutes=10)
+		Token.objects.filter(pk=self.token.pk).update(last_used_at=last_used_at)
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+		self.token.refresh_from_db()
+		self.assertGreater(self.token.last_used_at, last_used_at)
+
+		touched_at = self.token.last_used_at
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+		self.token.refresh_from_db()
+		self.assertEqual(self.token.last_used_at, touched_at)
+
+	@override_settings(BINDER_TOKEN_EXPIRE_TIME=timedelta(minutes=1))
+	def test_expired_cached_token(self):
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 200)
+
+		cached = token_cache.get(self.token.token)
+		cached.last_used_at -= timedelta(minutes=2)
+		token_cache.set(cached)
+
+		res = self.client.get('/user/identify/')
+		self.assertEqual(res.status_code, 400)
+		self.assertFalse(Token.objects.filter(pk=self.token.pk).exists())
+
+
+
 @override_settings(
 	BINDER_PERMISSION={
 		'default': [
@@ -276,3 +385,42 @@ class DeleteUserTokenTest(TestCase):
 		self.assertFalse(Token.objects.filter(id=token3.id).exists())
 
 		self.assertIn("Deleted 2 token(s) for user testuser@example.com.", out.getvalue())
+
+
+@override_settings(
+	BINDER_TOKEN_EXPIRE_TIME=timedelta(days=1),
+	BINDER_TOKEN_EXPIRE_BASE='last_used_at',
+)
+class PurgeExpiredTokensTest(TestCase):
+	def setUp(self):
+		user = User(username='testuser@example.com')
+		user.save()
+		self.fresh = Token(user=user)
+		self.fresh.save()
+		self.expired = []
+		for i in range(3):
+			token = Token(user=user)
+			token.save()
+			self.expired.append(token)
+		Token.objects.filter(pk__in=[t.pk for t in self.expired]).update(last_used_at=self.fresh.last_used_at - timedelta(days=2))
+
+
+	def test_expired_queryset_matches_expired_property(self):
+		expired = set(Token.objects.expired().values_list('pk', flat=True))
+		self.assertEqual({t.pk for t in Token.objects.all() if t.expired}, expired)
+		self.assertEqual({t.pk for t in self.expired}, expired)
+
+
+	@override_settings(BINDER_TOKEN_EXPIRE_TIME=None)
+	def test_no_tokens_expire_without_expire_time(self):
+		self.assertFalse(Token.objects.expired().exists())
+		self.assertEqual(0, Token.objects.purge_expired())
+		self.assertEqual(4, Token.objects.count())
+
+
+	def test_purge_expired_tokens_deletes_only_expired_tokens_in_batches(self):
+		out = StringIO()
+		call_command('purge_expired_tokens', '--batch-size', '2', stdout=out)
+
+		self.assertEqual([self.fresh.pk], list(Token.objects.values_list('pk', flat=True)))
+		self.assertIn("Deleted 3 expired token(s).", out.getvalue())
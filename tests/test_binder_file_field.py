@@ -1,17 +1,28 @@
+import hashlib
+from datetime import timedelta
 from os.path import basename
-from io import BytesIO
+from io import BytesIO, StringIO
+from unittest import mock
 from PIL import Image
 from tempfile import NamedTemporaryFile
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.management import call_command
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.contrib.auth.models import User
 from django.db import connection
+from django.utils import timezone
 
 from binder.json import jsonloads
+from binder.models import BinderFieldFile, StoredFile, parse_tuple, serialize_tuple
+from binder.thumbnails import Thumbnail
 
 from .testapp.models import Zoo
+from .testapp.urls import router
+from .testapp.views import ZooView
 from .utils import temp_imagefile
 
 
@@ -43,6 +54,40 @@ class BinderFileFieldTest(TestCase):
 		self.assertEqual(zoo2.binder_picture.content_type, 'image/jpeg')
 		self.assertEqual(zoo2.binder_picture.content_hash, JPG_HASH)
 
+	def test_hash_is_calculated_while_saving(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		with mock.patch.object(FileSystemStorage, 'open') as storage_open:
+			zoo.save()
+		storage_open.assert_not_called()
+
+		zoo2 = Zoo.objects.get(pk=zoo.pk)
+		self.assertEqual(zoo2.binder_picture.stored_content_hash, JPG_HASH)
+
+	@override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+	def test_post_file_uploaded_to_disk(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.save()
+
+		with mock.patch.object(FileSystemStorage, 'open') as storage_open:
+			response = self.client.post('/zoo/%s/binder_picture/' % zoo.id, data={
+				'file': ContentFile(JPG_CONTENT, name='pic.jpg'),
+			})
+		self.assertEqual(response.status_code, 200)
+		storage_open.assert_not_called()
+
+		zoo.refresh_from_db()
+		self.assertEqual(zoo.binder_picture.stored_content_hash, JPG_HASH)
+
+	@override_settings(BINDER_FILE_HASH_ALGORITHM='blake2b')
+	def test_hash_algorithm(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		zoo2 = Zoo.objects.get(pk=zoo.pk)
+		self.assertEqual(zoo2.binder_picture.content_hash, hashlib.blake2b(JPG_CONTENT).hexdigest())
+
 	def test_post(self):
 		filename = 'pic.jpg'
 		zoo = Zoo(name='Apenheul')
@@ -147,6 +192,92 @@ class BinderFileFieldTest(TestCase):
 		response = self.client.get(path)
 		self.assertNotIn('X-Accel-Redirect', response.headers)
 
+	def test_get_not_modified(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		response = self.client.get('/zoo/{}/binder_picture/'.format(zoo.pk))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['ETag'], '"{}"'.format(JPG_HASH))
+		self.assertEqual(response['Accept-Ranges'], 'bytes')
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
+		with mock.patch.object(FileSystemStorage, 'open') as storage_open:
+			response = self.client.get('/zoo/{}/binder_picture/'.format(zoo.pk), HTTP_IF_NONE_MATCH='"{}"'.format(JPG_HASH))
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response['ETag'], '"{}"'.format(JPG_HASH))
+		storage_open.assert_not_called()
+
+		response = self.client.get('/zoo/{}/binder_picture/'.format(zoo.pk), HTTP_IF_NONE_MATCH='"{}"'.format(PNG_HASH))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
+	def test_get_not_modified_since(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.django_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		response = self.client.get('/zoo/{}/django_picture/'.format(zoo.pk))
+		self.assertEqual(response.status_code, 200)
+		self.assertNotIn('ETag', response)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+		last_modified = response['Last-Modified']
+
+		response = self.client.get('/zoo/{}/django_picture/'.format(zoo.pk), HTTP_IF_MODIFIED_SINCE=last_modified)
+		self.assertEqual(response.status_code, 304)
+
+	def test_get_range(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+		path = '/zoo/{}/binder_picture/'.format(zoo.pk)
+		size = len(JPG_CONTENT)
+
+		response = self.client.get(path, HTTP_RANGE='bytes=10-19')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response['Content-Range'], 'bytes 10-19/{}'.format(size))
+		self.assertEqual(response['Content-Length'], '10')
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT[10:20])
+
+		response = self.client.get(path, HTTP_RANGE='bytes=600-')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT[600:])
+
+		response = self.client.get(path, HTTP_RANGE='bytes=-5')
+		self.assertEqual(response.status_code, 206)
+		self.assertEqual(response['Content-Range'], 'bytes {}-{}/{}'.format(size - 5, size - 1, size))
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT[-5:])
+
+		response = self.client.get(path, HTTP_RANGE='bytes={}-'.format(size))
+		self.assertEqual(response.status_code, 416)
+		self.assertEqual(response['Content-Range'], 'bytes */{}'.format(size))
+
+		# Multiple ranges are not supported, so the whole file is sent
+		response = self.client.get(path, HTTP_RANGE='bytes=0-1,5-6')
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
+		# The range is only sent when the file did not change
+		response = self.client.get(path, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"{}"'.format(JPG_HASH))
+		self.assertEqual(response.status_code, 206)
+		response = self.client.get(path, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"{}"'.format(PNG_HASH))
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
+	def test_get_with_current_hash_is_cached(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		response = self.client.get('/zoo/{}/binder_picture/?h={}'.format(zoo.pk, JPG_HASH))
+		self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
+		response = self.client.get('/zoo/{}/binder_picture/?h={}'.format(zoo.pk, PNG_HASH))
+		self.assertNotIn('Cache-Control', response)
+		self.assertEqual(b''.join(response.streaming_content), JPG_CONTENT)
+
 	def test_get_unknown_extension(self):
 		filename = 'pic.unknown'
 		zoo = Zoo(name='Apenheul')
@@ -207,19 +338,34 @@ class BinderFileFieldTest(TestCase):
 			# Update db directly to mimic existing records.
 			cur.execute("UPDATE {} set binder_picture='{}'".format(zoo._meta.db_table, file.name))
 
-		response = self.client.get('/zoo/{}/'.format(zoo.pk))
+		# The file is not read to get its hash until it is backfilled
+		with mock.patch.object(FileSystemStorage, 'open') as storage_open:
+			response = self.client.get('/zoo/')
 		self.assertEqual(response.status_code, 200)
+		storage_open.assert_not_called()
 		data = jsonloads(response.content)
+		self.assertEqual(
+			data['data'][0]['binder_picture'],
+			'/zoo/{}/binder_picture/?h={}&content_type=image/jpeg&filename={}'.format(zoo.pk, '', filename),
+		)
 
-		# Remove once Django 3 lands with: https://docs.djangoproject.com/en/3.1/howto/custom-file-storage/#django.core.files.storage.get_alternative_name
-		zoo.refresh_from_db()
-		filename = zoo.binder_picture.name
+		out = StringIO()
+		call_command('backfill_file_hashes', '--batch-size=1', stdout=out)
+		self.assertIn('testapp.Zoo.binder_picture: 1 hashes stored', out.getvalue())
 
+		response = self.client.get('/zoo/{}/'.format(zoo.pk))
+		self.assertEqual(response.status_code, 200)
+		data = jsonloads(response.content)
 		self.assertEqual(
 			data['data']['binder_picture'],
 			'/zoo/{}/binder_picture/?h={}&content_type=image/jpeg&filename={}'.format(zoo.pk, JPG_HASH, filename),
 		)
 
+		# Stored hashes are not calculated again
+		out = StringIO()
+		call_command('backfill_file_hashes', stdout=out)
+		self.assertIn('testapp.Zoo.binder_picture: 0 hashes stored', out.getvalue())
+
 	def test_reusing_same_file_for_multiple_fields(self):
 		with BytesIO() as bytesio:
 			im = Image.new('RGBA', (50,100))
@@ -269,6 +415,154 @@ class BinderFileFieldTest(TestCase):
 
 		self.assertEqual(str(cm.exception), 'ResourceWarning not triggered')
 
+	def test_get_stored_file(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		zoo = Zoo.objects.get(pk=zoo.pk)
+		field = Zoo._meta.get_field('binder_picture')
+		stored_file = field.get_stored_file(zoo)
+		self.assertEqual(StoredFile(zoo.binder_picture.name, JPG_HASH, 'image/jpeg'), stored_file)
+
+		self.assertEqual(StoredFile(None, None, None), Zoo._meta.get_field('binder_picture_direct').get_stored_file(zoo))
+
+		zoo = Zoo.objects.defer('binder_picture').get(pk=zoo.pk)
+		with self.assertRaises(ValueError):
+			field.get_stored_file(zoo)
+
+	def test_save_with_deferred_file_field(self):
+		zoo = Zoo(name='Apenheul')
+		zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		zoo.save()
+
+		name = zoo.binder_picture.name
+
+		# Like history_obj_post_save and LoadedValuesMixin.save do
+		zoo = Zoo.objects.defer('binder_picture').get(pk=zoo.pk)
+		self.assertEqual(name, zoo.binder_concrete_fields_as_dict()['binder_picture'])
+
+		zoo = Zoo.objects.defer('binder_picture').get(pk=zoo.pk)
+		zoo.name = 'Artis'
+		zoo.save()
+
+		zoo.refresh_from_db()
+		self.assertEqual('Artis', zoo.name)
+		self.assertEqual(JPG_HASH, zoo.binder_picture.stored_content_hash)
+		self.assertEqual(zoo.binder_picture.name, zoo.binder_concrete_fields_as_dict()['binder_picture'])
+
+	def test_parse_escaped_tuple(self):
+		values = ('foo\\bar,baz.jpg', JPG_HASH, 'image/jpeg')
+		self.assertEqual(values, parse_tuple(serialize_tuple(values)))
+
+	def test_list_does_not_refresh_deferred_file_fields(self):
+		for name in ('Apenheul', 'Artis'):
+			zoo = Zoo(name=name)
+			zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+			zoo.save()
+
+		request = RequestFactory().get('/zoo/')
+		request.user = User(username='testuser', is_active=True, is_superuser=True)
+		view = ZooView(router=router)
+
+		with CaptureQueriesContext(connection) as queries:
+			expected = view._get_objs(Zoo.objects.order_by('pk'), request)
+
+		with self.assertNumQueries(len(queries)), \
+				mock.patch.object(BinderFieldFile, '__init__', side_effect=AssertionError('BinderFieldFile constructed')):
+			data = view._get_objs(Zoo.objects.defer('binder_picture', 'floor_plan').order_by('pk'), request)
+		self.assertEqual(expected, data)
+		self.assertRegex(data[0]['binder_picture'], r'\?h={}&content_type=image/jpeg&filename=pic\w*\.jpg$'.format(JPG_HASH))
+
+		with self.assertNumQueries(len(queries)):
+			data = view._get_objs(Zoo.objects.only('name').order_by('pk'), request)
+		self.assertEqual(expected, data)
+
+
+@override_settings(BINDER_SIGNED_FILE_URL_MAX_AGE=3600)
+class SignedFileUrlTest(TestCase):
+	def setUp(self):
+		super().setUp()
+		u = User(username='testuser', is_active=True, is_superuser=True)
+		u.set_password('test')
+		u.save()
+		self.client = Client()
+		r = self.client.login(username='testuser', password='test')
+		self.assertTrue(r)
+
+		self.zoo = Zoo(name='Apenheul')
+		self.zoo.binder_picture = ContentFile(JPG_CONTENT, name='pic.jpg')
+		self.zoo.binder_picture_direct = ContentFile(JPG_CONTENT, name='pic.jpg')
+		self.zoo.save()
+
+	def get_url(self):
+		response = self.client.get('/zoo/{}/'.format(self.zoo.pk))
+		self.assertEqual(response.status_code, 200)
+		data = jsonloads(response.content)
+		# Other file fields keep their normal url
+		self.assertTrue(data['data']['binder_picture'].startswith('/zoo/{}/binder_picture/?'.format(self.zoo.pk)))
+		return data['data']['binder_picture_direct']
+
+	def test_get_signed_url(self):
+		url = self.get_url()
+		name = self.zoo.binder_picture_direct.name
+		self.assertTrue(url.startswith('/zoo/binder_picture_direct/signed/{}?h={}&content_type=image/jpeg&filename={}&expires='.format(
+			name, JPG_HASH, basename(name),
+		)))
+		# The url does not change on every request
+		self.assertEqual(url, self.get_url())
+
+		client = Client()
+		with self.assertNumQueries(0):
+			response = client.get(url)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response['X-Accel-Redirect'], '/internal/media/' + name)
+		self.assertEqual(response['Content-Type'], 'image/jpeg')
+		self.assertEqual(response['ETag'], '"{}"'.format(JPG_HASH))
+		self.assertRegex(response['Cache-Control'], r'^private, max-age=\d+$')
+		self.assertGreaterEqual(int(response['Cache-Control'].split('=')[1]), 3600)
+
+		response = client.get(url, HTTP_IF_NONE_MATCH='"{}"'.format(JPG_HASH))
+		self.assertEqual(response.status_code, 304)
+
+	def test_post_returns_signed_url(self):
+		response = self.client.post('/zoo/{}/binder_picture_direct/'.format(self.zoo.pk), data={
+			'file': ContentFile(PNG_CONTENT, name='pic.png'),
+		})
+		self.assertEqual(response.status_code, 200)
+		url = jsonloads(response.content)['data']['binder_picture_direct']
+		self.assertIn('?h={}&content_type=image/png'.format(PNG_HASH), url)
+
+		response = Client().get(url)
+		self.assertEqual(response.status_code, 200)
+
+	def test_invalid_signature(self):
+		url = self.get_url()
+		path, query = url.split('?')
+		client = Client()
+
+		for invalid_url in [
+			path + '?' + query.replace('signature=', 'signature=0'),
+			path + '?' + query.replace('h=', 'h=0'),
+			path.replace('/signed/', '/signed/other/') + '?' + query,
+			path.replace('/signed/', '/signed/../') + '?' + query,
+			path,
+		]:
+			response = client.get(invalid_url)
+			self.assertEqual(response.status_code, 403, invalid_url)
+			self.assertEqual(jsonloads(response.content)['code'], 'InvalidSignature')
+
+	def test_expired(self):
+		url = self.get_url()
+		with mock.patch('binder.downloads.time.time', return_value=timezone.now().timestamp() + 7201):
+			response = Client().get(url)
+		self.assertEqual(response.status_code, 403)
+
+	@override_settings(BINDER_SIGNED_FILE_URL_MAX_AGE=None)
+	def test_disabled(self):
+		url = self.get_url()
+		self.assertTrue(url.startswith('/zoo/{}/binder_picture_direct/?h='.format(self.zoo.pk)))
+
 
 class BinderFileFieldBlankNotNullableTest(TestCase):
 	def setUp(self):
@@ -370,3 +664,106 @@ class BinderFileFieldAllowedExtensionTest(TestCase):
 					data['data']['binder_picture_custom_extensions'],
 					'/zoo/{}/binder_picture_custom_extensions/?h={}&content_type=image/png&filename={}'.format(zoo.pk, PNG_HASH, filename),
 				)
+
+
+
+class ThumbnailTest(TestCase):
+	def setUp(self):
+		super().setUp()
+		u = User(username='testuser', is_active=True, is_superuser=True)
+		u.set_password('test')
+		u.save()
+		self.client = Client()
+		r = self.client.login(username='testuser', password='test')
+		self.assertTrue(r)
+
+		self.zoo = Zoo(name='Apenheul')
+		with temp_imagefile(500, 300, 'jpeg') as file:
+			self.zoo.binder_picture = ContentFile(file.read(), name='pic.jpg')
+		self.zoo.save()
+		self.path = '/zoo/{}/binder_picture/'.format(self.zoo.pk)
+
+	def tearDown(self):
+		for thumbnail in Thumbnail.objects.all():
+			default_storage.delete(thumbnail.file_name)
+
+	def get_image(self, response):
+		self.assertEqual(response.status_code, 200)
+		return Image.open(BytesIO(b''.join(response.streaming_content)))
+
+	def test_thumbnail(self):
+		response = self.client.get(self.path, {'width': 128, 'height': 128})
+		self.assertEqual(response['Content-Type'], 'image/jpeg')
+		img = self.get_image(response)
+		self.assertEqual((img.format, img.size), ('JPEG', (128, 77)))
+
+		content_hash = self.zoo.binder_picture.content_hash
+		self.assertEqual(response['ETag'], '"{}-128x128-contain-"'.format(content_hash))
+
+		# Served from the cache
+		with mock.patch('binder.thumbnails.make_thumbnail') as make_thumbnail:
+			response = self.client.get(self.path, {'width': 128, 'height': 128})
+			self.assertEqual(self.get_image(response).size, (128, 77))
+			response = self.client.get(self.path, {'width': 128, 'height': 128}, HTTP_IF_NONE_MATCH='"{}-128x128-contain-"'.format(content_hash))
+			self.assertEqual(response.status_code, 304)
+		make_thumbnail.assert_not_called()
+		self.assertEqual(1, Thumbnail.objects.count())
+
+	def test_not_modified_thumbnail_is_not_generated(self):
+		content_hash = self.zoo.binder_picture.content_hash
+		with mock.patch('binder.thumbnails.make_thumbnail') as make_thumbnail:
+			response = self.client.get(self.path, {'width': 128, 'format': 'png'}, HTTP_IF_NONE_MATCH='"{}-128x-contain-png"'.format(content_hash))
+			self.assertEqual(response.status_code, 304)
+		make_thumbnail.assert_not_called()
+		self.assertEqual(0, Thumbnail.objects.count())
+
+	def test_thumbnail_download_has_name_of_image(self):
+		response = self.client.get(self.path, {'width': 128, 'format': 'png', 'download': ''})
+		self.assertEqual(response['Content-Type'], 'image/png')
+		self.assertEqual(response['Content-Disposition'], 'attachment; filename="{}"'.format(basename(self.zoo.binder_picture.name)))
+
+	def test_thumbnail_cover(self):
+		response = self.client.get(self.path, {'width': 128, 'height': 128, 'fit': 'cover', 'format': 'png'})
+		self.assertEqual(response['Content-Type'], 'image/png')
+		img = self.get_image(response)
+		self.assertEqual((img.format, img.size), ('PNG', (128, 128)))
+
+	def test_thumbnail_is_not_scaled_up(self):
+		img = self.get_image(self.client.get(self.path, {'width': 1000}))
+		self.assertEqual(img.size, (500, 300))
+
+	def test_thumbnail_size_is_rounded_up(self):
+		response = self.client.get(self.path, {'width': 100, 'height': 70})
+		self.assertEqual(response['ETag'], '"{}-128x128-contain-"'.format(self.zoo.binder_picture.content_hash))
+		self.assertEqual((128, 77), self.get_image(response).size)
+
+		# Sizes which are rounded up to the same size share a thumbnail
+		with mock.patch('binder.thumbnails.make_thumbnail') as make_thumbnail:
+			response = self.client.get(self.path, {'width': 128, 'height': 100})
+			self.assertEqual((128, 77), self.get_image(response).size)
+		make_thumbnail.assert_not_called()
+		self.assertEqual(1, Thumbnail.objects.count())
+
+		with override_settings(BINDER_THUMBNAIL_SIZES=[100, 200]):
+			self.assertEqual((100, 60), self.get_image(self.client.get(self.path, {'width': 90})).size)
+			self.assertEqual(418, self.client.get(self.path, {'width': 201}).status_code)
+
+	def test_invalid_thumbnail(self):
+		for params in [{'width': 'foo'}, {'width': 0}, {'height': 2049}, {'fit': 'stretch'}, {'format': 'bmp'}]:
+			response = self.client.get(self.path, params)
+			self.assertEqual(response.status_code, 418, params)
+
+	def test_least_recently_used_thumbnails_are_evicted(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			self.get_image(self.client.get(self.path, {'width': 256}))
+		first = Thumbnail.objects.get()
+		self.assertTrue(default_storage.exists(first.file_name))
+		Thumbnail.objects.update(accessed_at=timezone.now() - timedelta(hours=1))
+
+		# Room for the first thumbnail, not for both
+		with override_settings(BINDER_THUMBNAIL_CACHE_SIZE=first.size + 1), self.captureOnCommitCallbacks(execute=True):
+			self.get_image(self.client.get(self.path, {'width': 128}))
+		second = Thumbnail.objects.get()
+		self.assertNotEqual(first, second)
+		self.assertFalse(default_storage.exists(first.file_name))
+		self.assertTrue(default_storage.exists(second.file_name))
@@ -1,9 +1,15 @@
 import json
+from unittest import mock
 
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
 
+from binder.plugins.views.combined import _after_value, Q_FALSE
+
 from .testapp.models import Zoo, Animal
+from .testapp.views import ZooView
 
 
 class CombinedTest(TestCase):
@@ -180,3 +186,119 @@ class CombinedTest(TestCase):
 			zoo1.id * 2,  # Apenheul
 			zoo2.id * 2,  # Emmen
 		])
+
+	def _create_zoos_and_animals(self):
+		zoos = [
+			Zoo.objects.create(name=name, founding_date=date)
+			for name, date in [('Apenheul', '1980-01-01'), ('Emmen', None), ('Artis', '1980-01-01'), ('Blijdorp', '1990-01-01')]
+		]
+		for i, (name, date) in enumerate([
+			('Bokito', '1995-01-01'), ('Harambe', None), ('Coco', '1980-01-01'),
+			('Apenheul', None), ('Emmen', '1990-01-01'), ('Woofer', '1980-01-01'),
+		]):
+			Animal.objects.create(zoo=zoos[i % len(zoos)], name=name, birth_date=date)
+
+	def _get_ids(self, url):
+		res = self.client.get(url)
+		self.assertEqual(res.status_code, 200)
+		data = json.loads(res.content)
+		return [obj['id'] for obj in data['data']], data['meta']
+
+	def test_combined_pagination_with_offset(self):
+		self._create_zoos_and_animals()
+
+		for order_by in ['id', '-id', 'name', '-name,-id', 'model_index,-name', '(founding_date,birth_date)', '-(founding_date,birth_date)__nulls_last']:
+			all_ids, _ = self._get_ids(f'/combined/zoo/animal/?order_by={order_by}&limit=none')
+			self.assertEqual(10, len(all_ids))
+
+			ids = []
+			for offset in range(0, 10, 3):
+				page, _ = self._get_ids(f'/combined/zoo/animal/?order_by={order_by}&limit=3&offset={offset}')
+				ids.extend(page)
+			self.assertEqual(all_ids, ids, order_by)
+
+	def test_combined_pagination_with_cursor(self):
+		self._create_zoos_and_animals()
+
+		for order_by in ['id', '-id', 'name', '-name,-id', 'model_index,-name', '(founding_date,birth_date)', '-(founding_date,birth_date)', '-(founding_date,birth_date)__nulls_last', '(founding_date,birth_date)__nulls_first']:
+			all_ids, _ = self._get_ids(f'/combined/zoo/animal/?order_by={order_by}&limit=none')
+
+			ids, meta = self._get_ids(f'/combined/zoo/animal/?order_by={order_by}&limit=3&include_meta=next_cursor')
+			while meta['next_cursor'] is not None:
+				page, meta = self._get_ids(f'/combined/zoo/animal/?order_by={order_by}&limit=3&after={meta["next_cursor"]}')
+				ids.extend(page)
+			self.assertEqual(all_ids, ids, order_by)
+
+	def test_cursor_follows_null_ordering_of_database(self):
+		for nulls_order_largest in [True, False]:
+			with mock.patch.object(connection.features, 'nulls_order_largest', nulls_order_largest):
+				for inverted in [False, True]:
+					after, _ = _after_value('founding_date', None, inverted, None)
+					# When nulls come first, all other rows come after a null
+					self.assertEqual(nulls_order_largest == inverted, after != Q_FALSE, (nulls_order_largest, inverted))
+
+					after, _ = _after_value('founding_date', '1980-01-01', inverted, None)
+					self.assertEqual(nulls_order_largest != inverted, ('founding_date__isnull', True) in after.children, (nulls_order_largest, inverted))
+
+	def test_combined_search_over_to_many_relation(self):
+		zoo = Zoo.objects.create(name='Apenheul')
+		for name in ['Duplicate 1', 'Duplicate 2', 'Duplicate 3']:
+			Animal.objects.create(zoo=zoo, name=name)
+
+		with mock.patch.object(ZooView, 'searches', ['animals__name__icontains']):
+			all_ids, meta = self._get_ids('/combined/zoo/animal/?search=duplicate&limit=none&include_meta=total_records')
+			self.assertEqual(4, len(all_ids))
+			self.assertEqual(4, len(set(all_ids)))
+			self.assertEqual(4, meta['total_records'])
+
+			ids, meta = self._get_ids('/combined/zoo/animal/?search=duplicate&limit=2&include_meta=next_cursor')
+			while meta['next_cursor'] is not None:
+				page, meta = self._get_ids(f'/combined/zoo/animal/?search=duplicate&limit=2&after={meta["next_cursor"]}')
+				ids.extend(page)
+			self.assertEqual(all_ids, ids)
+
+	def test_combined_invalid_cursor(self):
+		res = self.client.get('/combined/zoo/animal/?after=foo')
+		self.assertEqual(res.status_code, 418)
+		self.assertEqual(json.loads(res.content)['code'], 'RequestError')
+
+		# A cursor with the wrong number of values
+		res = self.client.get('/combined/zoo/animal/?order_by=name&after=WzFd')
+		self.assertEqual(res.status_code, 418)
+
+		res = self.client.get('/combined/zoo/animal/?after=WzFd&offset=1')
+		self.assertEqual(res.status_code, 418)
+
+		ids, meta = self._get_ids('/combined/zoo/animal/?include_meta=next_cursor&limit=0')
+		self.assertEqual([], ids)
+		self.assertIsNone(meta['next_cursor'])
+
+	def test_combined_limits_every_model(self):
+		self._create_zoos_and_animals()
+
+		with CaptureQueriesContext(connection) as queries:
+			ids, _ = self._get_ids('/combined/zoo/animal/?order_by=-id&limit=2&offset=1')
+
+		query = next(q['sql'] for q in queries if 'UNION' in q['sql'])
+		self.assertIn('UNION ALL', query)
+		self.assertEqual(2, query.count('LIMIT 3'))
+		self.assertEqual(2, len(ids))
+
+	def test_combined_total_records_in_one_query(self):
+		self._create_zoos_and_animals()
+
+		with CaptureQueriesContext(connection) as queries:
+			_, meta = self._get_ids('/combined/zoo/animal/?include_meta=total_records&limit=1')
+		self.assertEqual(10, meta['total_records'])
+		self.assertEqual(1, len([q for q in queries if 'COUNT(' in q['sql']]))
+
+		_, meta = self._get_ids('/combined/zoo/animal/?include_meta=total_records&.zoo.name=Emmen&limit=1')
+		self.assertEqual(1 + 6, meta['total_records'])
+
+	def test_combined_approximate_total_records(self):
+		self._create_zoos_and_animals()
+
+		_, meta = self._get_ids('/combined/zoo/animal/?include_meta=approximate_total_records')
+		self.assertNotIn('total_records', meta)
+		self.assertIsInstance(meta['approximate_total_records'], int)
+		self.assertGreaterEqual(meta['approximate_total_records'], 0)
@@ -1,17 +1,24 @@
 import json
 import mimetypes
 from contextlib import contextmanager
+from io import BytesIO
 from unittest import mock
 
 from django.db import DEFAULT_DB_ALIAS
-from django.test import TestCase, Client
+from django.conf import settings
+from django.test import TestCase, Client, RequestFactory, override_settings
 from django.test.client import encode_multipart
 from django.core.files import File
+from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
 
+from PIL import Image
+
 from binder.json import jsonloads
+from binder.uploads import UploadLimitHandler
 
 from .testapp.models import Animal, Zoo
+from .testapp.views import ZooView
 from .utils import temp_imagefile
 
 
@@ -200,6 +207,30 @@ class FileUploadTest(TestCase):
 		self.assertEqual(emmen.floor_plan.width, 500)
 		self.assertEqual(emmen.floor_plan.height, 500)
 
+	def test_upload_exif_rotated_jpeg(self):
+		emmen = Zoo(name='Wildlands Adventure Zoo Emmen')
+		emmen.save()
+
+		# Orientation 6 means the image has to be rotated 90 degrees clockwise
+		exif = Image.Exif()
+		exif[0x0112] = 6
+		for size, expected_size in [((300, 200), (200, 300)), ((1200, 800), (333, 500))]:
+			with BytesIO() as file:
+				Image.new('RGB', size).save(file, 'jpeg', exif=exif.tobytes())
+				content = file.getvalue()
+
+			save = Image.Image.save
+			with mock.patch.object(Image.Image, 'save', autospec=True, side_effect=save) as image_save:
+				response = self.client.post('/zoo/%s/floor_plan/' % emmen.id, data={'file': ContentFile(content, name='plan.jpg')})
+			self.assertEqual(response.status_code, 200)
+			# Rotated and resized with a single encode
+			self.assertEqual(image_save.call_count, 1)
+
+			emmen.refresh_from_db()
+			self.assertEqual((emmen.floor_plan.width, emmen.floor_plan.height), expected_size)
+			with emmen.floor_plan.open() as f:
+				self.assertNotIn(0x0112, Image.open(f).getexif())
+
 	def test_upload_file_in_post(self):
 		with temp_imagefile(500, 500, 'jpeg') as uploaded_file:
 			response = self.client.post('/zoo/', data={
@@ -367,3 +398,111 @@ class FileUploadTest(TestCase):
 		with zoo1.floor_plan.open() as f:
 			self.assertEqual(f.read(), zoo1_content)
 
+
+	def test_upload_exceeding_max_size_is_aborted_while_receiving(self):
+		emmen = Zoo(name='Wildlands Adventure Zoo Emmen')
+		emmen.save()
+
+		receive_data_chunk = UploadLimitHandler.receive_data_chunk
+		# 16 chunks of 64KB, of which only 2 have to be received
+		content = b'\xff\xd8\xff' + b'\0' * (16 * 65536 - 3)
+		with mock.patch.object(ZooView, 'max_upload_size', 0.1), \
+				mock.patch.object(UploadLimitHandler, 'receive_data_chunk', autospec=True, side_effect=receive_data_chunk) as receive:
+			response = self.client.post('/zoo/%s/floor_plan/' % emmen.id, data={'file': ContentFile(content, name='plan.jpg')})
+		self.assertEqual(response.status_code, 413)
+		data = jsonloads(response.content)
+		self.assertEqual(data['code'], 'FileSizeExceeded')
+		self.assertEqual(data['max_size'], 100000)
+		self.assertEqual(receive.call_count, 2)
+
+		emmen.refresh_from_db()
+		self.assertFalse(emmen.floor_plan)
+
+	def test_upload_max_size_per_field(self):
+		with temp_imagefile(500, 500, 'jpeg') as uploaded_file:
+			size = len(uploaded_file.read())
+			uploaded_file.seek(0)
+
+			max_upload_size = {'floor_plan': size / 10**6 - 0.000001, 'django_picture': 10}
+			with mock.patch.object(ZooView, 'max_upload_size', max_upload_size):
+				response = self.client.post('/zoo/', data={
+					'data': json.dumps({
+						'name': 'Wildlands Adventure Zoo Emmen',
+						'floor_plan': None,
+					}),
+					'file:floor_plan': uploaded_file,
+				})
+		self.assertEqual(response.status_code, 413)
+		self.assertEqual(jsonloads(response.content)['max_size'], size - 1)
+		self.assertFalse(Zoo.objects.exists())
+
+	def test_upload_for_related_object_gets_global_limits(self):
+		request = RequestFactory().put('/zoo/', data=b'--my-boundary--', content_type='multipart/form-data; boundary=my-boundary')
+		max_upload_size = {'floor_plan': 1, 'django_picture': 10}
+		with mock.patch.object(ZooView, 'max_upload_size', max_upload_size):
+			ZooView()._install_upload_handler(request, {})
+			get_limits = request.upload_handlers[0].get_limits
+
+			image_extensions = ['png', 'gif', 'jpg', 'jpeg']
+			self.assertEqual((10**6, image_extensions), get_limits('file:floor_plan'))
+			self.assertEqual((10**6, image_extensions), get_limits('file:data.0.floor_plan'))
+			# A file of a related model with a field of the same name
+			self.assertEqual((10 * 10**6, None), get_limits('file:with.zoo_employee.0.floor_plan'))
+
+	def test_upload_with_disallowed_extension_is_aborted(self):
+		boundary = 'my-boundary'
+		content_type = 'multipart/form-data; boundary=' + boundary
+		data = encode_multipart(boundary, {
+			'data': json.dumps({
+				'name': 'Wildlands Adventure Zoo Emmen',
+				'floor_plan': None,
+			}),
+			'file:floor_plan': ContentFile(b'#!/bin/sh', name='plan.sh'),
+		})
+		response = self.client.put('/zoo/', content_type=content_type, data=data)
+		self.assertEqual(response.status_code, 400)
+		data = jsonloads(response.content)
+		self.assertEqual(data['code'], 'FileTypeIncorrect')
+		self.assertEqual({'png', 'gif', 'jpg', 'jpeg'}, {t['extension'] for t in data['allowed_types']})
+
+	def test_upload_not_matching_its_extension_is_aborted(self):
+		emmen = Zoo(name='Wildlands Adventure Zoo Emmen')
+		emmen.save()
+
+		response = self.client.post('/zoo/%s/floor_plan/' % emmen.id, data={
+			'file': ContentFile(b'<script>alert(1)</script>', name='plan.jpg'),
+		})
+		self.assertEqual(response.status_code, 400)
+		self.assertEqual(jsonloads(response.content)['code'], 'FileTypeIncorrect')
+
+		# A png named .jpg is still an allowed image
+		with temp_imagefile(100, 200, 'png') as uploaded_file:
+			response = self.client.post('/zoo/%s/floor_plan/' % emmen.id, data={
+				'file': ContentFile(uploaded_file.read(), name='plan.jpg'),
+			})
+		self.assertEqual(response.status_code, 200)
+
+	def test_upload_is_aborted_before_csrf_check_with_middleware(self):
+		emmen = Zoo(name='Wildlands Adventure Zoo Emmen')
+		emmen.save()
+
+		middleware = list(settings.MIDDLEWARE)
+		middleware.insert(middleware.index('django.middleware.csrf.CsrfViewMiddleware'), 'binder.uploads.UploadLimitMiddleware')
+
+		client = Client(enforce_csrf_checks=True)
+		client.login(username='testuser', password='test')
+		csrf_token = 'a' * 32
+		client.cookies[settings.CSRF_COOKIE_NAME] = csrf_token
+
+		receive_data_chunk = UploadLimitHandler.receive_data_chunk
+		content = b'\xff\xd8\xff' + b'\0' * (16 * 65536 - 3)
+		with override_settings(MIDDLEWARE=middleware), \
+				mock.patch.object(ZooView, 'max_upload_size', 0.1), \
+				mock.patch.object(UploadLimitHandler, 'receive_data_chunk', autospec=True, side_effect=receive_data_chunk) as receive:
+			response = client.post(
+				'/zoo/%s/floor_plan/' % emmen.id,
+				data={'file': ContentFile(content, name='plan.jpg')},
+				HTTP_X_CSRFTOKEN=csrf_token,
+			)
+		self.assertEqual(response.status_code, 413)
+		self.assertEqual(receive.call_count, 2)
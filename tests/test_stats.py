@@ -1,9 +1,20 @@
+import io
 import json
+from unittest import mock
 
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 
-from .testapp.models import Animal, Caretaker, Zoo
+from .testapp.models import Animal, Caretaker, Picture, Zoo
+from .testapp.views.animal import AnimalView
+from binder.rollups import StatRollup, check_materialized_stat
+from binder.router import Router
+from binder.stats_cache import StatsCache
+from binder.views import Stat
 
 from .compare import assert_json, ANY
 
@@ -108,3 +119,230 @@ class StatsTest(TestCase):
 				'filters': {},
 			}
 		})
+
+	def test_stats_are_combined(self):
+		with CaptureQueriesContext(connection) as queries:
+			res = self.get_stats(
+				'total_records',
+				'without_caretaker',
+				'with_caretaker',
+				'stat_total_magic_number',
+				'by_zoo',
+				'magic_number_by_zoo',
+			)
+
+		self.assertEqual(res, {
+			'total_records': {
+				'value': 3,
+				'filters': {},
+			},
+			'without_caretaker': {
+				'value': 1,
+				'filters': {'caretaker:isnull': 'true'},
+			},
+			'with_caretaker': {
+				'value': 2,
+				'filters': {'caretaker:isnull': 'false'},
+			},
+			'stat_total_magic_number': {
+				'value': 6,
+				'filters': {},
+			},
+			'by_zoo': {
+				'value': {'Zoo 1': 1, 'Zoo 2': 2},
+				'other': 0,
+				'filters': {},
+				'group_by': 'zoo.name',
+			},
+			'magic_number_by_zoo': {
+				'value': {'Zoo 1': 2, 'Zoo 2': 4},
+				'other': 0,
+				'filters': {},
+				'group_by': 'zoo.name',
+			},
+		})
+		# One aggregate for the stats without group by, and one grouped query
+		self.assertEqual(2, len([q for q in queries if 'testapp_animal' in q['sql']]))
+
+	def test_stats_joining_to_many_are_not_combined(self):
+		animal = Animal.objects.get(name='Animal 1')
+		for _ in range(3):
+			Picture.objects.create(animal=animal, file='picture.jpg', original_file='picture.jpg')
+
+		with mock.patch.dict(AnimalView.stats, {
+			'pictures': Stat(Count('picture')),
+			'pictures_by_zoo': Stat(Count('picture'), group_by='zoo.name'),
+		}):
+			res = self.get_stats('total_records', 'pictures', 'by_zoo', 'pictures_by_zoo')
+
+		self.assertEqual(3, res['total_records']['value'])
+		self.assertEqual(3, res['pictures']['value'])
+		self.assertEqual({'Zoo 1': 1, 'Zoo 2': 2}, res['by_zoo']['value'])
+		self.assertEqual({'Zoo 1': 3, 'Zoo 2': 0}, res['pictures_by_zoo']['value'])
+
+	def test_combined_stats_filtered(self):
+		res = self.get_stats(
+			'without_caretaker',
+			'with_caretaker',
+			'magic_number_by_zoo',
+			params={'.zoo.name': 'Zoo 2'},
+		)
+		self.assertEqual(1, res['without_caretaker']['value'])
+		self.assertEqual(1, res['with_caretaker']['value'])
+		self.assertEqual({'Zoo 2': 4}, res['magic_number_by_zoo']['value'])
+
+
+class StatsCacheTest(TestCase):
+
+	def setUp(self):
+		self.zoo = Zoo.objects.create(name='Zoo 1')
+		Animal.objects.create(name='Animal 1', zoo=self.zoo)
+
+		u = User(username='testuser', is_active=True, is_superuser=True)
+		u.set_password('test')
+		u.save()
+		self.assertTrue(self.client.login(username='testuser', password='test'))
+
+		old_settings = (AnimalView.stats_cache_timeout, AnimalView.stats_cache_models)
+		AnimalView.stats_cache_timeout = 60
+		AnimalView.stats_cache_models = [Zoo]
+
+		def restore():
+			AnimalView.stats_cache_timeout, AnimalView.stats_cache_models = old_settings
+		self.addCleanup(restore)
+
+	def get_stats(self, *stats, params={}):
+		res = self.client.get('/animal/stats/', {
+			'stats': ','.join(stats),
+			**params,
+		})
+		self.assertEqual(res.status_code, 200)
+		return json.loads(res.content)
+
+	def test_stats_are_cached(self):
+		res = self.get_stats('total_records', 'by_zoo')
+		self.assertEqual({'value': 1, 'filters': {}, 'cached': False}, res['total_records'])
+		self.assertFalse(res['by_zoo']['cached'])
+
+		with CaptureQueriesContext(connection) as queries:
+			res = self.get_stats('total_records', 'by_zoo')
+		self.assertEqual({'value': 1, 'filters': {}, 'cached': True}, res['total_records'])
+		self.assertEqual({'Zoo 1': 1}, res['by_zoo']['value'])
+		self.assertTrue(res['by_zoo']['cached'])
+		self.assertEqual(0, len([q for q in queries if 'testapp_animal' in q['sql']]))
+
+		# Only the missing stats are computed
+		res = self.get_stats('total_records', 'without_caretaker')
+		self.assertTrue(res['total_records']['cached'])
+		self.assertFalse(res['without_caretaker']['cached'])
+
+	def test_stats_are_cached_per_filter(self):
+		self.get_stats('total_records')
+		res = self.get_stats('total_records', params={'.name': 'Animal 2'})
+		self.assertEqual({'value': 0, 'filters': {}, 'cached': False}, res['total_records'])
+
+	def test_cache_is_invalidated_on_write(self):
+		self.get_stats('total_records', 'by_zoo')
+		Animal.objects.create(name='Animal 2', zoo=self.zoo)
+
+		res = self.get_stats('total_records', 'by_zoo')
+		self.assertEqual({'value': 2, 'filters': {}, 'cached': False}, res['total_records'])
+		self.assertEqual({'Zoo 1': 2}, res['by_zoo']['value'])
+
+	def test_cache_is_invalidated_on_write_of_related_model(self):
+		self.get_stats('by_zoo')
+		self.zoo.name = 'Zoo One'
+		self.zoo.save()
+
+		res = self.get_stats('by_zoo')
+		self.assertFalse(res['by_zoo']['cached'])
+		self.assertEqual({'Zoo One': 1}, res['by_zoo']['value'])
+
+
+	def test_cache_is_invalidated_by_other_process(self):
+		self.get_stats('total_records')
+
+		# A process which registered the views, but did not serve stats
+		fresh_stats_cache = StatsCache()
+		with mock.patch('binder.router.stats_cache', fresh_stats_cache):
+			Router().register(AnimalView)
+		self.assertIn('testapp.Animal', fresh_stats_cache.models)
+		self.assertIn('testapp.Zoo', fresh_stats_cache.models)
+
+		with mock.patch('binder.stats_cache.stats_cache', fresh_stats_cache):
+			Animal.objects.create(name='Animal 2', zoo=self.zoo)
+
+		res = self.get_stats('total_records')
+		self.assertEqual({'value': 2, 'filters': {}, 'cached': False}, res['total_records'])
+
+
+class MaterializedStatsTest(TestCase):
+
+	def setUp(self):
+		self.zoo_1 = Zoo.objects.create(name='Zoo 1')
+		self.zoo_2 = Zoo.objects.create(name='Zoo 2')
+		self.caretaker = Caretaker.objects.create(name='Caretaker')
+
+		Animal.objects.create(name='Animal 1', zoo=self.zoo_1, caretaker=self.caretaker)
+		Animal.objects.create(name='Animal 2', zoo=self.zoo_2, caretaker=self.caretaker)
+		self.animal = Animal.objects.create(name='Animal 3', zoo=self.zoo_2, caretaker=None)
+
+		u = User(username='testuser', is_active=True, is_superuser=True)
+		u.set_password('test')
+		u.save()
+		self.assertTrue(self.client.login(username='testuser', password='test'))
+
+		call_command('build_stat_rollups', stdout=io.StringIO())
+
+	def get_stats(self, *stats, params={}):
+		res = self.client.get('/animal/stats/', {
+			'stats': ','.join(stats),
+			**params,
+		})
+		self.assertEqual(res.status_code, 200)
+		return json.loads(res.content)
+
+	def assertStats(self, by_zoo, without_caretaker, params={}):
+		res = self.get_stats('materialized_by_zoo', 'materialized_without_caretaker', params=params)
+		self.assertEqual({str(pk): value for pk, value in by_zoo.items()}, res['materialized_by_zoo']['value'])
+		self.assertEqual(without_caretaker, res['materialized_without_caretaker']['value'])
+
+	def test_stats_come_from_rollup(self):
+		with CaptureQueriesContext(connection) as queries:
+			self.assertStats({self.zoo_1.pk: 1, self.zoo_2.pk: 2}, 1)
+		self.assertEqual(0, len([q for q in queries if 'testapp_animal' in q['sql']]))
+
+	def test_rollup_is_updated_on_write(self):
+		Animal.objects.create(name='Animal 4', zoo=self.zoo_1, caretaker=None)
+		self.assertStats({self.zoo_1.pk: 2, self.zoo_2.pk: 2}, 2)
+
+		self.animal.zoo = self.zoo_1
+		self.animal.caretaker = self.caretaker
+		self.animal.save()
+		self.assertStats({self.zoo_1.pk: 3, self.zoo_2.pk: 1}, 1)
+
+		# Soft deleted animals are not counted
+		self.animal.deleted = True
+		self.animal.save()
+		self.assertStats({self.zoo_1.pk: 2, self.zoo_2.pk: 1}, 1)
+
+		Animal.objects.filter(zoo=self.zoo_2).delete()
+		self.assertStats({self.zoo_1.pk: 2}, 1)
+
+	def test_filtered_stats_are_aggregated_live(self):
+		with CaptureQueriesContext(connection) as queries:
+			self.assertStats({self.zoo_2.pk: 2}, 1, params={'.zoo': self.zoo_2.pk})
+		self.assertEqual(2, len([q for q in queries if 'testapp_animal' in q['sql']]))
+
+	def test_stats_are_aggregated_live_until_built(self):
+		StatRollup.objects.all().delete()
+		Animal.objects.create(name='Animal 4', zoo=self.zoo_1, caretaker=None)
+		self.assertStats({self.zoo_1.pk: 2, self.zoo_2.pk: 2}, 2)
+
+	def test_only_sums_of_records_can_be_materialized(self):
+		with self.assertRaises(ValueError):
+			check_materialized_stat(AnimalView, 'foo', Stat(Count('name', distinct=True), materialized=True))
+		with self.assertRaises(ValueError):
+			check_materialized_stat(AnimalView, 'foo', Stat(Sum('magic_number') * 100, materialized=True))
+		with self.assertRaises(ValueError):
+			check_materialized_stat(AnimalView, 'foo', Stat(Sum('name'), materialized=True))
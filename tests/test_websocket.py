@@ -2,7 +2,8 @@ from django.test import TestCase, Client
 from django.contrib.auth.models import User
 from unittest import mock
 from binder.views import JsonResponse
-from binder.websocket import trigger
+from binder.websocket import RoomController, trigger, trigger_on_commit, trigger_metrics, trigger_worker, rabbitmq_publisher
+from django.db import transaction
 from .testapp.urls import room_controller
 from .testapp.models import Animal, Costume
 import requests
@@ -11,8 +12,28 @@ from django.test import override_settings
 
 
 class MockUser:
-	def __init__(self, costumes):
+	def __init__(self, costumes, pk=None):
 		self.costumes = costumes
+		self.pk = pk
+
+
+class CountingView:
+	"""
+	Stands in for a view with room listings, counting the calls.
+	"""
+
+	def __init__(self, batch=False):
+		self.calls = []
+		if batch:
+			self.get_rooms_for_users = self._get_rooms_for_users
+
+	def get_rooms_for_user(self, user):
+		self.calls.append([user])
+		return [{'costume': c} for c in user.costumes] + [{'zoo': 'all'}]
+
+	def _get_rooms_for_users(self, users):
+		self.calls.append(users)
+		return [[{'costume': c} for c in user.costumes] for user in users]
 
 
 def mock_post_high_templar(*args, **kwargs):
@@ -47,7 +68,63 @@ class WebsocketTest(TestCase):
 		rooms = room_controller.list_rooms_for_user(user)
 		self.assertCountEqual(allowed_rooms, rooms)
 
-	@mock.patch('requests.post', side_effect=mock_post_high_templar)
+	def test_room_controller_deduplicates_rooms(self):
+		controller = RoomController()
+		view = CountingView()
+		controller.room_listings = [(view.get_rooms_for_user, None), (lambda user: [{'zoo': 'all'}], None)]
+
+		rooms = controller.list_rooms_for_user(MockUser([1337, 1337]))
+		self.assertEqual([{'costume': 1337}, {'zoo': 'all'}], rooms)
+
+	def test_room_controller_caches_rooms(self):
+		controller = RoomController(cache_timeout=60)
+		view = CountingView()
+		controller.room_listings = [(view.get_rooms_for_user, None)]
+		user = MockUser([1337], pk=1)
+
+		self.assertEqual([{'costume': 1337}, {'zoo': 'all'}], controller.list_rooms_for_user(user))
+		user.costumes = [1338]
+		self.assertEqual([{'costume': 1337}, {'zoo': 'all'}], controller.list_rooms_for_user(user))
+		self.assertEqual(1, len(view.calls))
+
+		controller.invalidate(user)
+		self.assertEqual([{'costume': 1338}, {'zoo': 'all'}], controller.list_rooms_for_user(user))
+		self.assertEqual(2, len(view.calls))
+
+	def test_room_controller_invalidates_on_model_change(self):
+		controller = RoomController(cache_timeout=60).invalidate_on(Costume)
+		view = CountingView()
+		controller.room_listings = [(view.get_rooms_for_user, None)]
+		user = MockUser([1337], pk=1)
+
+		controller.list_rooms_for_user(user)
+		doggo = Animal(name='Woofer')
+		doggo.save()
+		Costume(nickname='Gnarls Barker', animal=doggo).save()
+		controller.list_rooms_for_user(user)
+
+		self.assertEqual(2, len(view.calls))
+
+	def test_room_controller_lists_rooms_for_many_users(self):
+		controller = RoomController(cache_timeout=60)
+		batch_view = CountingView(batch=True)
+		view = CountingView()
+		controller.room_listings = [(None, batch_view.get_rooms_for_users), (view.get_rooms_for_user, None)]
+		users = [MockUser([1], pk=1), MockUser([2], pk=2), MockUser([3], pk=3)]
+
+		controller.list_rooms_for_user(users[1])
+		rooms = controller.list_rooms_for_users(users)
+
+		self.assertEqual([
+			[{'costume': 1}, {'zoo': 'all'}],
+			[{'costume': 2}, {'zoo': 'all'}],
+			[{'costume': 3}, {'zoo': 'all'}],
+		], rooms)
+		# One call for the first user, then one call for both missing users
+		self.assertEqual([[users[1]], [users[0], users[2]]], batch_view.calls)
+		self.assertEqual(3, len(view.calls))
+
+	@mock.patch('requests.Session.post', side_effect=mock_post_high_templar)
 	@override_settings(HIGH_TEMPLAR_URL="http://localhost:8002")
 	def test_post_save_trigger(self, mock):
 		doggo = Animal(name='Woofer')
@@ -55,7 +132,7 @@ class WebsocketTest(TestCase):
 
 		costume = Costume(nickname='Gnarls Barker', description='Foo Bark', animal=doggo)
 		costume.save()
-		self.assertEqual(1, requests.post.call_count)
+		self.assertEqual(1, requests.Session.post.call_count)
 		mock.assert_called_with('http://localhost:8002/trigger/', data=json.dumps({
 				'data': {'id': doggo.id},
 				'rooms': [{'costume': doggo.id}]
@@ -71,25 +148,168 @@ class WebsocketTest(TestCase):
 		self.assertIsNotNone(costume.pk)
 
 
-class TriggerConnectionCloseTest(TestCase):
-	@override_settings(
-		HIGH_TEMPLAR={
-			'rabbitmq': {
-				'host': 'localhost',
-				'username': 'guest',
-				'password': 'guest'
-			}
+class FakeBroker:
+	"""
+	Stands in for RabbitMQ, by replacing pika.BlockingConnection.
+	"""
+
+	def __init__(self):
+		self.connections = []
+		self.messages = []
+
+	def __call__(self, parameters):
+		connection = FakeConnection(self, parameters)
+		self.connections.append(connection)
+		return connection
+
+	def drop_connections(self):
+		for connection in self.connections:
+			connection.is_open = False
+
+
+class FakeConnection:
+	def __init__(self, broker, parameters):
+		self.broker = broker
+		self.parameters = parameters
+		self.is_open = True
+		self.close_count = 0
+
+	@property
+	def is_closed(self):
+		return not self.is_open
+
+	def channel(self):
+		return FakeChannel(self)
+
+	def close(self):
+		self.is_open = False
+		self.close_count += 1
+
+
+class FakeChannel:
+	def __init__(self, connection):
+		self.connection = connection
+
+	@property
+	def is_open(self):
+		# A dropped connection is only noticed when using it
+		return True
+
+	def basic_publish(self, exchange, routing_key, body):
+		from pika.exceptions import StreamLostError
+		if not self.connection.is_open:
+			raise StreamLostError('Stream connection lost')
+		self.connection.broker.messages.append((exchange, routing_key, json.loads(body)))
+
+
+@override_settings(
+	HIGH_TEMPLAR={
+		'rabbitmq': {
+			'host': 'localhost',
+			'username': 'guest',
+			'password': 'guest'
 		}
-	)
-	@mock.patch('pika.BlockingConnection')
-	def test_trigger_calls_connection_close(self, mock_connection_class):
-		mock_connection = mock_connection_class.return_value
-		mock_connection.is_closed = False
+	}
+)
+class TriggerRabbitMQTest(TestCase):
+	def setUp(self):
+		super().setUp()
+		rabbitmq_publisher.close()
+		self.broker = FakeBroker()
+		patcher = mock.patch('pika.BlockingConnection', self.broker)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+		self.addCleanup(rabbitmq_publisher.close)
+
+	def test_trigger_publishes(self):
+		trigger({'id': 123}, [{'costume': 123}])
+
+		self.assertEqual([('hightemplar', '*', {'data': {'id': 123}, 'rooms': [{'costume': 123}]})], self.broker.messages)
+		self.assertEqual('localhost', self.broker.connections[0].parameters.host)
+
+	def test_trigger_reuses_connection(self):
+		trigger({'id': 1}, [{'costume': 1}])
+		trigger({'id': 2}, [{'costume': 2}])
+
+		self.assertEqual(2, len(self.broker.messages))
+		self.assertEqual(1, len(self.broker.connections))
+		self.assertTrue(self.broker.connections[0].is_open)
+
+	def test_close_closes_pooled_connections(self):
+		trigger({'id': 123}, [{'costume': 123}])
+		rabbitmq_publisher.close()
+
+		self.assertEqual(1, self.broker.connections[0].close_count)
+
+	def test_trigger_reconnects_when_connection_is_lost(self):
+		trigger({'id': 1}, [{'costume': 1}])
+		self.broker.drop_connections()
+		trigger({'id': 2}, [{'costume': 2}])
+
+		self.assertEqual([1, 2], [body['data']['id'] for _, _, body in self.broker.messages])
+		self.assertEqual(2, len(self.broker.connections))
+		self.assertTrue(self.broker.connections[1].is_open)
+
+	def test_trigger_reconnects_when_settings_change(self):
+		trigger({'id': 1}, [{'costume': 1}])
+		with override_settings(HIGH_TEMPLAR={'rabbitmq': {'host': 'otherhost', 'username': 'guest', 'password': 'guest'}}):
+			trigger({'id': 2}, [{'costume': 2}])
+
+		self.assertEqual(2, len(self.broker.connections))
+		self.assertEqual('otherhost', self.broker.connections[1].parameters.host)
+		self.assertEqual(1, self.broker.connections[0].close_count)
+
+
+@override_settings(HIGH_TEMPLAR_URL="http://localhost:8002")
+@mock.patch('requests.Session.post', side_effect=mock_post_high_templar)
+class TriggerOnCommitTest(TestCase):
+	def setUp(self):
+		super().setUp()
+		trigger_metrics.reset()
+
+	def sent(self, post):
+		return [json.loads(call[1]['data']) for call in post.call_args_list]
+
+	def test_triggers_are_sent_on_commit(self, post):
+		with self.captureOnCommitCallbacks(execute=True):
+			trigger_on_commit({'id': 1}, [{'costume': 1}])
+			self.assertEqual(0, post.call_count)
+
+		self.assertEqual([{'data': {'id': 1}, 'rooms': [{'costume': 1}]}], self.sent(post))
+
+	def test_triggers_are_not_sent_on_rollback(self, post):
+		with self.captureOnCommitCallbacks(execute=True) as callbacks:
+			try:
+				with transaction.atomic():
+					trigger_on_commit({'id': 1}, [{'costume': 1}])
+					raise ValueError()
+			except ValueError:
+				pass
+
+			trigger_on_commit({'id': 2}, [{'costume': 2}])
+
+		self.assertEqual(1, len(callbacks))
+		self.assertEqual([{'data': {'id': 2}, 'rooms': [{'costume': 2}]}], self.sent(post))
 
-		data = {'id': 123}
-		rooms = [{'costume': 123}]
+	def test_duplicate_triggers_are_collapsed(self, post):
+		with self.captureOnCommitCallbacks(execute=True):
+			trigger_on_commit({'id': 1}, [{'costume': 1}])
+			trigger_on_commit({'id': 2}, [{'costume': 2}])
+			trigger_on_commit({'id': 1}, [{'costume': 1}, {'zoo': 'all'}])
+			trigger_on_commit({'id': 1}, [{'costume': 1}])
 
-		trigger(data, rooms)
+		self.assertEqual([
+			{'data': {'id': 1}, 'rooms': [{'costume': 1}, {'zoo': 'all'}]},
+			{'data': {'id': 2}, 'rooms': [{'costume': 2}]},
+		], self.sent(post))
+		self.assertEqual(4, trigger_metrics.queued)
+		self.assertEqual(2, trigger_metrics.sent)
+		self.assertEqual(2, trigger_metrics.collapsed)
 
-		mock_connection.close.assert_called_once()
+	@override_settings(HIGH_TEMPLAR_TRIGGER_IN_BACKGROUND=True)
+	def test_triggers_can_be_sent_in_background(self, post):
+		with self.captureOnCommitCallbacks(execute=True):
+			trigger_on_commit({'id': 1}, [{'costume': 1}])
 
+		trigger_worker.join()
+		self.assertEqual([{'data': {'id': 1}, 'rooms': [{'costume': 1}]}], self.sent(post))
@@ -2,10 +2,12 @@ from django.urls import path, re_path, include
 
 import binder.router # noqa
 import binder.websocket # noqa
+import binder.rollups # noqa
 import binder.views # noqa
 import binder.history # noqa
 import binder.models # noqa
 import binder.plugins.token_auth.views # noqa
+import binder.plugins.export_jobs.views # noqa
 from binder.plugins.views.multi_request import multi_request_view
 from binder.plugins.views.combined import combined_view
 from .views import animal, caretaker, costume, custom, zoo, contact_person, gate # noqa
@@ -13,6 +15,7 @@ from .views.handle_exceptions import handle_exceptions_view
 
 router = binder.router.Router().register(binder.views.ModelView)
 room_controller = binder.websocket.RoomController().register(binder.views.ModelView)
+binder.rollups.stat_rollups.register(binder.views.ModelView)
 
 urlpatterns = [
 	re_path(r'^custom/route', custom.custom, name='custom'),
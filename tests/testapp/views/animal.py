@@ -28,4 +28,23 @@ class AnimalView(ModelView):
 			Sum('magic_number')*100,
 			annotations=['magic_number'],
 		),
+		'with_caretaker': Stat(
+			Count(Value(1)),
+			filters={'caretaker:isnull': 'false'},
+		),
+		'magic_number_by_zoo': Stat(
+			Sum('magic_number'),
+			group_by='zoo.name',
+			annotations=['magic_number'],
+		),
+		'materialized_by_zoo': Stat(
+			Count(Value(1)),
+			group_by='zoo',
+			materialized=True,
+		),
+		'materialized_without_caretaker': Stat(
+			Count(Value(1)),
+			filters={'caretaker:isnull': 'true'},
+			materialized=True,
+		),
 	}
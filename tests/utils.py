@@ -1,8 +1,10 @@
 from os import urandom
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
 from PIL import Image
 
+from django.test import TransactionTestCase, override_settings
+
 
 IMG_SUFFIX = {
 	'jpeg': '.jpg',
@@ -23,3 +25,23 @@ def temp_imagefile(width, height, format, mode='RGB'):
 	i.save(f, format)
 	f.seek(0)
 	return f
+
+
+class CommittingTestCase(TransactionTestCase):
+	"""
+	A test which is not run in a transaction, so requests commit like they
+	do outside of tests. The tests share the database with all other tests,
+	which is not flushed afterwards, so they have to delete what they create.
+	Files are stored in a temporary MEDIA_ROOT, which is removed afterwards.
+	"""
+
+	def setUp(self):
+		super().setUp()
+		media_root = TemporaryDirectory()
+		self.addCleanup(media_root.cleanup)
+		media_settings = override_settings(MEDIA_ROOT=media_root.name)
+		media_settings.enable()
+		self.addCleanup(media_settings.disable)
+
+	def _fixture_teardown(self):
+		pass